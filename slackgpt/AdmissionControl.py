@@ -0,0 +1,107 @@
+from typing import Callable, Dict, Optional, Tuple
+import threading
+import time
+
+def format_wait(seconds: float) -> str:
+    """Formats an estimated wait for a message to a user
+
+    Args:
+        seconds (float): The amount of seconds
+
+    Returns:
+        str: The wait in seconds, or in minutes from 90 seconds on
+    """
+    return f"{max(1, round(seconds))} seconds" if seconds < 90 else f"{round(seconds / 60)} minutes"
+
+
+class AdmissionControl:
+    def __init__(self, user_rate: float = 0, user_burst: float = 5, max_queue: int = 0, workers: int = 1, smoothing: float = 0.2, initial_duration: float = 30, clock: Callable[[], float] = time.monotonic):
+        """Decides in O(1) whether a question is accepted and estimates how long accepted questions wait
+
+        Every user has a token bucket, the queue has a global cap and the answer time is a moving average of the worker durations.
+
+        Args:
+            user_rate (float, optional): The amount of questions per minute a user may ask, 0 for no limit. Defaults to 0.
+            user_burst (float, optional): The amount of questions a user may ask at once. Defaults to 5.
+            max_queue (int, optional): The maximum amount of queued questions, 0 for no limit. Defaults to 0.
+            workers (int, optional): The amount of workers answering in parallel. Defaults to 1.
+            smoothing (float, optional): The weight of a new duration in the moving average (0-1). Defaults to 0.2.
+            initial_duration (float, optional): The assumed answer time in seconds before anything has been answered. Defaults to 30.
+            clock (Callable[[], float], optional): Returns the current time in seconds. Defaults to time.monotonic.
+        """
+        self.user_rate = user_rate / 60
+        self.user_burst = user_burst
+        self.max_queue = max_queue
+        self.workers = max(1, workers)
+        self.smoothing = smoothing
+        self.average_duration = initial_duration
+        self.clock = clock
+        self.rejected = 0
+        self.__buckets: Dict[str, Tuple[float, float]] = {} # Username -> (tokens, last refill), only users whose bucket isn't full
+        self.__swept = clock() # The time of the latest removal of full buckets
+        self.__lock = threading.Lock()
+
+    def admit(self, username: str, queue_length: int) -> Tuple[bool, Optional[str]]:
+        """Takes a token from the user's bucket if the question may be queued
+
+        Args:
+            username (str): The username of the user
+            queue_length (int): The amount of questions that are already queued
+
+        Returns:
+            Tuple[bool, Optional[str]]: Whether the question is accepted and, if not, a friendly message for the user
+        """
+        with self.__lock:
+            if self.max_queue and queue_length >= self.max_queue:
+                self.rejected += 1
+                return False, f"I am busy right now, {queue_length} questions are waiting already. Please try again in {format_wait(self.eta(queue_length))}."
+            if not self.user_rate:
+                return True, None
+            now = self.clock()
+            if now - self.__swept >= self.user_burst / self.user_rate: # Every bucket has refilled completely since the last sweep
+                self.__sweep(now)
+            tokens, refilled = self.__buckets.get(username, (self.user_burst, now))
+            tokens = min(self.user_burst, tokens + (now - refilled) * self.user_rate)
+            if tokens < 1:
+                self.__buckets[username] = (tokens, now)
+                self.rejected += 1
+                return False, f"You are asking questions faster than I can answer them. Please wait {format_wait((1 - tokens) / self.user_rate)} before asking again."
+            self.__buckets[username] = (tokens - 1, now)
+            return True, None
+
+    def __sweep(self, now: float) -> None:
+        self.__swept = now
+        for username, (tokens, refilled) in list(self.__buckets.items()):
+            if tokens + (now - refilled) * self.user_rate >= self.user_burst: # Same as a new bucket
+                del self.__buckets[username]
+
+    def record(self, duration: float) -> None:
+        """Adds the duration of an answer to the moving average
+
+        Args:
+            duration (float): The amount of seconds the worker needed
+        """
+        with self.__lock:
+            self.average_duration += self.smoothing * (duration - self.average_duration)
+
+    def eta(self, position: int) -> float:
+        """Estimates how long a question at the given queue position waits for its answer
+
+        Args:
+            position (int): The position in the queue, starting at 1
+
+        Returns:
+            float: The estimated amount of seconds
+        """
+        return (position + self.workers - 1) // self.workers * self.average_duration
+
+    def describe(self, position: int) -> str:
+        """Returns the queue position feedback for an accepted question
+
+        Args:
+            position (int): The position in the queue, starting at 1
+
+        Returns:
+            str: The message for the user
+        """
+        return f"You are number {position} in the queue, your answer should arrive in about {format_wait(self.eta(position))}."
@@ -0,0 +1,160 @@
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+import json
+import os
+import threading
+import time
+
+def normalize_prompt(prompt: str, prefix: str = "!") -> str:
+    """Strips the prefix and folds whitespace and case of a prompt
+
+    Args:
+        prompt (str): The prompt as sent by the user
+        prefix (str, optional): The prefix that triggers the bot. Defaults to "!".
+
+    Returns:
+        str: The normalized prompt
+    """
+    prompt = prompt.strip()
+    if prefix and prompt.lower().startswith(prefix.lower()):
+        prompt = prompt[len(prefix):]
+    return " ".join(prompt.casefold().split())
+
+
+class AnswerCache:
+    def __init__(self, prefix: str = "!", ttl: float = 3600, max_entries: int = 10000, max_bytes: int = 16 * 1024 * 1024, excluded_channels: Iterable[str] = ()):
+        """Represents a thread-safe LRU cache of answers shared by all users, keyed by the normalized prompt
+
+        Args:
+            prefix (str, optional): The prefix that triggers the bot, stripped from the prompts. Defaults to "!".
+            ttl (float, optional): The amount of seconds an answer is reused. Defaults to 3600.
+            max_entries (int, optional): The maximum amount of cached answers. Defaults to 10000.
+            max_bytes (int, optional): The maximum size of the cached prompts and answers in bytes. Defaults to 16 MiB.
+            excluded_channels (Iterable[str], optional): The channels that never use the cache, e.g. for stateful conversations. Defaults to ().
+        """
+        self.prefix = prefix.lower()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.excluded_channels = set(excluded_channels)
+        self.hits = 0
+        self.misses = 0
+        self.size = 0 # The size of the cached prompts and answers in bytes
+        self.__entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict() # Normalized prompt -> (answer, expiry timestamp)
+        self.__lock = threading.Lock()
+
+    def normalize(self, prompt: str) -> str:
+        """Strips the prefix and folds whitespace and case of a prompt
+
+        Args:
+            prompt (str): The prompt as sent by the user
+
+        Returns:
+            str: The normalized prompt
+        """
+        return normalize_prompt(prompt, self.prefix)
+
+    def is_enabled(self, channel: str) -> bool:
+        """Checks whether the cache may be used in a channel
+
+        Args:
+            channel (str): The channel id
+
+        Returns:
+            bool: Whether the cache may be used
+        """
+        return self.max_entries > 0 and channel not in self.excluded_channels
+
+    def get(self, prompt: str) -> Optional[str]:
+        """Returns the cached answer for a prompt and counts the hit or miss
+
+        Args:
+            prompt (str): The prompt as sent by the user
+
+        Returns:
+            Optional[str]: The cached answer or None if there is no fresh answer
+        """
+        key = self.normalize(prompt)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[1] <= time.time():
+                self.__remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, prompt: str, answer: str, expiry: Optional[float] = None) -> None:
+        """Caches the answer to a prompt, evicting the least recently used answers when the cache is full
+
+        Args:
+            prompt (str): The prompt as sent by the user
+            answer (str): The answer to the prompt
+            expiry (float, optional): The timestamp at which the answer expires. Defaults to now + ttl.
+        """
+        if answer is not None:
+            self.__store(self.normalize(prompt), answer, expiry if expiry is not None else time.time() + self.ttl)
+
+    def __store(self, key: str, answer: str, expiry: float) -> None:
+        if self.max_entries <= 0:
+            return
+        with self.__lock:
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = (answer, expiry)
+            self.size += len(key.encode()) + len(answer.encode())
+            while self.__entries and (len(self.__entries) > self.max_entries or self.size > self.max_bytes):
+                self.__remove(next(iter(self.__entries)))
+
+    def __remove(self, key: str) -> None:
+        answer, _ = self.__entries.pop(key)
+        self.size -= len(key.encode()) + len(answer.encode())
+
+    def save(self, path: str) -> None:
+        """Writes a snapshot of the fresh answers to a file so they survive restarts
+
+        Args:
+            path (str): The path of the snapshot
+        """
+        now = time.time()
+        with self.__lock:
+            entries = [[key, answer, expiry] for key, (answer, expiry) in self.__entries.items() if expiry > now]
+        with open(path + ".tmp", "w") as f:
+            json.dump(entries, f)
+        os.replace(path + ".tmp", path)
+
+    def load(self, path: str) -> int:
+        """Loads a snapshot written by save, skipping expired answers
+
+        Args:
+            path (str): The path of the snapshot
+
+        Returns:
+            int: The amount of loaded answers
+        """
+        if not os.path.exists(path):
+            return 0
+        with open(path, "r") as f:
+            entries = json.load(f)
+        now = time.time()
+        loaded = 0
+        for key, answer, expiry in entries:
+            if expiry > now:
+                self.__store(key, answer, expiry)
+                loaded += 1
+        return loaded
+
+    def stats(self) -> str:
+        """Returns a human readable summary of the cache
+
+        Returns:
+            str: The amount of entries, their size and the hit rate
+        """
+        total = self.hits + self.misses
+        return f"Answer cache: {len(self)} entries, {self.size} bytes, {self.hits} hits, {self.misses} misses ({self.hits / total * 100 if total else 0:.1f}% hit rate)"
+
+    def __len__(self) -> int:
+        return len(self.__entries)
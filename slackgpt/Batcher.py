@@ -0,0 +1,106 @@
+from typing import Hashable, List, Optional
+import re
+from Question import Question
+
+class Batcher:
+    marker = re.compile(r"\[\[(\d+)\]\]")
+
+    def __init__(self, prefix: str = "!", max_size: int = 4, window: float = 30.0, max_chars: int = 4000):
+        """Merges queued follow-up questions of a user into the question a worker just took, so they cost one backend ask
+
+        The prompts are numbered and the backend is asked to answer each one after its number. The reply is split
+        back into one answer per question. If the reply doesn't follow the numbering, the first question gets the
+        whole reply and the others point to it.
+
+        Args:
+            prefix (str, optional): The prefix that triggers the bot, it is not part of the merged prompts. Defaults to "!".
+            max_size (int, optional): The maximum amount of questions in one ask. Defaults to 4.
+            window (float, optional): The maximum amount of seconds between the first and any other merged question. Defaults to 30.0.
+            max_chars (int, optional): The maximum amount of prompt characters in one ask. Defaults to 4000.
+        """
+        self.prefix = prefix
+        self.max_size = max_size
+        self.window = window
+        self.max_chars = max_chars
+        self.batches = 0 # The amount of asks with more than one question
+        self.merged = 0 # The amount of questions that were answered by another question's ask
+
+    def strip(self, text: str) -> str:
+        return text[len(self.prefix):] if text.lower().startswith(self.prefix.lower()) else text
+
+    def collect(self, queue, worker: Hashable, first: Question) -> List[Question]:
+        """Takes the queued questions that can be asked together with a question a worker took
+
+        Args:
+            queue (Queue): The queue to take the questions from
+            worker (Hashable): The worker that took the question, its lane is searched too
+            first (Question): The question the worker took
+
+        Returns:
+            List[Question]: The question followed by the taken questions in the order they were asked
+        """
+        if self.max_size < 2 or first.followers: # Other users wait for the answer to exactly this prompt
+            return [first]
+        budget = self.max_chars - len(self.strip(first.text))
+        def fits(question: Question) -> bool:
+            nonlocal budget
+            if question.username != first.username or question.followers or abs(question.created - first.created) > self.window:
+                return False
+            size = len(self.strip(question.text))
+            if size > budget:
+                return False
+            budget -= size
+            return True
+        taken = queue.take(worker, fits, self.max_size - 1)
+        if not taken:
+            return [first]
+        taken.sort(key=lambda question: question.created)
+        self.batches += 1
+        self.merged += len(taken)
+        return [first] + taken
+
+    def prompt(self, prompts: List[str]) -> str:
+        """Merges prompts into one numbered prompt
+
+        Args:
+            prompts (List[str]): The prompts in the order they were asked
+
+        Returns:
+            str: The merged prompt
+        """
+        if len(prompts) == 1:
+            return prompts[0]
+        lines = [f"I sent you {len(prompts)} messages at once. Answer each of them separately and in order, and start every answer with the number of its message in double brackets, like [[1]]."]
+        lines += [f"[[{index}]] {prompt}" for index, prompt in enumerate(prompts, 1)]
+        return "\n\n".join(lines)
+
+    def split(self, answer: str, count: int) -> Optional[List[str]]:
+        """Splits the reply to a merged prompt into the answers to its prompts
+
+        Args:
+            answer (str): The reply
+            count (int): The amount of merged prompts
+
+        Returns:
+            Optional[List[str]]: The answers in the order of the prompts or None if the reply doesn't contain every number once
+        """
+        if count == 1:
+            return [answer]
+        parts = self.marker.split(answer) # Text before the first number, then number and answer pairs
+        answers = {}
+        for number, text in zip(parts[1::2], parts[2::2]):
+            number = int(number)
+            if number in answers or not 1 <= number <= count or not text.strip():
+                return None
+            answers[number] = text.strip()
+        if len(answers) != count:
+            return None
+        return [answers[number] for number in range(1, count + 1)]
+
+    def stats(self) -> str:
+        """Returns a human readable summary of the batching
+
+        Returns:
+            str: The summary
+        """
+        return f"Batching: {self.merged} questions merged into {self.batches} asks"
@@ -1,31 +1,205 @@
+from typing import Iterator, List, Optional
+import random
 import threading
+import time
 from Handler import Handler
 from Logger import *
 from Question import Question
+import Metrics
 
 class ChatBotThread(threading.Thread):
+    warm_up_prompt: Optional[str] = None # Asked once after the backend is built so the first question doesn't pay for the cold page, None to skip
+    start_attempts = 3 # The amount of times building the backend is tried before the worker gives up
 
-    def __init__(self, handler: Handler, browser: str, prefix: str = "!", headless: bool = True):
+    def __init__(self, handler: Handler, browser: str, prefix: str = "!", headless: bool = True, name: str = None, stream: bool = False):
         """Inherits from threading.Thread and is used to run ChatGPT in a separate thread
 
         Args:
             handler (Handler): The handler to use in the main thread
             browser (str): The browser playwright should use
             headless (bool, optional): Whether to run ChatGPT in headless mode. Defaults to True.
+            name (str, optional): The name of the thread, also used to route conversations to this worker. Defaults to None.
+            stream (bool, optional): Whether to show the answer while it is generated. Defaults to False.
         """
-        super().__init__()
+        super().__init__(name=name, daemon=True)
         self.queue = handler.queue
         self.handler = handler
         self.lg = Logger("ChatGPT", level=Level.INFO, formatter=Logger.minecraft_formatter, handlers=[FileHandler.latest_file_handler(Logger.minecraft_formatter), main_file_handler])
         self.browser = browser
         self.headless = headless
         self.prefix = prefix
+        self.stream = stream
+        self.poll_interval = 1.0 # Seconds to block on the queue before checking for a shutdown
+        self.busy = False # Whether the worker is answering a question, for the utilization metric
+        self.bot = None
+        self.ask_timeout = 0.0 # Seconds the backend may take without progress before the watchdog gives up on it, 0 for no limit
+        self.recycle_after = 0 # The amount of asks after which the backend is rebuilt, 0 for never
+        self.asks = 0 # The amount of asks since the backend was built
+        self.recycle_requested = False # Set by the watchdog, e.g. when the memory limit is exceeded
+        self.abandoned = False # Set by the watchdog when the backend hung, the thread must not touch the question anymore
+        self.current: List[Question] = [] # The questions being answered
+        self.deadline: Optional[float] = None # The monotonic time at which the current ask times out
+        self.deadline_lock = threading.Lock()
+        self.ready = threading.Event() # Set while the backend is built and warmed up
+        self.active = threading.Event() # Cleared for spare workers, which build their backend and wait until they replace a worker
+        self.active.set()
+        self.start_duration = 0.0 # The amount of seconds the latest backend took to start
+        self.__recycle_at = 0
 
     def create_bot(self):
         return None
 
+    def start_bot(self) -> bool:
+        """Builds the backend, warms it up with warm_up_prompt and marks the worker as ready
+
+        A failed build is tried again after 2, 4, ... seconds, up to start_attempts times.
+
+        Returns:
+            bool: Whether the backend is ready, False if every attempt failed or the queue was shut down
+        """
+        self.ready.clear()
+        for attempt in range(1, self.start_attempts + 1):
+            self.lg.info(f"Initializing the backend of {self.name}")
+            start = time.monotonic()
+            try:
+                self.bot = self.create_bot()
+                break
+            except Exception as e:
+                Metrics.errors.inc(kind="backend_start")
+                self.lg.error(f"Failed to initialize the backend of {self.name} (attempt {attempt}/{self.start_attempts}): {e}")
+                if attempt == self.start_attempts:
+                    return False
+                backoff = time.monotonic() + min(2 ** attempt, 30)
+                while not self.queue.is_shutdown and time.monotonic() < backoff:
+                    time.sleep(max(0.0, min(self.poll_interval, backoff - time.monotonic())))
+                if self.queue.is_shutdown:
+                    return False
+        if self.warm_up_prompt:
+            try:
+                self.bot.ask(self.warm_up_prompt) # The next ask switches to the conversation of its user
+            except Exception as e:
+                self.lg.warning(f"Failed to warm up the backend of {self.name}: {e}")
+        self.start_duration = time.monotonic() - start
+        Metrics.backend_start_seconds.observe(self.start_duration)
+        self.lg.info(f"Initialized the backend of {self.name}. Took {self.start_duration} seconds")
+        self.ready.set()
+        if self.handler.startup is not None and self.active.is_set(): # A spare reports once it is activated
+            self.handler.startup.backend_ready(self.name, self.start_duration)
+        return True
+
+    def activate(self) -> None:
+        """Lets a spare worker answer questions, it counts as a ready backend from now on if its backend is built
+        """
+        self.active.set()
+        if self.handler.startup is not None and self.ready.is_set():
+            self.handler.startup.backend_ready(self.name, self.start_duration)
+
+    def close_bot(self) -> None:
+        """Tears down the backend, e.g. its browser. May be called from the watchdog while the backend hangs
+        """
+        close = getattr(self.bot, "close", None)
+        if callable(close):
+            close()
+
+    def recycle(self, reason: str) -> bool:
+        """Tears down the backend and builds a new one with create_bot
+
+        Args:
+            reason (str): Why the backend is recycled, for the log and the metrics
+
+        Returns:
+            bool: Whether the new backend is ready, see start_bot
+        """
+        self.lg.info(f"Recycling the backend of {self.name} after {self.asks} asks ({reason})")
+        Metrics.recycles.inc(reason=reason)
+        try:
+            self.close_bot()
+        except Exception as e:
+            self.lg.error(f"Failed to close the backend of {self.name}: {e}")
+        self.asks = 0
+        self.recycle_requested = False
+        self.__recycle_at = 0
+        return self.start_bot()
+
+    def needs_recycle(self) -> Optional[str]:
+        """Returns why the backend should be recycled before the next ask, the ask limit is spread by up to 20% so workers don't recycle together
+
+        Returns:
+            Optional[str]: The reason or None if the backend can be kept
+        """
+        if self.recycle_requested:
+            return "memory"
+        if self.recycle_after:
+            if not self.__recycle_at:
+                self.__recycle_at = self.recycle_after + random.randint(0, self.recycle_after // 5)
+            if self.asks >= self.__recycle_at:
+                return "asks"
+        return None
+
+    def start_deadline(self, questions: List[Question]) -> None:
+        """Starts the deadline of an ask
+
+        Args:
+            questions (List[Question]): The questions being answered
+        """
+        with self.deadline_lock:
+            self.current = questions
+            self.deadline = time.monotonic() + self.ask_timeout if self.ask_timeout else None
+
+    def extend_deadline(self) -> bool:
+        """Restarts the deadline because the backend made progress, e.g. streamed a chunk
+
+        Returns:
+            bool: Whether the ask may continue, False if the watchdog abandoned it
+        """
+        with self.deadline_lock:
+            if self.abandoned:
+                return False
+            if self.deadline is not None:
+                self.deadline = time.monotonic() + self.ask_timeout
+            return True
+
+    def clear_deadline(self) -> bool:
+        """Ends the deadline of an ask before the question is answered
+
+        Returns:
+            bool: Whether the worker may answer the question, False if the watchdog abandoned it
+        """
+        with self.deadline_lock:
+            if self.abandoned:
+                return False
+            self.deadline = None
+            self.current = []
+            return True
+
+    def expire(self, now: float) -> List[Question]:
+        """Abandons the current ask if its deadline has passed. Called by the watchdog
+
+        Args:
+            now (float): The current monotonic time
+
+        Returns:
+            List[Question]: The questions of the abandoned ask, empty if the worker is fine
+        """
+        with self.deadline_lock:
+            if self.abandoned or self.deadline is None or now < self.deadline:
+                return []
+            self.abandoned = True
+            return self.current
+
     def run(self) -> None:
         return super().run()
 
     def ask(self, question: Question) -> str:
-        return ""
\ No newline at end of file
+        return ""
+
+    def ask_stream(self, prompt: str) -> Iterator[str]:
+        """Yields the answer to a prompt in chunks. Backends that can't stream yield the whole answer at once
+
+        Args:
+            prompt (str): The prompt for the chatbot
+
+        Yields:
+            str: The next chunk of the answer
+        """
+        yield self.bot.ask(prompt)
\ No newline at end of file
@@ -0,0 +1,407 @@
+from typing import IO, Iterator, List, Optional
+from datetime import datetime
+import argparse
+import glob
+import gzip
+import heapq
+import json
+import os
+import threading
+import time
+from Logger import *
+
+class ChatMessage:
+    __slots__ = ("channel", "username", "text", "fields", "time")
+
+    def __init__(self, channel: str, username: str, text: str, **fields):
+        """A chat line for the CHAT logger, file handlers write it as text and ChatLog as a JSON record
+
+        Args:
+            channel (str): The id of the channel
+            username (str): The username of the author
+            text (str): The text of the message
+            **fields: Extra fields of the record, e.g. the event id
+        """
+        self.channel = channel
+        self.username = username
+        self.text = text
+        self.fields = fields
+        self.time = time.time()
+
+    def to_dict(self) -> dict:
+        return {"time": self.time, "channel": self.channel, "user": self.username, "text": self.text, **self.fields}
+
+    def __str__(self) -> str:
+        return f"[{self.channel}] {self.username}: {self.text}"
+
+
+class ChatLog(Handler):
+    def __init__(self, directory: str = "./logs/chat", level: Level = Level.LOG, max_bytes: int = 64 * 2 ** 20, max_age: float = 86400.0, retention: float = 30 * 86400.0, block_lines: int = 256, block_bytes: int = 64 * 1024, writer: LogWriter = None):
+        """A Logger handler that writes chat messages as JSON Lines into rotating segments and gzips the closed ones
+
+        Every segment has a sidecar index with one entry per block of lines: its offset and size in the segment,
+        its first and last timestamp and its channels. Closed segments are compressed block by block into separate
+        gzip members, so a block can be read without decompressing the blocks before it. A query only reads the
+        blocks whose time range and channels match (see query).
+
+        Every process writes its own segments, named after their start time and the process id. The lines and index
+        entries are written in batches by a LogWriter, so logging a message doesn't wait for the disk.
+
+        Args:
+            directory (str, optional): The directory of the segments. Defaults to "./logs/chat".
+            level (Level, optional): The lowest level to write. Defaults to Level.LOG.
+            max_bytes (int, optional): The size after which a segment is closed. Defaults to 64 MiB.
+            max_age (float, optional): The amount of seconds after which a segment is closed. Defaults to a day.
+            retention (float, optional): The amount of seconds closed segments are kept, 0 to keep them forever. Defaults to 30 days.
+            block_lines (int, optional): The maximum amount of lines in an indexed block. Defaults to 256.
+            block_bytes (int, optional): The maximum amount of bytes in an indexed block. Defaults to 64 KiB.
+            writer (LogWriter, optional): The writer that batches the lines. Defaults to the shared log_writer.
+        """
+        self.directory = directory
+        self.level = level
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.retention = retention
+        self.block_lines = block_lines
+        self.block_bytes = block_bytes
+        self.writer = writer if writer is not None else log_writer
+        self.lg = Logger("ChatLog", level=Level.INFO, formatter=Logger.minecraft_formatter, handlers=[FileHandler.latest_file_handler(Logger.minecraft_formatter), main_file_handler])
+        self.__lock = threading.Lock()
+        self.__path: Optional[str] = None # The segment that is being written
+        self.__size = 0 # The size of the segment including the lines the writer hasn't written yet
+        self.__opened = 0.0
+        self.__segments = 0 # The amount of segments opened by this process, several may start within a second
+        self.__block: Optional[dict] = None # The entry of the block that is being written
+        self.__compressing: List[threading.Thread] = []
+        os.makedirs(directory, exist_ok=True)
+        self.__expire()
+        for path in glob.glob(os.path.join(directory, "*.jsonl")): # Left open by a stopped process, or its compression was interrupted
+            if not self.is_written(path):
+                self.__compress_later(path)
+
+    @staticmethod
+    def index_path(path: str) -> str:
+        path = path[:-len(".gz")] if path.endswith(".gz") else path
+        return path[:-len(".jsonl")] + ".idx"
+
+    @staticmethod
+    def is_written(path: str) -> bool:
+        """Checks whether a plain segment is still written by another running process
+
+        Args:
+            path (str): The path of the segment
+
+        Returns:
+            bool: Whether the process in the name of the segment is running
+        """
+        try:
+            pid = int(os.path.basename(path)[:-len(".jsonl")].rsplit("_", 1)[1])
+        except (IndexError, ValueError):
+            return False
+        if pid == os.getpid():
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError: # Running as another user
+            pass
+        return True
+
+    def __call__(self, text, name: str, level: Level) -> None:
+        if level.value < self.level.value:
+            return
+        record = text.to_dict() if isinstance(text, ChatMessage) else {"time": time.time(), "text": str(text)}
+        line = json.dumps(record, separators=(",", ":")) + "\n" # ASCII, so its length is its size in the file
+        with self.__lock:
+            if self.__path is not None and (self.__size >= self.max_bytes or time.time() - self.__opened >= self.max_age):
+                self.__rotate()
+            if self.__path is None:
+                self.__open()
+            offset = self.__size
+            self.writer.write(self.__path, line)
+            self.__size += len(line)
+            block = self.__block
+            if block is None:
+                block = self.__block = {"offset": offset, "size": 0, "lines": 0, "start": record["time"], "end": record["time"], "channels": []}
+            block["size"] += len(line)
+            block["lines"] += 1
+            block["end"] = max(block["end"], record["time"])
+            if "channel" in record and record["channel"] not in block["channels"]:
+                block["channels"].append(record["channel"])
+            if block["lines"] >= self.block_lines or block["size"] >= self.block_bytes:
+                self.__end_block()
+
+    def __open(self) -> None:
+        self.__opened = time.time()
+        self.__segments += 1
+        name = f"chat_{datetime.fromtimestamp(self.__opened).strftime('%Y-%m-%d_%H-%M-%S')}_{self.__segments}_{os.getpid()}"
+        self.__path = os.path.join(self.directory, name + ".jsonl")
+        self.__size = 0
+        self.writer.write(self.index_path(self.__path), json.dumps({"segment": os.path.basename(self.__path)}) + "\n")
+
+    def __end_block(self) -> None:
+        self.writer.write(self.index_path(self.__path), json.dumps(self.__block, separators=(",", ":")) + "\n")
+        self.__block = None
+
+    def __rotate(self) -> None:
+        if self.__block is not None:
+            self.__end_block()
+        self.writer.flush() # The compression reads the whole segment
+        self.__compress_later(self.__path)
+        self.__path = None
+        self.__expire()
+
+    def __compress_later(self, path: str) -> None:
+        self.__compressing = [thread for thread in self.__compressing if thread.is_alive()]
+        thread = threading.Thread(target=self.compress, args=(path,), name="ChatLog-compress", daemon=True)
+        thread.start()
+        self.__compressing.append(thread)
+
+    def compress(self, path: str) -> None:
+        """Gzips a closed segment one block per gzip member and rewrites its index with the compressed offsets
+
+        Args:
+            path (str): The path of the plain segment
+        """
+        try:
+            index = read_index(self.index_path(path))
+            if index is not None and index[0].get("segment", "").endswith(".gz"): # Compressed before the plain file was removed
+                os.remove(path)
+                return
+            compressed = path + ".gz"
+            blocks = []
+            with open(path, "rb") as source, open(compressed + ".tmp", "wb") as target:
+                for block in blocks_of(source, self.block_lines, self.block_bytes):
+                    offset = target.tell()
+                    target.write(gzip.compress(block["data"], compresslevel=6, mtime=0))
+                    del block["data"]
+                    block["offset"], block["size"] = offset, target.tell() - offset
+                    blocks.append(block)
+                target.flush()
+                os.fsync(target.fileno())
+            with open(self.index_path(path) + ".tmp", "w") as f:
+                f.write(json.dumps({"segment": os.path.basename(compressed)}) + "\n")
+                f.writelines(json.dumps(block, separators=(",", ":")) + "\n" for block in blocks)
+            os.replace(compressed + ".tmp", compressed)
+            os.replace(self.index_path(path) + ".tmp", self.index_path(path)) # From now on the index points to the compressed segment
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.lg.info(f"Compressed {os.path.basename(path)} from {size / 2 ** 20:.1f}MiB to {os.path.getsize(compressed) / 2 ** 20:.1f}MiB")
+        except (OSError, ValueError) as e:
+            self.lg.error(f"Failed to compress the chat log {path}: {e}")
+
+    def __expire(self) -> None:
+        if not self.retention:
+            return
+        now = time.time()
+        for path in glob.glob(os.path.join(self.directory, "*.jsonl.gz")) + glob.glob(os.path.join(self.directory, "*.jsonl")):
+            if path == self.__path or (path.endswith(".jsonl") and self.is_written(path)):
+                continue
+            try:
+                if now - os.path.getmtime(path) <= self.retention:
+                    continue
+                os.remove(path)
+                remove_missing(self.index_path(path))
+                self.lg.info(f"Deleted the chat log {os.path.basename(path)} after the retention")
+            except FileNotFoundError: # Deleted by another process
+                pass
+            except OSError as e:
+                self.lg.error(f"Failed to delete the chat log {path}: {e}")
+        # Left behind by a failed compression or delete, a compression in progress keeps its temporary files recent
+        for path in glob.glob(os.path.join(self.directory, "*.idx")) + glob.glob(os.path.join(self.directory, "*.tmp")):
+            segment = path[:-len(".idx")] + ".jsonl"
+            if path.endswith(".idx") and (os.path.exists(segment) or os.path.exists(segment + ".gz")):
+                continue
+            try:
+                if now - os.path.getmtime(path) > self.retention:
+                    remove_missing(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.lg.error(f"Failed to delete the chat log file {path}: {e}")
+
+    def close(self) -> None:
+        """Closes the current segment and waits until every closed segment is compressed
+        """
+        with self.__lock:
+            if self.__path is not None:
+                self.__rotate()
+        for thread in self.__compressing:
+            thread.join()
+
+
+def remove_missing(path: str) -> None:
+    """Removes a file that may not exist anymore
+
+    Args:
+        path (str): The path of the file
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def blocks_of(file: IO, block_lines: int, block_bytes: int) -> Iterator[dict]:
+    """Splits a plain segment into blocks of complete lines and describes them like the index does
+
+    Args:
+        file (IO): The segment, opened in binary mode at the start of the first block
+        block_lines (int): The maximum amount of lines in a block
+        block_bytes (int): The maximum amount of bytes in a block
+
+    Yields:
+        dict: The index entry of each block with its lines in "data"
+    """
+    block = None
+    offset = file.tell()
+    for line in file:
+        if not line.endswith(b"\n"): # Torn by a crash
+            break
+        try:
+            record = json.loads(line)
+        except ValueError:
+            offset += len(line)
+            continue
+        if block is None:
+            block = {"offset": offset, "size": 0, "lines": 0, "start": record["time"], "end": record["time"], "channels": [], "data": b""}
+        block["data"] += line
+        block["size"] += len(line)
+        block["lines"] += 1
+        block["end"] = max(block["end"], record["time"])
+        if "channel" in record and record["channel"] not in block["channels"]:
+            block["channels"].append(record["channel"])
+        offset += len(line)
+        if block["lines"] >= block_lines or block["size"] >= block_bytes:
+            yield block
+            block = None
+    if block is not None:
+        yield block
+
+
+def read_index(path: str) -> Optional[List[dict]]:
+    """Reads the index of a segment
+
+    Args:
+        path (str): The path of the index
+
+    Returns:
+        Optional[List[dict]]: The header followed by the block entries, or None if there is no index
+    """
+    entries = []
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                entries.append(json.loads(line))
+    except FileNotFoundError: # Not written yet or deleted after the retention
+        return None
+    return entries if entries else None
+
+
+def read_segment(directory: str, index: List[dict], start: float, end: float, channels: Optional[List[str]] = None) -> Iterator[dict]:
+    """Reads the records of a segment within a time range, only the matching blocks are read
+
+    Args:
+        directory (str): The directory of the segment
+        index (List[dict]): The index of the segment, see read_index
+        start (float): The earliest timestamp
+        end (float): The latest timestamp
+        channels (List[str], optional): The channels to read. Defaults to None (every channel).
+
+    Yields:
+        dict: The records in the order they were written
+    """
+    path = os.path.join(directory, index[0]["segment"])
+    compressed = path.endswith(".gz")
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        if compressed: # Deleted after the retention
+            return
+        index = read_index(ChatLog.index_path(path)) # Compressed since the index was read
+        if index is not None and index[0]["segment"].endswith(".gz"):
+            yield from read_segment(directory, index, start, end, channels)
+        return
+    with f:
+        for block in index[1:]:
+            if block["end"] < start or block["start"] > end or (channels and not set(channels) & set(block["channels"])):
+                continue
+            f.seek(block["offset"])
+            data = f.read(block["size"])
+            yield from filter_records(gzip.decompress(data) if compressed else data, start, end, channels)
+        if compressed:
+            return
+        f.seek(index[-1]["offset"] + index[-1]["size"] if len(index) > 1 else 0) # The lines after the last indexed block of an open segment
+        yield from filter_records(f.read(), start, end, channels)
+
+
+def filter_records(data: bytes, start: float, end: float, channels: Optional[List[str]]) -> Iterator[dict]:
+    for line in data.splitlines(keepends=True):
+        if not line.endswith(b"\n"):
+            break
+        record = json.loads(line)
+        if start <= record["time"] <= end and (not channels or record.get("channel") in channels):
+            yield record
+
+
+def query(directory: str, start: float = 0.0, end: float = float("inf"), channels: Optional[List[str]] = None) -> Iterator[dict]:
+    """Reads the chat records of every segment in a directory within a time range, merged by time
+
+    Args:
+        directory (str): The directory of the segments
+        start (float, optional): The earliest timestamp. Defaults to 0.0.
+        end (float, optional): The latest timestamp. Defaults to no limit.
+        channels (List[str], optional): The channels to read. Defaults to None (every channel).
+
+    Yields:
+        dict: The records
+    """
+    segments = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.idx"))):
+        index = read_index(path)
+        if index is None:
+            continue
+        if len(index) > 1 and index[0]["segment"].endswith(".gz") and (max(block["end"] for block in index[1:]) < start or min(block["start"] for block in index[1:]) > end):
+            continue
+        segments.append(read_segment(directory, index, start, end, channels))
+    return heapq.merge(*segments, key=lambda record: record["time"]) # Segments of several processes overlap
+
+
+def parse_time(value: str) -> float:
+    """Parses an ISO 8601 time, a unix timestamp or an amount of minutes (m), hours (h) or days (d) ago
+
+    Args:
+        value (str): The time, e.g. "2023-03-01T12:00", "1677672000" or "2h"
+
+    Returns:
+        float: The unix timestamp
+    """
+    units = {"m": 60, "h": 3600, "d": 86400}
+    if value[-1:] in units and value[:-1].replace(".", "", 1).isdigit():
+        return time.time() - float(value[:-1]) * units[value[-1]]
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+# Query CLI
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prints the chat messages of a time range from the chat log")
+    parser.add_argument("--directory", default="./logs/chat", help="Specify the directory of the chat log")
+    parser.add_argument("--since", type=parse_time, default=0.0, help="Specify the earliest message: ISO time, unix timestamp or e.g. 2h for two hours ago")
+    parser.add_argument("--until", type=parse_time, default=float("inf"), help="Specify the latest message, like --since")
+    parser.add_argument("--channel", action="append", help="Specify a channel to print (can be repeated)")
+    parser.add_argument("--json", action="store_true", help="Print the JSON records instead of text lines")
+    args = parser.parse_args()
+    try:
+        for record in query(args.directory, args.since, args.until, args.channel):
+            if args.json:
+                print(json.dumps(record, ensure_ascii=False))
+            else:
+                print(f"[{datetime.fromtimestamp(record['time']).strftime('%Y-%m-%d %H:%M:%S')}] [{record.get('channel', '')}] {record.get('user', '')}: {record['text']}")
+    except BrokenPipeError: # Piped into head
+        pass
@@ -0,0 +1,70 @@
+from collections import OrderedDict
+from typing import Hashable
+import threading
+import time
+
+class ExpiringSet:
+    def __init__(self, ttl: float = 600, max_size: int = 100000):
+        """Represents a thread-safe set whose entries expire after a fixed time and whose size is capped
+
+        Entries are kept in insertion order, which is also their expiry order, so expiring and evicting is O(1) per entry.
+
+        Args:
+            ttl (float, optional): The amount of seconds an entry is kept. Defaults to 600 (covers Slack's retry window).
+            max_size (int, optional): The maximum amount of entries, the oldest entries are evicted first. Defaults to 100000.
+
+        Raises:
+            ValueError: If the ttl or max_size are not positive
+        """
+        if ttl <= 0 or max_size <= 0:
+            raise ValueError("ttl and max_size must be positive")
+        self.ttl = ttl
+        self.max_size = max_size
+        self.__entries: "OrderedDict[Hashable, float]" = OrderedDict() # Key -> expiry timestamp
+        self.__lock = threading.Lock()
+
+    def __expire(self, now: float) -> None:
+        while self.__entries:
+            key, expiry = next(iter(self.__entries.items()))
+            if expiry > now:
+                break
+            del self.__entries[key]
+
+    def add(self, key: Hashable) -> bool:
+        """Adds a key if it isn't already in the set
+
+        Args:
+            key (Hashable): The key to add
+
+        Returns:
+            bool: Whether the key was added, False if it was already present
+        """
+        now = time.monotonic()
+        with self.__lock:
+            self.__expire(now)
+            if key in self.__entries:
+                return False
+            self.__entries[key] = now + self.ttl
+            if len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+            return True
+
+    def discard(self, key: Hashable) -> None:
+        """Removes a key if it is present
+
+        Args:
+            key (Hashable): The key to remove
+        """
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def __contains__(self, key: Hashable) -> bool:
+        now = time.monotonic()
+        with self.__lock:
+            self.__expire(now)
+            return key in self.__entries
+
+    def __len__(self) -> int:
+        with self.__lock:
+            self.__expire(time.monotonic())
+            return len(self.__entries)
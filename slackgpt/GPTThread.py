@@ -1,47 +1,158 @@
 from Handler import Handler
 from Logger import *
 from Question import Question
-from chatgpt_wrapper import ChatGPT
 import time
+import traceback
+from typing import Iterator, List
 from ChatBotThread import ChatBotThread
+import Metrics
 
 class GPTThread(ChatBotThread):
-    def __init__(self, handler: Handler, browser: str, prefix: str = "!", headless: bool = True):
+    def __init__(self, handler: Handler, browser: str, prefix: str = "!", headless: bool = True, name: str = None, stream: bool = False):
         """Inherits from threading.Thread and is used to run ChatGPT in a separate thread
 
         Args:
             handler (Handler): The handler to use in the main thread
             browser (str): The browser playwright should use
             headless (bool, optional): Whether to run ChatGPT in headless mode. Defaults to True.
+            name (str, optional): The name of the thread, also used to route conversations to this worker. Defaults to None.
+            stream (bool, optional): Whether to show the answer while it is generated. Defaults to False.
         """
         super().__init__(handler,
             browser, 
             prefix, 
-            headless
+            headless,
+            name,
+            stream
         )
-        self.create_bot = lambda: ChatGPT(browser=self.browser, headless=self.headless)
-
     def run(self):
         """The method that is run when the thread is started
         """
-        self.lg.info(f"Running GPT Thread {self.ident}")
-        self.lg.info(f"Initializing ChatGPT")
-        start = time.time()
-        self.bot = self.create_bot()
-        self.lg.info(f"Initialized ChatGPT. Took {time.time() - start} seconds")
-        while True:
-            if len(self.queue) > 0:
-                self.ask(self.queue.pop())
+        self.lg.info(f"Running GPT Thread {self.name}")
+        if not self.start_bot():
+            self.lg.error(f"Stopped GPT Thread {self.name}, its backend couldn't be started")
+            return # The watchdog replaces the thread
+        while not self.active.wait(self.poll_interval): # Spare workers wait until they replace a worker
+            if self.queue.is_shutdown:
+                self.lg.info(f"Stopped spare GPT Thread {self.name}")
+                return
+        while not self.abandoned:
+            reason = self.needs_recycle()
+            if reason is not None and not self.recycle(reason):
+                self.lg.error(f"Stopped GPT Thread {self.name}, its backend couldn't be rebuilt")
+                return
+            question = self.queue.pop(timeout=self.poll_interval, worker=self.name)
+            if question is None:
+                if self.queue.is_shutdown:
+                    break
+                continue
+            questions = self.handler.batcher.collect(self.queue, self.name, question) if self.handler.batcher is not None else [question]
+            for question in questions:
+                question.mark("dequeued")
+                if self.handler.journal is not None:
+                    self.handler.journal.dequeue(question)
+            self.busy = True
+            start = time.monotonic()
+            try:
+                self.ask_batch(questions)
+            finally:
+                self.busy = False
+                Metrics.worker_busy_seconds.inc(time.monotonic() - start, worker=self.name)
+            self.asks += 1
+        self.lg.info(f"Stopped GPT Thread {self.name}")
+
+    def create_bot(self):
+        from chatgpt_wrapper import ChatGPT # Imports Playwright, so it is only loaded by the threads that need it
+        return ChatGPT(browser=self.browser, headless=self.headless)
+
+    def ask_stream(self, prompt: str) -> Iterator[str]:
+        if not hasattr(self.bot, "ask_stream"):
+            yield from super().ask_stream(prompt)
+            return
+        yield from self.bot.ask_stream(prompt)
+
+    def close_bot(self) -> None:
+        super().close_bot()
+        for close in (getattr(getattr(self.bot, "browser", None), "close", None), getattr(getattr(self.bot, "play", None), "stop", None)):
+            if callable(close):
+                close()
+
+    def prompt(self, question: Question) -> str:
+        return question.text[len(self.prefix):] if question.text.lower().startswith(self.prefix.lower()) else question.text
 
     def ask(self, question: Question) -> str:
+        self.ask_batch([question])
+        return question.answer_text
+
+    def ask_batch(self, questions: List[Question]) -> None:
+        """Asks ChatGPT one or more questions of the same user in a single prompt and answers every question
+
+        Merged questions (see Batcher) don't show partial answers, the numbered reply is only split once it is complete.
+
+        Args:
+            questions (List[Question]): The questions, the first one was taken from the queue
+        """
+        first = questions[0]
+        user = first.user # The questions detach from their user once they are answered
+        self.start_deadline(questions)
         try:
-            self.lg.info(f"Asking ChatGPT with prompt {question.text[len(self.prefix) if question.direct_message else 0:]}")
-            if not question.user.conversation_id is None:
-                self.bot.conversation_id = question.user.conversation_id
+            prompts = [self.prompt(question) for question in questions]
+            prompt = self.handler.batcher.prompt(prompts) if len(questions) > 1 else prompts[0]
+            if len(questions) > 1:
+                self.lg.info(f"Asking ChatGPT {len(questions)} questions of {first.username} at once")
+            self.lg.info(f"Asking ChatGPT with prompt {prompt}")
+            if self.bot.conversation_id != user.conversation_id:
+                self.bot.conversation_id = user.conversation_id
             start = time.time()
-            question.answer(self.bot.ask(question.text[len(self.prefix) if question.direct_message else 0:]))
-            self.lg.info(f"Answered {question.username} in {time.time() - start} seconds")
-            question.user.conversation_id = self.bot.conversation_id
+            for question in questions:
+                question.mark("backend_start")
+            visible = False # Whether part of the answer has been shown already
+            if self.stream:
+                answer = ""
+                for chunk in self.ask_stream(prompt):
+                    if not self.extend_deadline():
+                        return
+                    answer += chunk
+                    if len(questions) == 1 and first.send_partial(answer) and not visible:
+                        visible = True
+                        self.handler.first_token_latency.record(time.monotonic() - first.created)
+            else:
+                answer = self.bot.ask(prompt)
+            if not self.clear_deadline(): # The watchdog took the questions over
+                return
+            user.conversation_id = self.bot.conversation_id # Before answering, the store may evict the user once nothing is pending
+            answers = self.handler.batcher.split(answer, len(questions)) if len(questions) > 1 else [answer]
+            for question in questions:
+                question.mark("backend_end")
+            if answers is None: # The reply isn't numbered, it answers the questions together
+                self.lg.warning(f"Couldn't split the answer to {len(questions)} questions of {first.username}")
+                first.answer(answer)
+                for question in questions[1:]:
+                    question.answer(answer if question.followers else "_Answered together with your previous message above._")
+            else:
+                for question, text in zip(questions, answers):
+                    question.answer(text)
+            if self.handler.startup is not None:
+                self.handler.startup.answered()
+            if not visible:
+                for question in questions:
+                    self.handler.first_token_latency.record(time.monotonic() - question.created)
+            if self.handler.admission is not None:
+                self.handler.admission.record(time.time() - start)
+            self.lg.info(f"Answered {first.username} in {time.time() - start} seconds")
+            if answers is not None:
+                for question in questions:
+                    self.handler.cache_answer(question)
         except Exception as e:
-            self.lg.error(e)
-            question.answer(f"An error occured while asking ChatGPT the question. Please try again later. \n{e.with_traceback}")
\ No newline at end of file
+            if not self.clear_deadline():
+                return
+            Metrics.errors.inc(kind="backend")
+            self.lg.error(f"Failed to ask ChatGPT for {first.username}: {e}\n{traceback.format_exc()}")
+            for question in questions:
+                if not question.is_answered:
+                    question.answer("An error occured while asking ChatGPT the question. Please try again later.")
+        finally:
+            if not self.abandoned:
+                for question in questions:
+                    self.handler.complete(question)
+                    self.handler.answer_followers(question)
\ No newline at end of file
@@ -1,21 +1,89 @@
-from typing import List
+from typing import Callable, Dict, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+import time
 from flask import Response
 from User import User
+from UserStore import UserStore
+from QueueJournal import QueueJournal
+from Startup import Startup
+from Batcher import Batcher
+from SharedQueue import SharedQueue
 from Queue import Queue
 from Question import Question
 from Logger import *
+from ExpiringSet import ExpiringSet
+from AnswerCache import AnswerCache
+from SingleFlight import SingleFlight
+from NearDuplicateIndex import NearDuplicateIndex
+from LatencyTracker import LatencyTracker
+from Outbox import Outbox
+from Scheduler import FifoScheduler, Scheduler
+from AdmissionControl import AdmissionControl
+import Metrics
 from slack_sdk import WebClient
 
 class Handler:
-    def __init__(self, client: WebClient) -> None:
+    def __init__(self, client: WebClient, ingest_workers: int = 4, dedup_ttl: float = 600, dedup_size: int = 100000, answer_cache: Optional[AnswerCache] = None, single_flight: Optional[SingleFlight] = None, near_duplicates: Optional[NearDuplicateIndex] = None, question_type: type = Question, outbox: Optional[Outbox] = None, scheduler: Callable[[], Scheduler] = FifoScheduler, admission: Optional[AdmissionControl] = None, store: Optional[UserStore] = None, journal: Optional[QueueJournal] = None, startup: Optional[Startup] = None, batcher: Optional[Batcher] = None, queue: Optional[Queue] = None, messages: Optional[ExpiringSet] = None) -> None:
         """Represents a handler for the questions, users and queue
+
+        Args:
+            client (WebClient): The Slack WebClient
+            ingest_workers (int, optional): The amount of threads processing events after they have been acknowledged. Defaults to 4.
+            dedup_ttl (float, optional): The amount of seconds an event id is remembered to drop Slack retries. Defaults to 600.
+            dedup_size (int, optional): The maximum amount of remembered event ids. Defaults to 100000.
+            answer_cache (AnswerCache, optional): The answer cache shared by all users. Defaults to None (no caching).
+            single_flight (SingleFlight, optional): Coalesces identical questions in flight. Defaults to None (every question is asked).
+            near_duplicates (NearDuplicateIndex, optional): Reuses answers of slightly different prompts. Defaults to None (only exact matches are reused).
+            question_type (type, optional): The Question class to create, e.g. WaitingQuestion for placeholder messages. Defaults to Question.
+            outbox (Outbox, optional): Delivers the messages to Slack in the background. Defaults to an Outbox for the client.
+            scheduler (Callable[[], Scheduler], optional): Creates the scheduler that orders the queue. Defaults to FifoScheduler.
+            admission (AdmissionControl, optional): Rate limits users and sheds load when the queue is full. Defaults to None (everything is queued).
+            store (UserStore, optional): Persists users, conversations and answers in SQLite. Defaults to None (users are kept in memory).
+            journal (QueueJournal, optional): Journals the queued questions so they are asked after a crash. Defaults to None (queued questions are lost).
+            startup (Startup, optional): Tracks the cold start, questions that arrive before a backend is ready are told how long it takes. Defaults to None.
+            batcher (Batcher, optional): Merges queued questions of a user into one ask. Defaults to None (every question is asked separately).
+            queue (Queue, optional): The queue of the questions, e.g. a SharedQueue used by several processes. Defaults to a Queue with the scheduler.
+            messages (ExpiringSet, optional): The ids of the received events, e.g. a SharedEventSet used by several processes. Defaults to an ExpiringSet with the dedup_ttl and dedup_size.
         """
-        self.messages: List[str] = []
-        self.users: List[User] = []
-        self.queue: Queue = Queue()
+        self.messages: ExpiringSet = messages if messages is not None else ExpiringSet(dedup_ttl, dedup_size) # The ids of the events that have already been received
+        self.users: Dict[str, User] = {} # Username -> user
+        self.users_lock = threading.Lock()
+        self.store = store
+        self.journal = journal
+        self.startup = startup
+        self.batcher = batcher
+        self.queue: Queue = queue if queue is not None else Queue(scheduler)
+        if isinstance(self.queue, SharedQueue):
+            self.queue.factory = self.restore # Questions pushed by other processes are rebuilt here
         self.client = client
+        self.outbox = outbox if outbox is not None else Outbox(client)
         self.lg = Logger("Handler", level=Level.INFO, formatter=Logger.minecraft_formatter, handlers=[FileHandler.latest_file_handler(Logger.minecraft_formatter), main_file_handler])
-        self.waiting_messages = []
+        self.answer_cache = answer_cache
+        self.single_flight = single_flight
+        self.near_duplicates = near_duplicates
+        self.question_type = question_type
+        self.admission = admission
+        self.first_token_latency = LatencyTracker("Time to first visible token", report_every=20, histogram=Metrics.first_token_seconds)
+        self.executor = ThreadPoolExecutor(max_workers=ingest_workers, thread_name_prefix="Ingest")
+
+    def submit(self, function: Callable[[dict], object], payload: dict) -> Future:
+        """Processes an event in the background so the Slack event can be acknowledged right away
+
+        Args:
+            function (Callable[[dict], object]): The function processing the payload
+            payload (dict): The payload of the event
+
+        Returns:
+            Future: The future of the background task
+        """
+        def run():
+            try:
+                return function(payload)
+            except Exception as e:
+                Metrics.errors.inc(kind="ingest")
+                self.lg.error(f"Failed to process event {payload.get('event_id')}: {e}")
+        return self.executor.submit(run)
 
     def get_user(self, username: str) -> User:
         """Returns either an existing user or a new user object
@@ -26,7 +94,13 @@ class Handler:
         Returns:
             User: The user object
         """
-        return [user for user in self.users if user.username == username][0] if username in [user.username for user in self.users] else User(username)
+        if self.store is not None:
+            return self.store.get(username)
+        user = self.users.get(username)
+        if user is None:
+            with self.users_lock:
+                user = self.users.setdefault(username, User(username))
+        return user
 
     def process_message(self, payload: dict, username) -> Response:
         """Handles the question from the user and replies to it
@@ -38,23 +112,137 @@ class Handler:
         Returns:
             Response: The response for the Slack API
         """	
+        resolved = time.monotonic()
         event = payload["event"]
         message = event["text"]
         user = self.get_user(username)
-        if user.in_pending(message) or user.in_answered(message):
-            self.client.chat_postMessage(channel=event["channel"], text="You already asked that question. Please wait for an answer. \n" if user.in_pending(message) else [question.answer_text for question in user.answered if question.text == message][0])
+        if user.in_pending(message) or (isinstance(self.queue, SharedQueue) and self.queue.is_pending(username, message)):
+            self.outbox.chat_postMessage(channel=event["channel"], text="You already asked that question. Please wait for an answer. \n")
+            return Response("OK", status=200)
+        answered = user.get_answered(message)
+        if answered is not None:
+            self.outbox.chat_postMessage(channel=event["channel"], text=answered.answer_text)
             return Response("OK", status=200)
         try:
-            question = Question(event["channel"], username, message, user, event["ts"], self.client, direct_message=event["channel"] == "im")
-            question.send_pre_answer()
+            cached = self.answer_cache.get(message) if self.answer_cache is not None and self.answer_cache.is_enabled(event["channel"]) else None
+            if cached is None and self.near_duplicates is not None and self.near_duplicates.is_enabled(event["channel"]):
+                similar = self.near_duplicates.find(message)
+                if similar is not None:
+                    cached = f"_Answer to the similar question \"{similar[0]}\":_\n{similar[1]}"
+            if cached is None and self.admission is not None:
+                accepted, reason = self.admission.admit(username, len(self.queue))
+                if not accepted:
+                    Metrics.errors.inc(kind="rejected")
+                    self.outbox.chat_postMessage(channel=event["channel"], text=reason)
+                    self.lg.info(f"Rejected {username}: {reason}")
+                    return Response("OK", status=200)
+            question = self.question_type(event["channel"], username, message, user, event["ts"], self.outbox, direct_message=event.get("channel_type") == "im")
+            question.mark("received", payload.get("received"))
+            question.mark("resolved", resolved)
+            if cached is not None:
+                question.answer(cached)
+                self.lg.info(f"Answered {username} from the answer cache")
+                return Response("OK", status=200)
+            if not isinstance(self.queue, SharedQueue): # Otherwise the process that pops the question shows that it is being processed
+                question.send_pre_answer()
+            if self.journal is not None:
+                try:
+                    self.journal.enqueue(question)
+                except OSError as e: # The journal writes the record again, until then a crash loses the question
+                    Metrics.errors.inc(kind="journal")
+                    self.lg.error(f"The question of {username} isn't durable yet: {e}")
+            if self.single_flight is not None and self.single_flight.join(question):
+                self.lg.info(f"{username} is waiting for an identical question in flight")
+                return Response("OK", status=200)
             self.queue.push(question)
-            self.lg.info(f"Added {username} to queue")
+            question.mark("enqueued")
+            position = len(self.queue)
+            if self.startup is not None and not self.startup.is_ready:
+                self.outbox.chat_postMessage(channel=event["channel"], text=self.startup.describe(self.admission.eta(position) if self.admission is not None else 0.0))
+            elif self.admission is not None and position > self.admission.workers:
+                self.outbox.chat_postMessage(channel=event["channel"], text=self.admission.describe(position))
+            self.lg.info(f"Added {username} to queue at position {position}")
             return Response("OK", status=200)
         except Exception as e:
+            Metrics.errors.inc(kind="handler")
             self.lg.error(e)
-            self.client.chat_postMessage(channel=event["channel"], text=f"An error occurred while processing your message. Please try again later. \n{e}")
+            self.outbox.chat_postMessage(channel=event["channel"], text=f"An error occurred while processing your message. Please try again later. \n{e}")
             return Response("An error occurred. Please try again later.", status=500)
 
+    def cache_answer(self, question: Question) -> None:
+        """Stores the answer of a question in the shared answer cache and near duplicate index, unless its channel opted out
+
+        Args:
+            question (Question): The answered question
+        """
+        if self.answer_cache is not None and self.answer_cache.is_enabled(question.channel):
+            self.answer_cache.put(question.text, question.answer_text)
+        if self.near_duplicates is not None and self.near_duplicates.is_enabled(question.channel):
+            self.near_duplicates.add(question.text, question.answer_text)
+
+    def answer_followers(self, question: Question) -> None:
+        """Sends the answer of a question to every identical question that was coalesced with it
+
+        Args:
+            question (Question): The answered question
+        """
+        if self.single_flight is None:
+            return
+        for follower in self.single_flight.release(question):
+            try:
+                follower.answer(question.answer_text)
+            except Exception as e:
+                Metrics.errors.inc(kind="follower")
+                self.lg.error(f"Failed to answer {follower.username}: {e}")
+            finally:
+                self.complete(follower)
+
+    def complete(self, question: Question) -> None:
+        """Journals that a question has been answered and removes it from the queue, so it isn't asked again after a restart
+        and its user can be served by any worker once nothing else of them is pending
+
+        Args:
+            question (Question): The answered question
+        """
+        if self.journal is not None:
+            self.journal.complete(question)
+        self.queue.complete(question)
+
+    def replay(self) -> int:
+        """Queues the questions the journal recorded as unfinished, in their original order. Call before starting the workers
+
+        Returns:
+            int: The amount of replayed questions
+        """
+        if self.journal is None:
+            return 0
+        records = self.journal.replay()
+        for record in records:
+            question = self.restore(record)
+            question.journal_id = record["id"]
+            if self.single_flight is not None and self.single_flight.join(question):
+                continue
+            self.queue.push(question)
+            question.mark("enqueued")
+        return len(records)
+
+    def restore(self, record: dict) -> Question:
+        """Builds a question from a journal or shared queue record and lets the user know that it is being processed
+
+        Args:
+            record (dict): The channel, username, text, ts and direct_message of the question, optionally its attempts
+
+        Returns:
+            Question: The question
+        """
+        user = self.get_user(record["username"])
+        if self.store is not None:
+            self.store.refresh(user) # Another process may have continued the conversation
+        question = self.question_type(record["channel"], record["username"], record["text"], user, record["ts"], self.outbox, direct_message=record["direct_message"])
+        question.attempts = record.get("attempts", 0)
+        question.send_pre_answer()
+        return question
+
     def is_unique_message(self, payload: dict) -> bool:
         """Checks whether the message event has already been registered
 
@@ -66,3 +254,14 @@ class Handler:
         """
         return not payload["event_id"] in self.messages
 
+    def register_message(self, payload: dict) -> bool:
+        """Registers the message event, checking and adding it atomically so concurrent retries are only processed once
+
+        Args:
+            payload (dict): The payload of the event
+
+        Returns:
+            bool: Whether the message event was new
+        """
+        return self.messages.add(payload["event_id"])
+
@@ -0,0 +1,64 @@
+from collections import deque
+from typing import Deque, Dict, Optional
+import threading
+from Logger import *
+from Metrics import Histogram
+
+class LatencyTracker:
+    def __init__(self, name: str, window: int = 10000, report_every: int = 100, histogram: Optional[Histogram] = None):
+        """Keeps a sliding window of latency samples and periodically logs their percentiles
+
+        Args:
+            name (str): The name of the measured latency, used in the report
+            window (int, optional): The amount of most recent samples to keep. Defaults to 10000.
+            report_every (int, optional): Log a report after this many samples, 0 to disable. Defaults to 100.
+            histogram (Histogram, optional): A histogram of the /metrics endpoint that receives every sample too. Defaults to None.
+        """
+        self.name = name
+        self.report_every = report_every
+        self.histogram = histogram
+        self.count = 0
+        self.__samples: Deque[float] = deque(maxlen=window)
+        self.__lock = threading.Lock()
+        self.lg = Logger("Latency", level=Level.INFO, formatter=Logger.minecraft_formatter, handlers=[FileHandler.latest_file_handler(Logger.minecraft_formatter), main_file_handler])
+
+    def record(self, seconds: float) -> None:
+        """Adds a sample to the window
+
+        Args:
+            seconds (float): The measured latency in seconds
+        """
+        with self.__lock:
+            self.__samples.append(seconds)
+            self.count += 1
+            report = self.report_every and self.count % self.report_every == 0
+        if self.histogram is not None:
+            self.histogram.observe(seconds)
+        if report:
+            self.lg.info(self.report())
+
+    def percentiles(self, *percentiles: float) -> Dict[float, float]:
+        """Calculates percentiles over the current window using the nearest-rank method
+
+        Args:
+            percentiles (float): The percentiles to calculate (0-100)
+
+        Returns:
+            Dict[float, float]: The latency in seconds for every requested percentile, empty if there are no samples
+        """
+        with self.__lock:
+            samples = sorted(self.__samples)
+        if not samples:
+            return {}
+        return {p: samples[min(len(samples) - 1, max(0, int(round(p / 100 * len(samples))) - 1))] for p in percentiles}
+
+    def report(self) -> str:
+        """Returns a human readable summary of the window
+
+        Returns:
+            str: The summary with p50, p90, p99 and max in milliseconds
+        """
+        values = self.percentiles(50, 90, 99, 100)
+        if not values:
+            return f"{self.name}: no samples"
+        return f"{self.name} over {min(self.count, self.__samples.maxlen)} samples: p50 {values[50] * 1000:.2f}ms, p90 {values[90] * 1000:.2f}ms, p99 {values[99] * 1000:.2f}ms, max {values[100] * 1000:.2f}ms"
@@ -0,0 +1,343 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import argparse
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from ProcessStats import rss
+
+SECRET = "load-test-signing-secret"
+
+class RecordingClient:
+    def __init__(self, latency: float = 0.0):
+        """An in-memory stand-in for the Slack WebClient that records every message instead of sending it
+
+        Args:
+            latency (float, optional): The amount of seconds every call takes, like a round trip to Slack. Defaults to 0.0.
+        """
+        self.latency = latency
+        self.messages: List[Tuple[float, str, str, str]] = [] # (time, method, channel, text)
+        self.users_info_calls = 0
+        self.__counter = itertools.count(1)
+        self.__lock = threading.Lock()
+
+    def __record(self, method: str, channel: str, text: str) -> dict:
+        if self.latency:
+            time.sleep(self.latency)
+        with self.__lock:
+            self.messages.append((time.monotonic(), method, channel, text))
+            return {"ok": True, "channel": channel, "ts": f"{1700000000 + next(self.__counter)}.000000"}
+
+    def chat_postMessage(self, channel: str, text: str, **_) -> dict:
+        return self.__record("post", channel, text)
+
+    def chat_update(self, channel: str, ts: str, text: str, **_) -> dict:
+        return self.__record("update", channel, text)
+
+    def users_info(self, user: str, **_) -> dict:
+        if self.latency:
+            time.sleep(self.latency)
+        with self.__lock:
+            self.users_info_calls += 1
+        return {"ok": True, "user": {"id": user, "name": user.lower(), "profile": {"display_name": f"user-{user}"}}}
+
+    def users_list(self, cursor: Optional[str] = None, limit: int = 200, **_) -> dict:
+        return {"ok": True, "members": [], "response_metadata": {"next_cursor": ""}}
+
+
+class StubBot:
+    def __init__(self, latency: float = 1.0, jitter: float = 0.0, failure_rate: float = 0.0, seed: int = 0, hang_rate: float = 0.0, startup: float = 0.0):
+        """Answers prompts like the ChatGPT wrapper, after a configurable delay and with a configurable failure rate
+
+        Args:
+            latency (float, optional): The mean amount of seconds an answer takes. Defaults to 1.0.
+            jitter (float, optional): The standard deviation of the answer time. Defaults to 0.0.
+            failure_rate (float, optional): The probability (0-1) that asking raises an exception. Defaults to 0.0.
+            seed (int, optional): The seed of the random generator. Defaults to 0.
+            hang_rate (float, optional): The probability (0-1) that asking blocks until the bot is closed. Defaults to 0.0.
+            startup (float, optional): The amount of seconds creating the bot takes, like starting a browser. Defaults to 0.0.
+        """
+        time.sleep(startup)
+        self.latency = latency
+        self.hang_rate = hang_rate
+        self.closed = threading.Event()
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.conversation_id = None
+
+    def __answer(self, prompt: str) -> Tuple[float, str]:
+        if self.random.random() < self.failure_rate:
+            time.sleep(self.latency / 2)
+            raise RuntimeError("Stub bot failure")
+        if self.random.random() < self.hang_rate:
+            self.closed.wait() # Like a browser that stopped responding
+            raise RuntimeError("Stub bot closed")
+        if self.conversation_id is None:
+            self.conversation_id = f"conversation-{self.random.getrandbits(32):08x}"
+        numbered = re.findall(r"^\[\[(\d+)\]\] ", prompt, re.MULTILINE) # Merged questions, see Batcher
+        if numbered:
+            return max(0.0, self.random.gauss(self.latency, self.jitter)), "\n\n".join(f"[[{number}]] Stub answer " + "lorem ipsum " * 20 for number in numbered)
+        return max(0.0, self.random.gauss(self.latency, self.jitter)), f"Stub answer to \"{prompt}\" " + "lorem ipsum " * 20
+
+    def ask(self, prompt: str) -> str:
+        duration, answer = self.__answer(prompt)
+        time.sleep(duration)
+        return answer
+
+    def ask_stream(self, prompt: str):
+        duration, answer = self.__answer(prompt)
+        words = answer.split(" ")
+        for word in words:
+            time.sleep(duration / len(words))
+            yield word + " "
+
+    def close(self) -> None:
+        self.closed.set()
+
+
+def generate_events(traffic: dict, seed: int = 0) -> List[Tuple[float, dict, int]]:
+    """Generates the deliveries of a scenario from its traffic description
+
+    Args:
+        traffic (dict): The traffic of the scenario, see the README
+        seed (int, optional): The seed of the random generator. Defaults to 0.
+
+    Returns:
+        List[Tuple[float, dict, int]]: (seconds after the start, payload, retry number) sorted by time
+    """
+    generator = random.Random(seed)
+    prefix = traffic.get("prefix", "!")
+    messages = traffic.get("messages", 100)
+    users = traffic.get("users", 10)
+    channels = traffic.get("channels", 1)
+    rate = traffic.get("rate", 0)
+    prompts = traffic.get("prompts", 0)
+    deliveries = []
+    offset = 0.0
+    for index in range(messages):
+        if rate:
+            offset += generator.expovariate(rate)
+        user = f"U{generator.randrange(users):05d}"
+        direct = generator.random() < traffic.get("direct", 0.0)
+        if prompts:
+            text = f"{prefix}Explain topic {generator.randrange(prompts)} in one paragraph"
+        else:
+            text = f"{prefix}Question {index} from {user}: " + "please explain this " * generator.randint(1, 20)
+        payload = {
+            "token": "load-test",
+            "team_id": "T00000000",
+            "api_app_id": "A00000000",
+            "type": "event_callback",
+            "event_id": f"Ev{index:010d}",
+            "event_time": int(time.time()),
+            "event": {
+                "type": "message",
+                "channel": f"D{user}" if direct else f"C{generator.randrange(channels):05d}",
+                "channel_type": "im" if direct else "channel",
+                "user": user,
+                "text": text,
+                "ts": f"{1600000000 + index}.000100"
+            }
+        }
+        deliveries.append((offset, payload, 0))
+        if generator.random() < traffic.get("retries", 0.0): # Slack redelivers the event when the ack is too slow
+            for attempt in range(1, generator.randint(1, traffic.get("max_retries", 3)) + 1):
+                deliveries.append((offset + attempt * traffic.get("retry_delay", 1.0), payload, attempt))
+    deliveries.sort(key=lambda delivery: delivery[0])
+    return deliveries
+
+
+def sign(body: bytes, secret: str = SECRET) -> Dict[str, str]:
+    """Returns the headers Slack sends with an event, signed with the signing secret
+
+    Args:
+        body (bytes): The request body
+        secret (str, optional): The signing secret. Defaults to SECRET.
+
+    Returns:
+        Dict[str, str]: The headers
+    """
+    timestamp = str(int(time.time()))
+    signature = "v0=" + hmac.new(secret.encode(), b"v0:" + timestamp.encode() + b":" + body, hashlib.sha256).hexdigest()
+    return {"X-Slack-Request-Timestamp": timestamp, "X-Slack-Signature": signature, "Content-Type": "application/json"}
+
+
+def run(scenario: dict) -> dict:
+    """Runs a scenario against main.py's message handler in this process
+
+    main.py reads its arguments and creates its clients on import, so a process can only run one scenario.
+
+    Args:
+        scenario (dict): The scenario, see the README
+
+    Returns:
+        dict: The results
+    """
+    slack = scenario.get("slack", {})
+    recorder = RecordingClient(slack.get("latency", 0.0))
+    import slack_sdk
+    slack_sdk.WebClient = lambda *_, **__: recorder # main.py creates its client with the token
+    directory = tempfile.mkdtemp(prefix="slackgpt-load-test-") # For the files a scenario's arguments refer to as {tmpdir}
+    sys.argv = ["main.py", "--token", "xoxb-load-test", "--secret", SECRET] + [arg.replace("{tmpdir}", directory) for arg in scenario.get("args", [])]
+    import main
+    import Metrics
+    from LatencyTracker import LatencyTracker
+    from Outbox import Outbox
+
+    handler = main.handler
+    if "rate" in slack or "burst" in slack:
+        handler.outbox.close()
+        handler.outbox = Outbox(recorder, slack.get("rate", 1.0), slack.get("burst", 3.0))
+    ack_latency = LatencyTracker("Ack latency", window=1000000, report_every=0)
+    e2e_latency = LatencyTracker("End to end latency", window=1000000, report_every=0)
+    observe_stages = Metrics.observe_stages
+    def traced(times: Dict[str, float]) -> None:
+        observe_stages(times)
+        if "received" in times:
+            e2e_latency.record(times["posted"] - times["received"])
+    Metrics.observe_stages = traced
+    futures: List[Future] = []
+    submit = handler.submit
+    def tracked(function, payload):
+        future = submit(function, payload)
+        futures.append(future)
+        return future
+    handler.submit = tracked
+
+    bot = scenario.get("bot", {})
+    seeds = itertools.count(scenario.get("seed", 0))
+    create_bot = lambda: StubBot(bot.get("latency", 1.0), bot.get("jitter", 0.0), bot.get("failure_rate", 0.0), next(seeds), bot.get("hang_rate", 0.0), bot.get("startup", 0.0))
+    pool = main.create_pool(create_bot)
+    pool.start()
+
+    deliveries = generate_events(scenario.get("traffic", {}), scenario.get("seed", 0))
+    clients = threading.local()
+    def deliver(payload: dict, attempt: int) -> int:
+        if not hasattr(clients, "client"):
+            clients.client = main.app.test_client()
+        body = json.dumps(payload).encode()
+        headers = sign(body)
+        if attempt:
+            headers.update({"X-Slack-Retry-Num": str(attempt), "X-Slack-Retry-Reason": "http_timeout"})
+        sent = time.perf_counter()
+        status = clients.client.post("/slack/events", data=body, headers=headers).status_code
+        ack_latency.record(time.perf_counter() - sent)
+        return status
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime
+    rss_before = rss()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=scenario.get("traffic", {}).get("concurrency", 8), thread_name_prefix="LoadTest") as senders:
+        statuses = []
+        for offset, payload, attempt in deliveries:
+            delay = start + offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            statuses.append(senders.submit(deliver, payload, attempt))
+        statuses = [status.result() for status in statuses]
+    sent = time.monotonic() - start
+
+    deadline = time.monotonic() + scenario.get("timeout", 600)
+    for future in list(futures):
+        future.result(timeout=max(0.0, deadline - time.monotonic()))
+    idle = 0
+    while idle < 3 and time.monotonic() < deadline: # Questions may move between the queue, a worker and the outbox
+        busy = len(handler.queue) or any(worker.busy for worker in pool.workers) or len(handler.outbox) or (handler.single_flight is not None and len(handler.single_flight))
+        idle = 0 if busy else idle + 1
+        time.sleep(0.05)
+    duration = time.monotonic() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    results = {
+        "scenario": scenario.get("name", "unnamed"),
+        "workers": main.args.workers,
+        "deliveries": len(deliveries),
+        "retries": sum(1 for delivery in deliveries if delivery[2]),
+        "failed_acks": sum(1 for status in statuses if status != 200),
+        "timed_out": idle < 3,
+        "send_seconds": sent,
+        "duration_seconds": duration,
+        "ack_throughput": len(deliveries) / sent if sent else 0.0,
+        "answer_throughput": e2e_latency.count / duration if duration else 0.0,
+        "ack_latency": {f"p{p}": value for p, value in ack_latency.percentiles(50, 90, 99, 100).items()},
+        "e2e_latency": {f"p{p}": value for p, value in e2e_latency.percentiles(50, 90, 99, 100).items()},
+        "answers": e2e_latency.count,
+        "rejected": sum(1 for message in recorder.messages if message[3].startswith(("You are asking questions faster", "I am busy"))),
+        "starting_up": sum(1 for message in recorder.messages if message[3].startswith("I am still starting up")),
+        "ready_seconds": main.startup.ready_after,
+        "first_answer_seconds": main.startup.answered_after,
+        "batched": handler.batcher.merged if handler.batcher is not None else 0,
+        "already_asked": sum(1 for message in recorder.messages if message[3].startswith("You already asked")),
+        "errors": {key[0]: value for key, value in Metrics.errors.values.items()},
+        "recycles": {key[0]: value for key, value in Metrics.recycles.values.items()},
+        "slack_posts": sum(1 for message in recorder.messages if message[1] == "post"),
+        "slack_updates": sum(1 for message in recorder.messages if message[1] == "update"),
+        "users_info_calls": recorder.users_info_calls,
+        "cpu_seconds": usage.ru_utime + usage.ru_stime - cpu,
+        "rss_growth_bytes": rss() - rss_before,
+        "max_rss_bytes": usage.ru_maxrss * 1024 # Kilobytes on Linux
+    }
+    pool.stop(timeout=5)
+    handler.outbox.close(timeout=5)
+    handler.executor.shutdown(wait=False)
+    if handler.store is not None:
+        handler.store.close()
+    if isinstance(handler.queue, main.SharedQueue):
+        handler.queue.close()
+        handler.messages.close()
+    main.chat_log.close()
+    shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def report(results: dict) -> str:
+    """Returns a human readable summary of the results of a scenario
+
+    Args:
+        results (dict): The results returned by run
+
+    Returns:
+        str: The summary
+    """
+    seconds = lambda value: f"{value:.2f}s" if value is not None else "never"
+    latency = lambda values: ", ".join(f"{p} {seconds * 1000:.1f}ms" for p, seconds in values.items()) or "no samples"
+    return "\n".join([
+        f"Scenario {results['scenario']}: {results['deliveries']} deliveries ({results['retries']} retries) with {results['workers']} workers{' - TIMED OUT' if results['timed_out'] else ''}",
+        f"  Throughput: {results['ack_throughput']:.1f} events/s acknowledged, {results['answer_throughput']:.2f} answers/s over {results['duration_seconds']:.1f}s",
+        f"  Ack latency: {latency(results['ack_latency'])} ({results['failed_acks']} failed)",
+        f"  End to end over {results['answers']} answers: {latency(results['e2e_latency'])}",
+        f"  Outcomes: {results['rejected']} rejected, {results['already_asked']} already asked, {results['batched']} batched, errors {results['errors'] or 'none'}, recycles {results['recycles'] or 'none'}",
+        f"  Cold start: first backend ready after {seconds(results['ready_seconds'])}, first answer after {seconds(results['first_answer_seconds'])}, {results['starting_up']} questions told about the startup",
+        f"  Slack calls: {results['slack_posts']} posts, {results['slack_updates']} updates, {results['users_info_calls']} users.info",
+        f"  CPU: {results['cpu_seconds']:.2f}s ({results['cpu_seconds'] / results['duration_seconds'] * 100:.0f}% of one core), RSS +{results['rss_growth_bytes'] / 2 ** 20:.1f}MiB, peak {results['max_rss_bytes'] / 2 ** 20:.1f}MiB"
+    ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays synthetic Slack traffic against main.py with a stub chatbot and an in-memory Slack client")
+    parser.add_argument("scenarios", nargs="+", help="The scenario files to run, see scenarios/")
+    parser.add_argument("--output", help="Append the results of every scenario as a JSON line to this file", required=False)
+    args = parser.parse_args()
+    if len(args.scenarios) > 1: # Every scenario needs a fresh process
+        for path in args.scenarios:
+            subprocess.run([sys.executable, __file__, path] + (["--output", args.output] if args.output else []), check=False)
+        sys.exit(0)
+    with open(args.scenarios[0], "r") as f:
+        scenario = json.load(f)
+    results = run(scenario)
+    print(report(results))
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(results) + "\n")
@@ -0,0 +1,198 @@
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+import threading
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    """Formats label names and values for the Prometheus text format
+
+    Args:
+        names (Sequence[str]): The label names
+        values (Sequence[str]): The label values
+        extra (str, optional): An already formatted label to append, e.g. le="1". Defaults to "".
+
+    Returns:
+        str: The labels in braces or an empty string if there are none
+    """
+    labels = [f'{name}="{str(value)}"'.replace("\n", " ") for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric:
+    def __init__(self, name: str, help: str, kind: str, labels: Sequence[str] = ()):
+        """The base class of every metric in the registry
+
+        Args:
+            name (str): The name of the metric
+            help (str): The description of the metric
+            kind (str): The Prometheus type of the metric
+            labels (Sequence[str], optional): The label names. Defaults to ().
+        """
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def render(self) -> List[str]:
+        """Returns the lines of the metric in the Prometheus text format
+
+        Returns:
+            List[str]: The lines, starting with HELP and TYPE
+        """
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        """A value that only goes up
+
+        Args:
+            name (str): The name of the metric
+            help (str): The description of the metric
+            labels (Sequence[str], optional): The label names. Defaults to ().
+        """
+        super().__init__(name, help, "counter", labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """Increases the counter
+
+        Args:
+            amount (float, optional): The amount to add. Defaults to 1.
+        """
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return super().render() + [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in values]
+
+
+class Gauge(Metric):
+    def __init__(self, name: str, help: str, function: Callable[[], float], kind: str = "gauge"):
+        """A value that is read when the metrics are scraped
+
+        Args:
+            name (str): The name of the metric
+            help (str): The description of the metric
+            function (Callable[[], float]): Returns the current value
+            kind (str, optional): The Prometheus type, "counter" for values that are counted elsewhere. Defaults to "gauge".
+        """
+        super().__init__(name, help, kind)
+        self.function = function
+
+    def render(self) -> List[str]:
+        return super().render() + [f"{self.name} {self.function()}"]
+
+
+class Histogram(Metric):
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Iterable[float] = default_buckets):
+        """Counts observations in cumulative buckets
+
+        Args:
+            name (str): The name of the metric
+            help (str): The description of the metric
+            labels (Sequence[str], optional): The label names. Defaults to ().
+            buckets (Iterable[float], optional): The upper bounds of the buckets. Defaults to default_buckets.
+        """
+        super().__init__(name, help, "histogram", labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[Tuple[str, ...], List[float]] = {} # Labels -> bucket counts, then sum and count
+
+    def observe(self, value: float, **labels) -> None:
+        """Adds an observation
+
+        Args:
+            value (float): The observed value
+        """
+        key = self.key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 3)
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in self.values.items()]
+        lines = super().render()
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {counts[-2]}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {counts[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        """Holds every metric and renders them for the /metrics endpoint
+        """
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """Adds a metric, replacing a metric with the same name
+
+        Args:
+            metric (Metric): The metric to add
+
+        Returns:
+            Metric: The added metric
+        """
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Renders every metric in the Prometheus text format
+
+        Returns:
+            str: The metrics
+        """
+        return "\n".join(line for metric in list(self.metrics.values()) for line in metric.render()) + "\n"
+
+
+registry = Registry()
+stage_seconds = registry.register(Histogram("slackgpt_stage_seconds", "Time a question spent until reaching a stage, since the previous stage", ["stage"]))
+question_seconds = registry.register(Histogram("slackgpt_question_seconds", "Time from receiving a question until its answer was posted"))
+worker_busy_seconds = registry.register(Counter("slackgpt_worker_busy_seconds_total", "Time the workers spent answering questions", ["worker"]))
+errors = registry.register(Counter("slackgpt_errors_total", "Errors by kind", ["kind"]))
+backend_start_seconds = registry.register(Histogram("slackgpt_backend_start_seconds", "Time a backend took to start and warm up"))
+recycles = registry.register(Counter("slackgpt_backend_recycles_total", "Backends that were torn down and rebuilt, by reason", ["reason"]))
+ack_seconds = registry.register(Histogram("slackgpt_ack_seconds", "Time until a Slack event was acknowledged", buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 3)))
+first_token_seconds = registry.register(Histogram("slackgpt_first_token_seconds", "Time from receiving a question until the first part of its answer was visible"))
+
+stages = ("received", "resolved", "enqueued", "dequeued", "backend_start", "backend_end", "posted") # The stages of a question in order
+
+def observe_stages(times: Dict[str, float]) -> None:
+    """Adds the time between every two consecutive stages a question went through to the histograms
+
+    Args:
+        times (Dict[str, float]): The monotonic time per reached stage
+    """
+    previous = None
+    for stage in stages:
+        at = times.get(stage)
+        if at is None:
+            continue # Cached and coalesced questions skip the queue and the backend
+        if previous is not None:
+            stage_seconds.observe(at - previous, stage=stage)
+        else:
+            first = at
+        previous = at
+    if previous is not None and "posted" in times:
+        question_seconds.observe(previous - first)
@@ -0,0 +1,212 @@
+from array import array
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from operator import eq
+import random
+import re
+import threading
+from AnswerCache import normalize_prompt
+
+MASK = (1 << 64) - 1
+DENSIFY_OFFSET = 0x9E3779B97F4A7C15 # Added per bin an empty bin borrows its value from
+TOKEN = re.compile(r"\w+|[^\w\s]") # Words and single symbols, e.g. operators
+NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+PUNCTUATION = set(".,!?;:'\"") # Sentence punctuation doesn't change the meaning of a prompt
+
+class NearDuplicateIndex:
+    def __init__(self, prefix: str = "!", threshold: float = 0.8, max_size: int = 10000, bands: int = 16, rows: int = 4, shingle_size: int = 4, seed: int = 1, excluded_channels: Iterable[str] = ()):
+        """Represents an in-process index of answered prompts that finds prompts which differ only slightly from a new one
+
+        Prompts are split into character shingles across word boundaries plus pairs of adjacent words and symbols, so
+        sentence punctuation and whitespace don't change them, but word order and operators do. Prompts whose numbers
+        differ never match.
+        Every prompt gets a MinHash signature of bands * rows values which is split into bands for locality sensitive hashing:
+        prompts that share a band land in the same bucket, and prompts that share enough bands are compared by their signature.
+
+        Args:
+            prefix (str, optional): The prefix that triggers the bot, stripped from the prompts. Defaults to "!".
+            threshold (float, optional): The minimum estimated Jaccard similarity to reuse an answer (0-1). Defaults to 0.8.
+            max_size (int, optional): The maximum amount of indexed prompts, the oldest ones are evicted first. Defaults to 10000.
+            bands (int, optional): The amount of LSH bands. Defaults to 16.
+            rows (int, optional): The amount of MinHash values per band. Defaults to 4.
+            shingle_size (int, optional): The amount of characters per shingle. Defaults to 4.
+            seed (int, optional): The seed mixed into the shingle hashes. Defaults to 1.
+            excluded_channels (Iterable[str], optional): The channels that never reuse similar answers. Defaults to ().
+
+        Raises:
+            ValueError: If the threshold is not between 0 and 1 or the max_size is not positive
+        """
+        if not 0 < threshold <= 1 or max_size <= 0:
+            raise ValueError("threshold must be between 0 and 1 and max_size must be positive")
+        self.prefix = prefix
+        self.threshold = threshold
+        self.max_size = max_size
+        self.bands = bands
+        self.rows = rows
+        self.shingle_size = shingle_size
+        self.excluded_channels = set(excluded_channels)
+        self.hits = 0
+        self.misses = 0
+        self.seed = seed
+        self.min_bands = 2 if bands >= 8 else 1 # The amount of shared bands before a candidate is compared
+        self.__entries: "OrderedDict[str, Tuple[array, Tuple[str, ...], str]]" = OrderedDict() # Normalized prompt -> (signature, numbers, answer)
+        self.__buckets: List[Dict[int, Set[str]]] = [{} for _ in range(bands)] # Band -> band hash -> normalized prompts
+        self.__lock = threading.Lock()
+
+    def is_enabled(self, channel: str) -> bool:
+        """Checks whether similar answers may be reused in a channel
+
+        Args:
+            channel (str): The channel id
+
+        Returns:
+            bool: Whether similar answers may be reused
+        """
+        return channel not in self.excluded_channels
+
+    def shingles(self, prompt: str) -> Set[str]:
+        """Splits a normalized prompt into the character shingles of its tokens joined by spaces and the pairs of adjacent tokens
+
+        Args:
+            prompt (str): The normalized prompt
+
+        Returns:
+            Set[str]: The shingles of the prompt
+        """
+        tokens = [token for token in TOKEN.findall(prompt) if token not in PUNCTUATION]
+        if not tokens:
+            return set()
+        text = f" {' '.join(tokens)} "
+        shingles = {text[i:i + self.shingle_size] for i in range(max(1, len(text) - self.shingle_size + 1))}
+        shingles.update(f"\0{first} {second}" for first, second in zip(tokens, tokens[1:])) # Marked so they can't collide with a character shingle
+        return shingles
+
+    def signature(self, prompt: str) -> Optional[array]:
+        """Calculates the MinHash signature of a normalized prompt using one permutation hashing
+
+        Every shingle is hashed once and only counts towards the bin its hash falls into, which keeps the cost
+        linear in the amount of shingles. Empty bins borrow the value of the next filled bin (densification).
+
+        Args:
+            prompt (str): The normalized prompt
+
+        Returns:
+            Optional[array]: The signature or None if the prompt has no words
+        """
+        size = self.bands * self.rows
+        signature = [MASK] * size
+        for shingle in self.shingles(prompt):
+            h = hash((self.seed, shingle)) & MASK
+            slot, value = h % size, h // size
+            if value < signature[slot]:
+                signature[slot] = value
+        dense = list(signature)
+        next_filled = None
+        for i in range(2 * size - 1, -1, -1): # Walk backwards twice so every empty bin sees the next filled one
+            if signature[i % size] != MASK:
+                next_filled = i
+            elif i < size and next_filled is not None:
+                dense[i] = (signature[next_filled % size] + (next_filled - i) * DENSIFY_OFFSET) & MASK
+        if next_filled is None:
+            return None
+        return array("Q", dense)
+
+    def __band_keys(self, signature: array) -> List[int]:
+        return [hash(tuple(signature[band * self.rows:(band + 1) * self.rows])) for band in range(self.bands)]
+
+    def add(self, prompt: str, answer: str) -> None:
+        """Indexes the answer of a prompt, evicting the oldest prompts when the index is full
+
+        Args:
+            prompt (str): The prompt as sent by the user
+            answer (str): The answer to the prompt
+        """
+        key = normalize_prompt(prompt, self.prefix)
+        signature = self.signature(key)
+        if signature is None or answer is None:
+            return
+        with self.__lock:
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = (signature, tuple(NUMBER.findall(key)), answer)
+            for buckets, band_key in zip(self.__buckets, self.__band_keys(signature)):
+                buckets.setdefault(band_key, set()).add(key)
+            while len(self.__entries) > self.max_size:
+                self.__remove(next(iter(self.__entries)))
+
+    def __remove(self, key: str) -> None:
+        signature, _, _ = self.__entries.pop(key)
+        for buckets, band_key in zip(self.__buckets, self.__band_keys(signature)):
+            bucket = buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del buckets[band_key]
+
+    def find(self, prompt: str) -> Optional[Tuple[str, str, float]]:
+        """Looks up the most similar indexed prompt and counts the hit or miss
+
+        Args:
+            prompt (str): The prompt as sent by the user
+
+        Returns:
+            Optional[Tuple[str, str, float]]: The similar prompt, its answer and the estimated similarity or None if no prompt reaches the threshold
+        """
+        key = normalize_prompt(prompt, self.prefix)
+        signature = self.signature(key)
+        numbers = tuple(NUMBER.findall(key)) # "2+2" and "2+3" are almost the same prompt with different answers
+        best = None
+        with self.__lock:
+            if signature is not None:
+                candidates = Counter()
+                for buckets, band_key in zip(self.__buckets, self.__band_keys(signature)):
+                    candidates.update(buckets.get(band_key, ()))
+                for candidate, shared in candidates.items():
+                    if shared < self.min_bands:
+                        continue
+                    other, other_numbers, answer = self.__entries[candidate]
+                    if other_numbers != numbers:
+                        continue
+                    similarity = sum(map(eq, signature, other)) / len(signature)
+                    if similarity >= self.threshold and (best is None or similarity > best[2]):
+                        best = (candidate, answer, similarity)
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return best
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+
+# Benchmark
+if __name__ == "__main__":
+    import time
+
+    def random_prompt(generator: random.Random, words: List[str]) -> str:
+        return " ".join(generator.choice(words) for _ in range(generator.randint(5, 15))) + "?"
+
+    def benchmark(size: int, lookups: int = 1000) -> None:
+        generator = random.Random(42)
+        words = ["".join(generator.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(generator.randint(2, 9))) for _ in range(5000)]
+        prompts = [random_prompt(generator, words) for _ in range(size)]
+        index = NearDuplicateIndex(max_size=size)
+        start = time.perf_counter()
+        for prompt in prompts:
+            index.add(prompt, "answer")
+        print(f"Indexed {size} prompts in {time.perf_counter() - start:.2f} seconds")
+
+        for name, queries in (
+            ("near duplicates", [generator.choice(prompts).rstrip("?").replace(" ", "  ") + "!!" for _ in range(lookups)]),
+            ("unseen prompts", [random_prompt(generator, words) for _ in range(lookups)])):
+            durations = []
+            for query in queries:
+                start = time.perf_counter()
+                index.find(query)
+                durations.append(time.perf_counter() - start)
+            durations.sort()
+            print(f"{name}: p50 {durations[len(durations) // 2] * 1000:.3f}ms, p99 {durations[int(len(durations) * 0.99)] * 1000:.3f}ms")
+        print(f"{index.hits} hits, {index.misses} misses")
+
+    benchmark(100000)
@@ -0,0 +1,198 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Dict, Optional, Tuple, Union
+import threading
+import time
+from slack_sdk import WebClient
+from Logger import *
+
+class Delivery:
+    def __init__(self, method: str, channel: str, text: str, message: Union[str, Future, None] = None):
+        """Represents a message waiting to be posted or updated by the outbox
+
+        Args:
+            method (str): Either "post" or "update"
+            channel (str): The channel id
+            text (str): The text of the message
+            message (Union[str, Future, None], optional): The ts of the message to update or the future of its post. Defaults to None.
+        """
+        self.method = method
+        self.channel = channel
+        self.text = text
+        self.message = message
+        self.attempts = 0
+        self.future: Future = Future() # Resolves to the ts of the posted or updated message
+
+
+class ChannelState:
+    def __init__(self, burst: float):
+        """Represents the token bucket and pending deliveries of a channel
+
+        Args:
+            burst (float): The amount of tokens the bucket starts with
+        """
+        self.deliveries: Deque[Delivery] = deque()
+        self.tokens = burst
+        self.refilled = time.monotonic()
+        self.blocked_until = 0.0 # Set by Retry-After and backoff
+        self.busy = False # Whether a delivery of the channel is being sent
+
+
+class Outbox:
+    def __init__(self, client: WebClient, rate: float = 1.0, burst: float = 3.0, senders: int = 4, max_retries: int = 5, max_backoff: float = 30.0):
+        """Delivers messages to Slack from background threads, so no worker waits for Slack or for a rate limit
+
+        Every channel has a token bucket and its deliveries are sent one after another in order. Rate limited
+        deliveries wait for Retry-After, failed ones are retried with exponential backoff, and updates of a message
+        that hasn't been sent yet are merged into one. chat_postMessage and chat_update mirror the WebClient methods,
+        so the outbox can be handed to the questions in place of the client.
+
+        Args:
+            client (WebClient): The Slack WebClient
+            rate (float, optional): The amount of messages per second and channel. Defaults to 1.0.
+            burst (float, optional): The amount of messages a channel may send at once. Defaults to 3.0.
+            senders (int, optional): The amount of threads calling Slack. Defaults to 4.
+            max_retries (int, optional): The amount of retries before a delivery fails. Defaults to 5.
+            max_backoff (float, optional): The maximum amount of seconds between two retries. Defaults to 30.0.
+        """
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.merged = 0 # The amount of updates that were merged into a pending update
+        self.rate_limited = 0 # The amount of 429 responses
+        self.__channels: Dict[str, ChannelState] = {}
+        self.__pending_updates: Dict[Tuple[str, object], Delivery] = {} # (channel, message) -> update that hasn't been sent yet
+        self.__condition = threading.Condition()
+        self.__closed = False
+        self.__executor = ThreadPoolExecutor(max_workers=senders, thread_name_prefix="Outbox")
+        self.__dispatcher = threading.Thread(target=self.__run, name="OutboxDispatcher", daemon=True)
+        self.__dispatcher.start()
+        self.lg = Logger("Outbox", level=Level.INFO, formatter=Logger.minecraft_formatter, handlers=[FileHandler.latest_file_handler(Logger.minecraft_formatter), main_file_handler])
+
+    def chat_postMessage(self, channel: str, text: str, **_) -> Future:
+        """Queues a new message
+
+        Args:
+            channel (str): The channel id
+            text (str): The text of the message
+
+        Returns:
+            Future: Resolves to the ts of the posted message
+        """
+        return self.__enqueue(Delivery("post", channel, text))
+
+    def chat_update(self, channel: str, ts: Union[str, Future], text: str, **_) -> Future:
+        """Queues an update of a message, merging it with an update of the same message that hasn't been sent yet
+
+        Args:
+            channel (str): The channel id
+            ts (Union[str, Future]): The ts of the message or the future returned when it was posted
+            text (str): The new text of the message
+
+        Returns:
+            Future: Resolves to the ts of the updated message
+        """
+        key = self.__key(channel, ts)
+        with self.__condition:
+            pending = self.__pending_updates.get(key)
+            if pending is not None:
+                pending.text = text
+                self.merged += 1
+                return pending.future
+            delivery = Delivery("update", channel, text, ts)
+            self.__pending_updates[key] = delivery
+        return self.__enqueue(delivery)
+
+    @staticmethod
+    def __key(channel: str, ts: Union[str, Future]) -> Tuple[str, object]:
+        return (channel, ts if isinstance(ts, str) else id(ts))
+
+    def __enqueue(self, delivery: Delivery) -> Future:
+        with self.__condition:
+            if self.__closed:
+                raise RuntimeError("Outbox has been closed")
+            state = self.__channels.get(delivery.channel)
+            if state is None:
+                state = self.__channels[delivery.channel] = ChannelState(self.burst)
+            state.deliveries.append(delivery)
+            self.__condition.notify()
+        return delivery.future
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                if self.__closed and not any(state.deliveries for state in self.__channels.values()):
+                    return
+                now = time.monotonic()
+                wake = now + 1.0
+                for channel, state in list(self.__channels.items()):
+                    state.tokens = min(self.burst, state.tokens + (now - state.refilled) * self.rate)
+                    state.refilled = now
+                    if not state.deliveries:
+                        if not state.busy and state.tokens >= self.burst:
+                            del self.__channels[channel] # A full bucket holds no state worth keeping
+                        continue
+                    if state.busy:
+                        continue
+                    ready = max(state.blocked_until, now + (1 - state.tokens) / self.rate if state.tokens < 1 else now)
+                    if ready > now:
+                        wake = min(wake, ready)
+                        continue
+                    state.tokens -= 1
+                    state.busy = True
+                    delivery = state.deliveries[0]
+                    if delivery.method == "update":
+                        self.__pending_updates.pop(self.__key(delivery.channel, delivery.message), None)
+                    self.__executor.submit(self.__send, state, delivery)
+                self.__condition.wait(max(0.0, wake - time.monotonic()))
+
+    def __send(self, state: ChannelState, delivery: Delivery) -> None:
+        retry_after = None
+        try:
+            message = delivery.message
+            if isinstance(message, Future):
+                # The post was queued earlier in the same channel, so it has been sent or has failed already
+                message = None if message.exception() is not None else message.result()
+            if delivery.method == "update" and message is not None:
+                response = self.client.chat_update(channel=delivery.channel, ts=message, text=delivery.text)
+            else:
+                response = self.client.chat_postMessage(channel=delivery.channel, text=delivery.text)
+            delivery.future.set_result(response["ts"])
+            done = True
+        except Exception as e:
+            delivery.attempts += 1
+            response = getattr(e, "response", None)
+            if getattr(response, "status_code", None) == 429:
+                self.rate_limited += 1
+                retry_after = float(response.headers.get("Retry-After", 1))
+            done = delivery.attempts > self.max_retries
+            if done:
+                self.lg.error(f"Failed to deliver a message to {delivery.channel}: {e}")
+                delivery.future.set_exception(e)
+            else:
+                retry_after = retry_after if retry_after is not None else min(self.max_backoff, 2 ** (delivery.attempts - 1))
+        with self.__condition:
+            if done:
+                state.deliveries.popleft()
+            else:
+                state.blocked_until = time.monotonic() + retry_after
+            state.busy = False
+            self.__condition.notify()
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Stops accepting messages and waits until the queued messages are delivered
+
+        Args:
+            timeout (float, optional): The maximum amount of seconds to wait. Defaults to None.
+        """
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify()
+        self.__dispatcher.join(timeout)
+        self.__executor.shutdown(wait=True)
+
+    def __len__(self) -> int:
+        with self.__condition:
+            return sum(len(state.deliveries) for state in self.__channels.values())
@@ -0,0 +1,82 @@
+from typing import Dict, List, Optional
+import os
+
+def stat(pid: str = "self") -> Optional[List[bytes]]:
+    """Reads the fields of /proc/<pid>/stat that follow the command name
+
+    Args:
+        pid (str, optional): The process id. Defaults to "self".
+
+    Returns:
+        Optional[List[bytes]]: The fields starting with the state, None if the process doesn't exist or /proc isn't available
+    """
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            return f.read().rsplit(b")", 1)[1].split() # The command name may contain spaces
+    except (OSError, IndexError):
+        return None
+
+
+def rss(pid: str = "self") -> int:
+    """Returns the resident set size of a process
+
+    Args:
+        pid (str, optional): The process id. Defaults to "self".
+
+    Returns:
+        int: The size in bytes, 0 if the process doesn't exist or /proc isn't available
+    """
+    try:
+        with open(f"/proc/{pid}/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def process_age() -> float:
+    """Returns how many seconds ago this process was started, including the time spent importing modules
+
+    Returns:
+        float: The age in seconds, 0 where /proc isn't available
+    """
+    fields = stat()
+    try:
+        started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        with open("/proc/uptime", "rb") as f:
+            uptime = float(f.read().split()[0])
+    except (TypeError, OSError, IndexError, ValueError):
+        return 0.0
+    return max(0.0, uptime - started)
+
+
+def process_tree_rss(pid: Optional[int] = None) -> int:
+    """Returns the resident set size of a process and all of its descendants, e.g. the browsers of the backends
+
+    Args:
+        pid (int, optional): The root process. Defaults to this process.
+
+    Returns:
+        int: The size in bytes, 0 where /proc isn't available
+    """
+    pid = os.getpid() if pid is None else pid
+    children: Dict[int, List[int]] = {}
+    sizes: Dict[int, int] = {}
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return 0
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        fields = stat(entry)
+        if fields is None or len(fields) < 2:
+            continue # The process exited in the meantime
+        sizes[int(entry)] = rss(entry)
+        children.setdefault(int(fields[1]), []).append(int(entry))
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        total += sizes.get(current, 0)
+        stack.extend(children.get(current, ()))
+    return total
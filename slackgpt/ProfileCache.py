@@ -0,0 +1,121 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, Tuple
+import threading
+import time
+from slack_sdk import WebClient
+
+class ProfileCache:
+    def __init__(self, client: WebClient, ttl: float = 3600, max_size: int = 50000):
+        """Represents a thread-safe cache of Slack usernames keyed by user id
+
+        Concurrent lookups of the same unknown user id share one users.info call.
+
+        Args:
+            client (WebClient): The Slack WebClient
+            ttl (float, optional): The amount of seconds a username is reused. Defaults to 3600.
+            max_size (int, optional): The maximum amount of cached users, the least recently used are evicted first. Defaults to 50000.
+        """
+        self.client = client
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict() # User id -> (username, expiry timestamp)
+        self.__lookups: Dict[str, Future] = {} # User id -> users.info call in flight
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def username(user: dict) -> str:
+        """Returns the display name of a Slack user object or the real name if the display name is empty
+
+        Args:
+            user (dict): The user object returned by users.info or users.list
+
+        Returns:
+            str: The username
+        """
+        username = user.get("profile", {}).get("display_name", "")
+        if username == "":
+            username = user.get("real_name") or user.get("profile", {}).get("real_name", "") or user.get("name", "")
+        return username
+
+    def put(self, user_id: str, username: str) -> None:
+        """Caches the username of a user
+
+        Args:
+            user_id (str): The Slack user id
+            username (str): The username
+        """
+        with self.__lock:
+            self.__entries[user_id] = (username, time.monotonic() + self.ttl)
+            self.__entries.move_to_end(user_id)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+    def get(self, user_id: str) -> str:
+        """Returns the username of a user, looking it up with users.info if it isn't cached
+
+        Args:
+            user_id (str): The Slack user id
+
+        Returns:
+            str: The username
+        """
+        with self.__lock:
+            entry = self.__entries.get(user_id)
+            if entry is not None and entry[1] > time.monotonic():
+                self.__entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            lookup = self.__lookups.get(user_id)
+            leader = lookup is None
+            if leader:
+                lookup = self.__lookups[user_id] = Future()
+        if not leader:
+            return lookup.result()
+        try:
+            username = self.username(self.client.users_info(user=user_id)["user"])
+            self.put(user_id, username)
+            lookup.set_result(username)
+            return username
+        except Exception as e:
+            lookup.set_exception(e)
+            raise
+        finally:
+            with self.__lock:
+                del self.__lookups[user_id]
+
+    def warm_up(self, page_size: int = 200) -> int:
+        """Caches every user of the workspace by paging through users.list
+
+        Args:
+            page_size (int, optional): The amount of users per page. Defaults to 200.
+
+        Returns:
+            int: The amount of cached users
+        """
+        cursor = None
+        loaded = 0
+        while True:
+            response = self.client.users_list(cursor=cursor, limit=page_size)
+            for member in response["members"]:
+                if not member.get("deleted"):
+                    self.put(member["id"], self.username(member))
+                    loaded += 1
+            cursor = response.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                return loaded
+
+    def stats(self) -> str:
+        """Returns a human readable summary of the cache
+
+        Returns:
+            str: The amount of cached users and the hit rate
+        """
+        total = self.hits + self.misses
+        return f"Profile cache: {len(self)} users, {self.hits} hits, {self.misses} misses ({self.hits / total * 100 if total else 0:.1f}% hit rate)"
+
+    def __len__(self) -> int:
+        return len(self.__entries)
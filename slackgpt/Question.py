@@ -1,9 +1,17 @@
 from slack_sdk.web import WebClient
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+import time
+import Metrics
 
 class Question:
+    __slots__ = ("channel", "username", "text", "ts", "client", "direct_message", "answer_text", "is_answered", "followers", "created", "stages", "journal_id", "queue_id", "attempts", "user")
+
     def __init__(self, channel: str, username: str, text: str, user, ts: str, client: WebClient, direct_message: bool = False):
         """Represents a question asked by a user
 
+        Once answered, the question detaches from the client and the user, so the answered history only holds small records.
+
         Args:
             channel (str): The channel id
             username (str): The username of the user
@@ -17,14 +25,17 @@ class Question:
         self.direct_message = direct_message
         self.answer_text = None # The field for the future answer by ChatGPT
         self.is_answered = False # Whether or not the question has been answered
+        self.followers: Optional[List["Question"]] = None # Identical questions of other users waiting for this answer
+        self.created = time.monotonic()
+        self.stages: Optional[Dict[str, float]] = {} # Stage -> monotonic time, see Metrics.stages. None once they have been observed
+        self.journal_id: Optional[int] = None # Set once the question has been written to the queue journal
+        self.queue_id: Optional[int] = None # Set once the question has been written to a SharedQueue
+        self.attempts = 0 # The amount of times a worker timed out answering the question
         self.user = user # Get the user object from the handler
         self.user.add(self) # Add the question to the user's pending list   
 
     def __str__(self):
-        return f"Question({self.channel}, {self.user.username}, {self.text}) -> {self.answer_text}"
-
-    def __getitem__(self, index):
-        return self
+        return f"Question({self.channel}, {self.username}, {self.text}) -> {self.answer_text}"
 
     def answer(self, answer_text: str):
         """Marks a question as answered
@@ -34,9 +45,45 @@ class Question:
         """
         self.is_answered = True
         self.answer_text = answer_text
-        self.user.answered.append(self)
-        self.user.pending.remove(self)
+        self.user.mark_answered(self)
         self.send_answer()
+        self.detach()
+
+    def detach(self) -> None:
+        """Drops the references an answered question doesn't need anymore
+        """
+        self.client = None
+        self.user = None
+
+    def mark(self, stage: str, at: Optional[float] = None) -> None:
+        """Records when the question reached a stage, the stage times are added to the metrics once the answer is posted
+
+        Args:
+            stage (str): One of Metrics.stages
+            at (float, optional): The monotonic time the stage was reached. Defaults to now.
+        """
+        if self.stages is None:
+            return
+        self.stages[stage] = time.monotonic() if at is None else at
+        if stage == "posted":
+            Metrics.observe_stages(self.stages)
+            self.stages = None
+
+    def track_delivery(self, response) -> None:
+        """Marks the question as posted once the answer has been delivered
+
+        Args:
+            response: The response of chat_postMessage or chat_update, a Future if it was sent through the outbox
+        """
+        if not isinstance(response, Future):
+            self.mark("posted")
+            return
+        def delivered(future: Future):
+            if future.exception() is None:
+                self.mark("posted")
+            else:
+                Metrics.errors.inc(kind="delivery")
+        response.add_done_callback(delivered)
 
     def send_answer(self) -> None:
         """Called by the handler to send the answer to the user
@@ -44,7 +91,7 @@ class Question:
         Args:
             client (WebClient): The Slack WebClient
         """
-        self.client.chat_postMessage(channel=self.channel, text=self.answer_text)
+        self.track_delivery(self.client.chat_postMessage(channel=self.channel, text=self.answer_text))
 
     def send_pre_answer(self) -> str:
         """Sent before the question is posed to ChatGPT to let the user know that the question is being processed
@@ -55,4 +102,15 @@ class Question:
         Returns:
             str: The message id of the sent message
         """
-        return ""
\ No newline at end of file
+        return ""
+
+    def send_partial(self, text: str) -> bool:
+        """Shows the part of the answer that has been generated so far, if the question supports it
+
+        Args:
+            text (str): The answer so far
+
+        Returns:
+            bool: Whether the partial answer was sent
+        """
+        return False
\ No newline at end of file
@@ -1,35 +1,179 @@
+from typing import Callable, Dict, Hashable, List, Optional, Set
+import threading
 from Question import Question
+from Scheduler import FifoScheduler, Scheduler
 
 class Queue:
-    def __init__(self):
-        """Represents a queue of questions to be answered by ChatGPT
+    def __init__(self, scheduler: Callable[[], Scheduler] = FifoScheduler):
+        """Represents a blocking, thread-safe queue of questions to be answered by ChatGPT
+
+        Questions of a user that is already owned by a worker are routed to that worker's own lane,
+        so a conversation always stays with the backend that created it. A user is owned until none
+        of their questions is queued or being answered anymore (see complete).
+
+        Args:
+            scheduler (Callable[[], Scheduler], optional): Creates the scheduler that orders the shared queue and every lane. Defaults to FifoScheduler.
         """
-        self.__queue = []
+        self.scheduler = scheduler
+        self.__queue: Scheduler = scheduler()
+        self.__lanes: Dict[Hashable, Scheduler] = {} # The questions routed to a specific worker
+        self.__owners: Dict[str, Hashable] = {} # Username -> worker that owns the user's conversation
+        self.__unfinished: Dict[str, Set[Question]] = {} # Username -> questions that are queued or being answered
+        self.__size = 0
+        self.__condition = threading.Condition()
+        self.__shutdown = False
 
     def push(self, question: Question):
-        """Adds a question to the queue
+        """Adds a question to the queue and wakes up a waiting worker
 
         Args:
             question (Question): The question to add to the queue
 
         Raises:
             TypeError: If the question is not of type Question
+            RuntimeError: If the queue has been shut down
         """
         if not isinstance(question, Question):
             raise TypeError("Question must be of type Question")
-        self.__queue.append(question)
+        with self.__condition:
+            if self.__shutdown:
+                raise RuntimeError("Queue has been shut down")
+            self.__size += 1
+            self.__unfinished.setdefault(question.username, set()).add(question) # Pushed again after a timeout, it is still one question
+            owner = self.__owners.get(question.username)
+            if owner is None:
+                self.__queue.push(question)
+                self.__condition.notify()
+            else:
+                self.__lane(owner).push(question)
+                self.__condition.notify_all()
 
-    def pop(self) -> Question:
-        """Removes the first question from the queue and returns it
+    def pop(self, timeout: Optional[float] = None, worker: Optional[Hashable] = None) -> Optional[Question]:
+        """Removes the next question for the worker from the queue and returns it, blocking until one is available
+
+        Args:
+            timeout (float, optional): The maximum amount of seconds to wait for a question. Defaults to None (wait forever).
+            worker (Hashable, optional): The worker asking for a question. The worker claims the users of the questions it receives. Defaults to None (no affinity).
 
         Returns:
-            Question: The first question in the queue
+            Optional[Question]: The next question or None if the timeout expired or the queue was shut down
         """
-        return self.__queue.pop(0)
+        with self.__condition:
+            while True:
+                if not self.__condition.wait_for(lambda: self.__lanes.get(worker) or self.__queue or self.__shutdown, timeout):
+                    return None
+                lane = self.__lanes.get(worker)
+                if lane:
+                    self.__size -= 1
+                    return lane.pop()
+                if not self.__queue:
+                    return None
+                question = self.__queue.pop()
+                if worker is None:
+                    self.__size -= 1
+                    return question
+                owner = self.__owners.setdefault(question.username, worker)
+                if owner == worker:
+                    self.__size -= 1
+                    return question
+                # Another worker owns this conversation, hand the question over and keep waiting
+                self.__lane(owner).push(question)
+                self.__condition.notify_all()
 
-    def __len__(self) -> Question:
-        return len(self.__queue)
+    def take(self, worker: Hashable, predicate: Callable[[Question], bool], limit: int) -> List[Question]:
+        """Removes queued questions the predicate accepts without blocking, from the worker's lane first
 
-    def __getitem__(self, index) -> Question:
-        return self.__queue[index]
+        Args:
+            worker (Hashable): The worker taking the questions
+            predicate (Callable[[Question], bool]): Returns whether a question is taken, it must only accept users the worker owns or that are unowned
+            limit (int): The maximum amount of questions to take
+
+        Returns:
+            List[Question]: The taken questions
+        """
+        with self.__condition:
+            taken: List[Question] = []
+            lane = self.__lanes.get(worker)
+            if lane:
+                taken += lane.take(predicate, limit)
+            if len(taken) < limit and self.__queue:
+                taken += self.__queue.take(predicate, limit - len(taken))
+            self.__size -= len(taken)
+            return taken
+
+    def complete(self, question: Question) -> None:
+        """Marks a question as answered, the user's conversation is released once none of their questions is unfinished
+
+        Args:
+            question (Question): The answered question
+        """
+        with self.__condition:
+            unfinished = self.__unfinished.get(question.username)
+            if unfinished is None:
+                return
+            unfinished.discard(question)
+            if not unfinished:
+                del self.__unfinished[question.username]
+                self.__owners.pop(question.username, None)
+
+    def __lane(self, worker: Hashable) -> Scheduler:
+        lane = self.__lanes.get(worker)
+        if lane is None:
+            lane = self.__lanes[worker] = self.scheduler()
+        return lane
+
+    def owner(self, username: str) -> Optional[Hashable]:
+        """Returns the worker that owns the conversation of the user
+
+        Args:
+            username (str): The username of the user
 
+        Returns:
+            Optional[Hashable]: The owning worker or None if the user has not been claimed yet
+        """
+        with self.__condition:
+            return self.__owners.get(username)
+
+    def release(self, worker: Hashable) -> None:
+        """Drops every conversation owned by the worker and moves its pending questions back to the shared queue
+
+        Args:
+            worker (Hashable): The worker to release
+        """
+        with self.__condition:
+            self.__owners = {username: owner for username, owner in self.__owners.items() if owner != worker}
+            lane = self.__lanes.pop(worker, None)
+            if lane:
+                while lane:
+                    self.__queue.push(lane.pop())
+                self.__condition.notify_all()
+
+    def peek(self) -> Optional[Question]:
+        """Returns the first question in the shared queue without removing it
+
+        Returns:
+            Optional[Question]: The first question in the queue or None if the queue is empty
+        """
+        with self.__condition:
+            return self.__queue.peek()
+
+    def shutdown(self) -> None:
+        """Signals all waiting workers to stop. Questions that are still queued can be drained with pop
+        """
+        with self.__condition:
+            self.__shutdown = True
+            self.__condition.notify_all()
+
+    @property
+    def is_shutdown(self) -> bool:
+        """Whether the queue has been shut down
+        """
+        return self.__shutdown
+
+    def __len__(self) -> int:
+        with self.__condition:
+            return self.__size
+
+    def __getitem__(self, index) -> Question:
+        with self.__condition:
+            return list(self.__queue)[index]
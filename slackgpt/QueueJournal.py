@@ -0,0 +1,331 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import json
+import os
+import threading
+import zlib
+from Logger import *
+
+class QueueJournal:
+    def __init__(self, path: str, compact_after: int = 10000, max_attempts: int = 3, fsync: bool = True):
+        """Represents an append-only journal of the queued questions so they survive a crash
+
+        Every question is journaled when it is queued, when a worker takes it and when it has been answered. Appends
+        are written and fsynced by a background thread in groups: every append that arrives while a fsync runs is
+        committed by the next one. Once compact_after records have been written, the journal is rewritten with only
+        the unfinished questions.
+
+        Every line is a CRC32 checksum followed by the JSON record, so a torn last line is detected and ignored.
+
+        Args:
+            path (str): The path of the journal file
+            compact_after (int, optional): The amount of written records after which the journal is compacted. Defaults to 10000.
+            max_attempts (int, optional): The amount of times a question may be taken by a worker before it isn't replayed anymore. Defaults to 3.
+            fsync (bool, optional): Whether every group of records is fsynced. Defaults to True.
+        """
+        self.path = path
+        self.compact_after = compact_after
+        self.max_attempts = max_attempts
+        self.fsync = fsync
+        self.commits = 0 # The amount of fsynced groups
+        self.compactions = 0
+        self.lg = Logger("QueueJournal", level=Level.INFO, formatter=Logger.minecraft_formatter, handlers=[FileHandler.latest_file_handler(Logger.minecraft_formatter), main_file_handler])
+        self.__live: "OrderedDict[int, dict]" = OrderedDict() # Id -> enqueue record of every unfinished question, in enqueue order
+        self.__written = self.__load()
+        self.__next_id = max(self.__live, default=0) + 1
+        self.__replay = list(self.__live.values())
+        self.__buffer: List[bytes] = []
+        self.__appended = 0 # The sequence number of the latest append
+        self.__committed = 0 # The sequence number of the latest fsynced append
+        self.__error: Optional[OSError] = None # The error of the latest failed write, cleared by the next successful one
+        self.__condition = threading.Condition()
+        self.__closed = False
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.__file = open(path, "ab")
+        self.__thread = threading.Thread(target=self.__run, name="QueueJournal", daemon=True)
+        self.__thread.start()
+
+    @staticmethod
+    def encode(record: dict) -> bytes:
+        data = json.dumps(record, separators=(",", ":")).encode()
+        return b"%08x %s\n" % (zlib.crc32(data), data)
+
+    @staticmethod
+    def decode(line: bytes) -> dict:
+        """Parses a journal line
+
+        Args:
+            line (bytes): The line including its checksum
+
+        Raises:
+            ValueError: If the line is incomplete or its checksum doesn't match
+
+        Returns:
+            dict: The record
+        """
+        if not line.endswith(b"\n") or len(line) < 10:
+            raise ValueError("Incomplete record")
+        data = line[9:-1]
+        if int(line[:8], 16) != zlib.crc32(data):
+            raise ValueError("Checksum mismatch")
+        return json.loads(data)
+
+    def __load(self) -> int:
+        if not os.path.exists(self.path):
+            return 0
+        records = 0
+        valid = 0 # The offset after the last valid line
+        with open(self.path, "rb") as f:
+            offset = 0
+            for number, line in enumerate(f, 1):
+                offset += len(line)
+                try:
+                    record = self.decode(line)
+                except ValueError as e:
+                    self.lg.warning(f"Ignoring line {number} of {self.path}: {e}") # Written while the process died
+                    continue
+                valid = offset
+                records += 1
+                self.__apply(record)
+        if offset > valid: # Otherwise the next record would be appended to the torn line and fail its checksum
+            with open(self.path, "r+b") as f:
+                f.truncate(valid)
+            self.lg.warning(f"Truncated {offset - valid} bytes after the last valid record of {self.path}")
+        return records
+
+    def __apply(self, record: dict) -> None:
+        operation = record["op"]
+        if operation == "enqueue":
+            self.__live[record["id"]] = record
+        elif operation == "dequeue":
+            live = self.__live.get(record["id"])
+            if live is not None:
+                live["attempts"] = live.get("attempts", 0) + 1
+        elif operation == "complete":
+            self.__live.pop(record["id"], None)
+
+    def replay(self) -> List[dict]:
+        """Returns the enqueue records of the questions that were unfinished when the journal was opened, in their original order
+
+        Questions that were taken by a worker max_attempts times are skipped and completed, so a prompt that crashes
+        the process isn't asked forever.
+
+        Returns:
+            List[dict]: The records with the id, channel, username, text, ts and direct_message of every question
+        """
+        records = []
+        for record in self.__replay:
+            if record.get("attempts", 0) >= self.max_attempts:
+                self.lg.warning(f"Dropping question {record['id']} of {record['username']} after {record['attempts']} attempts")
+                self.__append({"op": "complete", "id": record["id"]})
+                continue
+            records.append(record)
+        self.__replay = []
+        return records
+
+    def enqueue(self, question) -> int:
+        """Journals a queued question and waits until the record is on disk. Replayed questions are not journaled again
+
+        Args:
+            question (Question): The question, its journal_id is set
+
+        Raises:
+            OSError: If the record couldn't be written, it is written again with the next records
+
+        Returns:
+            int: The journal id of the question
+        """
+        if question.journal_id is not None:
+            return question.journal_id
+        with self.__condition:
+            question.journal_id = self.__next_id
+            self.__next_id += 1
+            record = {"op": "enqueue", "id": question.journal_id, "channel": question.channel, "username": question.username, "text": question.text, "ts": question.ts, "direct_message": question.direct_message}
+            sequence = self.__append(record)
+            failed = self.__error
+            self.__condition.wait_for(lambda: self.__committed >= sequence or self.__closed or (self.__error is not None and self.__error is not failed))
+            if self.__committed < sequence and self.__error is not None:
+                raise self.__error
+        return question.journal_id
+
+    def dequeue(self, question) -> None:
+        """Journals that a worker took a question, without waiting for the disk
+
+        Args:
+            question (Question): The question
+        """
+        if question.journal_id is not None:
+            self.__append({"op": "dequeue", "id": question.journal_id})
+
+    def complete(self, question) -> None:
+        """Journals that a question has been answered, without waiting for the disk. At worst it is asked again after a crash
+
+        Args:
+            question (Question): The question
+        """
+        if question.journal_id is not None:
+            self.__append({"op": "complete", "id": question.journal_id})
+
+    def __append(self, record: dict) -> int:
+        line = self.encode(record)
+        with self.__condition:
+            if self.__closed:
+                raise RuntimeError("Journal has been closed")
+            self.__apply(record)
+            self.__buffer.append(line)
+            self.__appended += 1
+            self.__condition.notify_all()
+            return self.__appended
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: self.__buffer or self.__closed)
+                if self.__error is not None:
+                    self.__condition.wait_for(lambda: self.__closed, 1.0) # Retry the failed write, e.g. once the disk has space again
+                if not self.__buffer and self.__closed:
+                    return
+                lines, self.__buffer = self.__buffer, []
+                sequence = self.__appended
+                self.__written += len(lines)
+                compact = self.__written >= self.compact_after
+                live = [self.encode(record) for record in self.__live.values()] if compact else None
+            offset = None
+            try:
+                if compact: # The live records already contain the effect of the lines
+                    self.__compact(live)
+                else:
+                    offset = self.__file.tell()
+                    self.__file.write(b"".join(lines))
+                    self.__file.flush()
+                    if self.fsync:
+                        os.fsync(self.__file.fileno())
+            except (OSError, ValueError) as e: # ValueError if the file couldn't be reopened
+                self.lg.error(f"Failed to write {self.path}: {e}")
+                self.__reopen(offset)
+                with self.__condition:
+                    self.__buffer[:0] = lines # Written again before the later records
+                    self.__written -= len(lines)
+                    self.__error = e if isinstance(e, OSError) else OSError(str(e))
+                    self.__condition.notify_all()
+                    if not self.__closed:
+                        continue
+                return # Closing, the records are lost
+            with self.__condition:
+                self.__error = None
+                self.commits += 1
+                self.__committed = sequence
+                self.__condition.notify_all()
+
+    def __reopen(self, offset: Optional[int]) -> None:
+        try:
+            self.__file.close() # Fails if the buffered lines can't be flushed, the file is closed anyway
+        except OSError:
+            pass
+        try:
+            if offset is not None: # Drop a partly written group, the next one would continue its torn line
+                with open(self.path, "r+b") as f:
+                    f.truncate(offset)
+            self.__file = open(self.path, "ab")
+        except OSError as e:
+            self.lg.error(f"Failed to reopen {self.path}: {e}")
+
+    def __compact(self, lines: List[bytes]) -> None:
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(b"".join(lines))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        self.__file.close()
+        try:
+            os.replace(temporary, self.path)
+        finally:
+            self.__file = open(self.path, "ab")
+        if self.fsync and hasattr(os, "O_DIRECTORY"): # Make the rename durable
+            directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_DIRECTORY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        with self.__condition:
+            self.__written = len(lines)
+        self.compactions += 1
+
+    def close(self) -> None:
+        """Commits the waiting records and closes the journal
+        """
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        self.__thread.join()
+        self.__file.close()
+
+    def stats(self) -> str:
+        """Returns a human readable summary of the journal
+
+        Returns:
+            str: The summary
+        """
+        return f"Queue journal: {len(self.__live)} unfinished questions, {self.__appended} records in {self.commits} commits, {self.compactions} compactions"
+
+    def __len__(self) -> int:
+        return len(self.__live)
+
+
+# Benchmark
+if __name__ == "__main__":
+    import tempfile
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    class Record:
+        def __init__(self, index: int):
+            self.journal_id = None
+            self.channel = "C00000000"
+            self.username = f"user{index % 100}"
+            self.text = f"!Question {index}: " + "please explain this " * 10
+            self.ts = f"{1600000000 + index}.000100"
+            self.direct_message = False
+
+    def measure(threads: int, fsync: bool, count: int = 4000) -> str:
+        path = os.path.join(tempfile.mkdtemp(), "queue.journal")
+        journal = QueueJournal(path, compact_after=5000, fsync=fsync)
+        latencies = []
+        def enqueue(index: int) -> None:
+            question = Record(index)
+            start = time.perf_counter()
+            journal.enqueue(question)
+            latencies.append(time.perf_counter() - start)
+            journal.dequeue(question)
+            journal.complete(question)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(enqueue, range(count)))
+        duration = time.perf_counter() - start
+        journal.close()
+        latencies.sort()
+        return f"{threads:2} threads, fsync {'on ' if fsync else 'off'}: {count / duration:8.0f} questions/s, enqueue p50 {latencies[len(latencies) // 2] * 1e6:7.0f}us, p99 {latencies[int(len(latencies) * 0.99)] * 1e6:7.0f}us, {journal.commits} commits, {journal.compactions} compactions"
+
+    for fsync in (False, True):
+        for threads in (1, 4, 16):
+            print(measure(threads, fsync))
+
+    path = os.path.join(tempfile.mkdtemp(), "queue.journal")
+    journal = QueueJournal(path)
+    questions = [Record(index) for index in range(1000)]
+    for question in questions:
+        journal.enqueue(question)
+    for question in questions[:600]:
+        journal.dequeue(question)
+        journal.complete(question)
+    journal.dequeue(questions[600]) # In flight when the process dies
+    journal.close()
+    with open(path, "ab") as f:
+        f.write(b"0badc0de {\"op\":\"comp") # Torn write
+    start = time.perf_counter()
+    journal = QueueJournal(path)
+    replayed = journal.replay()
+    print(f"Replayed {len(replayed)} questions (first {replayed[0]['id']}, in order: {[r['id'] for r in replayed] == sorted(r['id'] for r in replayed)}) in {(time.perf_counter() - start) * 1000:.1f}ms")
+    journal.close()
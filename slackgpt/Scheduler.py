@@ -0,0 +1,392 @@
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Callable, Deque, Dict, Iterator, List, Optional
+import heapq
+import itertools
+import time
+from Question import Question
+
+class Scheduler(ABC):
+    """Decides in which order the queued questions are answered. Used by Queue, which takes care of locking
+    """
+
+    @abstractmethod
+    def push(self, question: Question) -> None:
+        """Adds a question
+
+        Args:
+            question (Question): The question to add
+        """
+
+    @abstractmethod
+    def pop(self) -> Question:
+        """Removes the next question and returns it
+
+        Raises:
+            IndexError: If there are no questions
+
+        Returns:
+            Question: The next question
+        """
+
+    @abstractmethod
+    def peek(self) -> Optional[Question]:
+        """Returns the next question without removing it
+
+        Returns:
+            Optional[Question]: The next question or None if there are no questions
+        """
+
+    @abstractmethod
+    def take(self, predicate: Callable[[Question], bool], limit: int) -> List[Question]:
+        """Removes the questions the predicate accepts, in the order they were pushed. The predicate is called once per question until the limit is reached
+
+        Args:
+            predicate (Callable[[Question], bool]): Returns whether a question is taken
+            limit (int): The maximum amount of questions to take
+
+        Returns:
+            List[Question]: The taken questions
+        """
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    @abstractmethod
+    def __iter__(self) -> Iterator[Question]:
+        pass
+
+
+class FifoScheduler(Scheduler):
+    def __init__(self):
+        """Answers the questions in the order they were asked
+        """
+        self.__questions: Deque[Question] = deque()
+
+    def push(self, question: Question) -> None:
+        self.__questions.append(question)
+
+    def pop(self) -> Question:
+        return self.__questions.popleft()
+
+    def peek(self) -> Optional[Question]:
+        return self.__questions[0] if self.__questions else None
+
+    def take(self, predicate: Callable[[Question], bool], limit: int) -> List[Question]:
+        taken: List[Question] = []
+        kept: Deque[Question] = deque()
+        for question in self.__questions:
+            if len(taken) < limit and predicate(question):
+                taken.append(question)
+            else:
+                kept.append(question)
+        self.__questions = kept
+        return taken
+
+    def __len__(self) -> int:
+        return len(self.__questions)
+
+    def __iter__(self) -> Iterator[Question]:
+        return iter(self.__questions)
+
+
+class Entry:
+    __slots__ = ("question", "enqueued", "alive")
+
+    def __init__(self, question: Question, enqueued: float):
+        """A queued question with its enqueue time, dead entries have been served and are skipped
+
+        Args:
+            question (Question): The queued question
+            enqueued (float): The time the question was pushed
+        """
+        self.question = question
+        self.enqueued = enqueued
+        self.alive = True
+
+
+class DeficitRoundRobin:
+    def __init__(self, quantum: float, weights: Dict[str, float], cost: Callable[[Question], float]):
+        """Deficit round robin over one FIFO flow per user, so every user gets a share of the backend proportional to their weight
+
+        Args:
+            quantum (float): The credit a user gets per round
+            weights (Dict[str, float]): The weight per username, users without a weight have 1
+            cost (Callable[[Question], float]): Returns the cost of answering a question
+        """
+        self.quantum = quantum
+        self.weights = weights
+        self.cost = cost
+        self.flows: Dict[str, Deque[Entry]] = {}
+        self.deficits: Dict[str, float] = {}
+        self.ring: Deque[str] = deque() # The users with queued questions in round robin order
+        self.in_turn = False # Whether the first user of the ring already got its credit for this round
+
+    def push(self, entry: Entry) -> None:
+        username = entry.question.username
+        flow = self.flows.get(username)
+        if flow is None:
+            flow = self.flows[username] = deque()
+            self.deficits[username] = 0.0
+            self.ring.append(username)
+        flow.append(entry)
+
+    def __drop_dead(self, username: str) -> bool:
+        flow = self.flows[username]
+        while flow and not flow[0].alive:
+            flow.popleft()
+        if flow:
+            return False
+        del self.flows[username]
+        del self.deficits[username]
+        return True
+
+    def pop(self) -> Optional[Entry]:
+        while self.ring:
+            username = self.ring[0]
+            if self.__drop_dead(username):
+                self.ring.popleft()
+                self.in_turn = False
+                continue
+            if not self.in_turn: # The user's turn starts, it gets its credit for this round
+                self.deficits[username] += self.quantum * self.weights.get(username, 1.0)
+                self.in_turn = True
+            head = self.flows[username][0]
+            cost = self.cost(head.question)
+            if self.deficits[username] >= cost:
+                self.deficits[username] -= cost
+                self.flows[username].popleft()
+                if self.__drop_dead(username):
+                    self.ring.popleft()
+                    self.in_turn = False
+                return head
+            self.in_turn = False
+            self.ring.rotate(-1)
+        return None
+
+    def peek(self) -> Optional[Entry]:
+        for username in self.ring:
+            for entry in self.flows[username]:
+                if entry.alive:
+                    return entry
+        return None
+
+
+class FairScheduler(Scheduler):
+    def __init__(self, quantum: float = 1.0, weights: Optional[Dict[str, float]] = None, prioritize_direct_messages: bool = True, max_wait: float = 300, clock: Callable[[], float] = time.monotonic):
+        """Shares the backend fairly between users with deficit round robin
+
+        A question costs 1 plus 1 per 1000 prompt characters, so with the default quantum every user gets about one
+        question per round and long prompts need a little more credit.
+
+        Direct messages form a priority class that is served first. Any question that waited longer than max_wait is
+        served next regardless of its user or class, so nothing starves.
+
+        Args:
+            quantum (float, optional): The credit a user gets per round. Defaults to 1.0.
+            weights (Dict[str, float], optional): The weight per username, users without a weight have 1. Defaults to None.
+            prioritize_direct_messages (bool, optional): Whether direct messages are served before channel mentions. Defaults to True.
+            max_wait (float, optional): The amount of seconds after which a question is served first. Defaults to 300.
+            clock (Callable[[], float], optional): Returns the current time in seconds. Defaults to time.monotonic.
+        """
+        weights = weights or {}
+        cost = lambda question: 1 + len(question.text) / 1000
+        self.prioritize_direct_messages = prioritize_direct_messages
+        self.max_wait = max_wait
+        self.clock = clock
+        self.__classes = [DeficitRoundRobin(quantum, weights, cost), DeficitRoundRobin(quantum, weights, cost)] # Priority, normal
+        self.__arrivals: Deque[Entry] = deque() # Every entry in arrival order, for aging
+        self.__size = 0
+
+    def __class_of(self, question: Question) -> DeficitRoundRobin:
+        return self.__classes[0 if self.prioritize_direct_messages and question.direct_message else 1]
+
+    def __oldest(self) -> Optional[Entry]:
+        while self.__arrivals and not self.__arrivals[0].alive:
+            self.__arrivals.popleft()
+        return self.__arrivals[0] if self.__arrivals else None
+
+    def push(self, question: Question) -> None:
+        entry = Entry(question, self.clock())
+        self.__class_of(question).push(entry)
+        self.__arrivals.append(entry)
+        self.__size += 1
+
+    def pop(self) -> Question:
+        oldest = self.__oldest()
+        if oldest is None:
+            raise IndexError("pop from an empty scheduler")
+        if self.clock() - oldest.enqueued >= self.max_wait:
+            entry = oldest # Aged, its flow drops the dead entry lazily
+        else:
+            entry = self.__classes[0].pop() or self.__classes[1].pop()
+        entry.alive = False
+        self.__size -= 1
+        return entry.question
+
+    def peek(self) -> Optional[Question]:
+        oldest = self.__oldest()
+        if oldest is None:
+            return None
+        if self.clock() - oldest.enqueued >= self.max_wait:
+            return oldest.question
+        entry = self.__classes[0].peek() or self.__classes[1].peek()
+        return entry.question if entry is not None else None
+
+    def take(self, predicate: Callable[[Question], bool], limit: int) -> List[Question]:
+        taken: List[Question] = []
+        for entry in self.__arrivals:
+            if len(taken) >= limit:
+                break
+            if entry.alive and predicate(entry.question):
+                entry.alive = False # Its flow and the arrivals drop the dead entry lazily
+                taken.append(entry.question)
+        self.__size -= len(taken)
+        return taken
+
+    def __len__(self) -> int:
+        return self.__size
+
+    def __iter__(self) -> Iterator[Question]:
+        return (entry.question for entry in list(self.__arrivals) if entry.alive)
+
+
+class ShortestFirstScheduler(Scheduler):
+    def __init__(self, prioritize_direct_messages: bool = True, max_wait: float = 300, clock: Callable[[], float] = time.monotonic):
+        """Answers the shortest prompts first, which minimizes the mean wait if answer time grows with prompt length
+
+        Any question that waited longer than max_wait is served next, so long prompts don't starve.
+
+        Args:
+            prioritize_direct_messages (bool, optional): Whether direct messages are served before channel mentions. Defaults to True.
+            max_wait (float, optional): The amount of seconds after which a question is served first. Defaults to 300.
+            clock (Callable[[], float], optional): Returns the current time in seconds. Defaults to time.monotonic.
+        """
+        self.prioritize_direct_messages = prioritize_direct_messages
+        self.max_wait = max_wait
+        self.clock = clock
+        self.__heap: List[tuple] = []
+        self.__arrivals: Deque[Entry] = deque()
+        self.__counter = itertools.count()
+        self.__size = 0
+
+    def __drop_dead(self) -> None:
+        while self.__arrivals and not self.__arrivals[0].alive:
+            self.__arrivals.popleft()
+        while self.__heap and not self.__heap[0][-1].alive:
+            heapq.heappop(self.__heap)
+
+    def push(self, question: Question) -> None:
+        entry = Entry(question, self.clock())
+        priority = 0 if self.prioritize_direct_messages and question.direct_message else 1
+        heapq.heappush(self.__heap, (priority, len(question.text), next(self.__counter), entry))
+        self.__arrivals.append(entry)
+        self.__size += 1
+
+    def __next(self) -> Optional[Entry]:
+        self.__drop_dead()
+        if not self.__arrivals:
+            return None
+        if self.clock() - self.__arrivals[0].enqueued >= self.max_wait:
+            return self.__arrivals[0]
+        return self.__heap[0][-1]
+
+    def pop(self) -> Question:
+        entry = self.__next()
+        if entry is None:
+            raise IndexError("pop from an empty scheduler")
+        entry.alive = False
+        self.__size -= 1
+        return entry.question
+
+    def peek(self) -> Optional[Question]:
+        entry = self.__next()
+        return entry.question if entry is not None else None
+
+    def take(self, predicate: Callable[[Question], bool], limit: int) -> List[Question]:
+        taken: List[Question] = []
+        for entry in self.__arrivals:
+            if len(taken) >= limit:
+                break
+            if entry.alive and predicate(entry.question):
+                entry.alive = False # Its flow and the heap drop the dead entry lazily
+                taken.append(entry.question)
+        self.__size -= len(taken)
+        return taken
+
+    def __len__(self) -> int:
+        return self.__size
+
+    def __iter__(self) -> Iterator[Question]:
+        return (entry.question for entry in list(self.__arrivals) if entry.alive)
+
+
+schedulers: Dict[str, Callable[..., Scheduler]] = {
+    "fifo": FifoScheduler,
+    "fair": FairScheduler,
+    "shortest": ShortestFirstScheduler
+}
+
+
+# Simulation benchmark
+if __name__ == "__main__":
+    import random
+
+    class SimulatedUser:
+        def __init__(self, username: str):
+            self.username = username
+            self.conversation_id = None
+
+        def add(self, question):
+            pass
+
+    def simulate(factory: Callable[[Callable[[], float]], Scheduler], seed: int = 7, duration: float = 3600) -> Dict[str, List[float]]:
+        """Simulates one backend answering a bursty workload and returns the waits per kind of user
+        """
+        generator = random.Random(seed)
+        now = [0.0]
+        scheduler = factory(lambda: now[0])
+        arrivals = []
+        for t in range(0, int(duration), 600): # A heavy user pastes twenty prompts every ten minutes
+            arrivals += [(t + i * 0.5, "heavy", False, generator.randint(200, 1500)) for i in range(20)]
+        t = 0.0
+        while t < duration: # Light users mention the bot in channels
+            t += generator.expovariate(1 / 30)
+            arrivals.append((t, f"light{generator.randint(0, 20)}", False, generator.randint(20, 400)))
+        t = 0.0
+        while t < duration: # Some users send direct messages
+            t += generator.expovariate(1 / 120)
+            arrivals.append((t, f"dm{generator.randint(0, 5)}", True, generator.randint(20, 400)))
+        arrivals.sort()
+        users = {}
+        arrived: Dict[Question, float] = {}
+        waits: Dict[str, List[float]] = {"heavy": [], "light": [], "dm": []}
+        busy_until = 0.0
+        index = 0
+        while index < len(arrivals) or len(scheduler):
+            if index < len(arrivals) and (arrivals[index][0] <= busy_until or not len(scheduler)):
+                arrival, username, direct_message, length = arrivals[index]
+                index += 1
+                now[0] = arrival
+                user = users.setdefault(username, SimulatedUser(username))
+                question = Question("C", username, "x" * length, user, str(arrival), None, direct_message)
+                arrived[question] = arrival
+                scheduler.push(question)
+                continue
+            now[0] = max(now[0], busy_until)
+            question = scheduler.pop()
+            waits[question.username.rstrip("0123456789")].append(now[0] - arrived.pop(question))
+            busy_until = now[0] + 2 + len(question.text) / 100 # Answer time grows with the prompt length
+        return waits
+
+    def summary(values: List[float]) -> str:
+        values = sorted(values)
+        return f"mean {sum(values) / len(values):7.1f}s, p95 {values[int(len(values) * 0.95)]:7.1f}s, p99 {values[int(len(values) * 0.99)]:7.1f}s"
+
+    for name, factory in (("fifo", lambda clock: FifoScheduler()), ("fair", lambda clock: FairScheduler(clock=clock)), ("shortest", lambda clock: ShortestFirstScheduler(clock=clock))):
+        waits = simulate(factory)
+        print(f"{name}:")
+        for kind, values in waits.items():
+            print(f"  {kind:5} ({len(values):4} questions): {summary(values)}")
+        print(f"  all   ({sum(len(v) for v in waits.values()):4} questions): {summary([w for v in waits.values() for w in v])}")
@@ -0,0 +1,77 @@
+from typing import Hashable
+import sqlite3
+import threading
+import time
+
+class SharedEventSet:
+    def __init__(self, path: str, ttl: float = 600, max_size: int = 100000):
+        """Represents a set of Slack event ids with expiring entries in a SQLite file, shared by every process using the file
+
+        It replaces ExpiringSet when several processes receive Slack events, so a retry delivered to another process is
+        still dropped. Adding is a single INSERT OR IGNORE, so concurrent deliveries of an event are processed once.
+
+        Args:
+            path (str): The path of the database file, usually the one of the SharedQueue
+            ttl (float, optional): The amount of seconds an entry is kept. Defaults to 600 (covers Slack's retry window).
+            max_size (int, optional): The maximum amount of entries, the oldest entries are evicted first. Defaults to 100000.
+
+        Raises:
+            ValueError: If the ttl or max_size are not positive
+        """
+        if ttl <= 0 or max_size <= 0:
+            raise ValueError("ttl and max_size must be positive")
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.__connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS events (key TEXT PRIMARY KEY, expiry REAL NOT NULL)")
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS events_expiry ON events (expiry)")
+        self.__lock = threading.Lock()
+        self.__expired = 0.0 # The time of the latest expiry run
+
+    def __expire(self, now: float) -> None:
+        if now - self.__expired < min(self.ttl / 10, 60): # Expired entries are ignored by the lookups, deleting them can wait
+            return
+        self.__expired = now
+        self.__connection.execute("DELETE FROM events WHERE expiry <= ?", (now,))
+        self.__connection.execute("DELETE FROM events WHERE key IN (SELECT key FROM events ORDER BY expiry DESC LIMIT -1 OFFSET ?)", (self.max_size,))
+
+    def add(self, key: Hashable) -> bool:
+        """Adds a key if it isn't already in the set
+
+        Args:
+            key (Hashable): The key to add
+
+        Returns:
+            bool: Whether the key was added, False if it was already present
+        """
+        now = time.time() # Shared by processes, so the wall clock
+        with self.__lock:
+            self.__expire(now)
+            with self.__connection:
+                self.__connection.execute("BEGIN IMMEDIATE")
+                self.__connection.execute("DELETE FROM events WHERE key = ? AND expiry <= ?", (str(key), now))
+                return self.__connection.execute("INSERT OR IGNORE INTO events (key, expiry) VALUES (?, ?)", (str(key), now + self.ttl)).rowcount == 1
+
+    def discard(self, key: Hashable) -> None:
+        """Removes a key if it is present
+
+        Args:
+            key (Hashable): The key to remove
+        """
+        with self.__lock:
+            self.__connection.execute("DELETE FROM events WHERE key = ?", (str(key),))
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self.__lock:
+            return self.__connection.execute("SELECT 1 FROM events WHERE key = ? AND expiry > ?", (str(key), time.time())).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return self.__connection.execute("SELECT COUNT(*) FROM events WHERE expiry > ?", (time.time(),)).fetchone()[0]
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__connection.close()
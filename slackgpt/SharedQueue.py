@@ -0,0 +1,343 @@
+from typing import Callable, Hashable, List, Optional
+import os
+import secrets
+import socket
+import sqlite3
+import threading
+import time
+from Question import Question
+from Logger import *
+
+class SharedRecord:
+    __slots__ = ("id", "channel", "username", "text", "ts", "direct_message", "attempts", "enqueued", "received", "created", "followers")
+
+    def __init__(self, row: tuple):
+        """A queued question as stored in the shared queue, it has the fields of Question that take predicates read
+
+        Args:
+            row (tuple): The id, channel, username, text, ts, direct_message, attempts, enqueued and received columns
+        """
+        self.id, self.channel, self.username, self.text, self.ts, direct_message, self.attempts, self.enqueued, received = row
+        self.direct_message = bool(direct_message)
+        now = time.monotonic()
+        self.created = now - max(0.0, time.time() - self.enqueued) # The enqueue time on this process's clock
+        self.received = None if received is None else now - max(0.0, time.time() - received)
+        self.followers = None # Coalescing only happens within a process
+
+    def to_dict(self) -> dict:
+        return {"id": self.id, "channel": self.channel, "username": self.username, "text": self.text, "ts": self.ts, "direct_message": self.direct_message, "attempts": self.attempts}
+
+
+class SharedQueue:
+    def __init__(self, path: str, lease: float = 30.0, poll_interval: float = 0.1, max_attempts: int = 3):
+        """Represents a queue of questions in a SQLite file that several processes push to and pop from
+
+        Ingestion processes push the questions, and worker processes in the same or other processes pop them. The
+        popping process builds its own Question with factory, which the Handler sets (see Handler.restore), so every
+        process answers through its own Slack client. A question stays in the file until it is completed. A user is
+        owned by the worker that first took one of their questions, like the lanes of Queue, so a conversation stays
+        with its backend. Questions are served in the order they were pushed.
+
+        Every process writes a heartbeat. The questions and users of a process whose heartbeat is older than lease
+        seconds are handed to the other processes, so a crashed worker process doesn't lose questions.
+
+        Args:
+            path (str): The path of the database file
+            lease (float, optional): The amount of seconds after which a process without heartbeat is considered dead. Defaults to 30.0.
+            poll_interval (float, optional): The amount of seconds between two checks for questions pushed by other processes. Defaults to 0.1.
+            max_attempts (int, optional): The amount of dead processes a question may be taken by before it is dropped. Defaults to 3.
+        """
+        self.path = path
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.factory: Optional[Callable[[dict], Question]] = None # Builds the question of a record, set by the Handler
+        self.local_ready: Callable[[], int] = lambda: 0 # The amount of ready workers in this process, reported with the heartbeat
+        self.process = f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(2)}"
+        self.lg = Logger("SharedQueue", level=Level.INFO, formatter=Logger.minecraft_formatter, handlers=[FileHandler.latest_file_handler(Logger.minecraft_formatter), main_file_handler])
+        self.__connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.executescript("""
+            CREATE TABLE IF NOT EXISTS questions (id INTEGER PRIMARY KEY, channel TEXT NOT NULL, username TEXT NOT NULL, text TEXT NOT NULL, ts TEXT, direct_message INTEGER NOT NULL, attempts INTEGER NOT NULL, enqueued REAL NOT NULL, received REAL, state TEXT NOT NULL, worker TEXT, process TEXT);
+            CREATE INDEX IF NOT EXISTS questions_state ON questions (state, id);
+            CREATE INDEX IF NOT EXISTS questions_user ON questions (username, text);
+            CREATE TABLE IF NOT EXISTS owners (username TEXT PRIMARY KEY, worker TEXT NOT NULL, process TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS processes (id TEXT PRIMARY KEY, heartbeat REAL NOT NULL, ready INTEGER NOT NULL);
+        """)
+        self.__lock = threading.Lock()
+        self.__wakeup = threading.Condition() # Wakes the workers of this process when it pushes a question
+        self.__shutdown = False
+        self.__stopped = threading.Event()
+        self.__beat()
+        self.__thread = threading.Thread(target=self.__run, name="SharedQueue", daemon=True)
+        self.__thread.start()
+
+    def __key(self, worker: Optional[Hashable]) -> Optional[str]:
+        return None if worker is None else f"{self.process}/{worker}"
+
+    def push(self, question: Question):
+        """Adds a question to the shared queue, or puts a question taken by this process back
+
+        The question is dropped from its user afterwards: the process that pops it builds a new one.
+
+        Args:
+            question (Question): The question to add to the queue
+
+        Raises:
+            TypeError: If the question is not of type Question
+            RuntimeError: If the queue has been shut down
+        """
+        if not isinstance(question, Question):
+            raise TypeError("Question must be of type Question")
+        if self.__shutdown:
+            raise RuntimeError("Queue has been shut down")
+        with self.__lock, self.__connection:
+            self.__connection.execute("BEGIN IMMEDIATE")
+            if question.queue_id is None:
+                now = time.time()
+                received = question.stages.get("received") if question.stages is not None else None
+                received = None if received is None else now - (time.monotonic() - received) # Wall clock, it is shared by the processes
+                question.queue_id = self.__connection.execute("INSERT INTO questions (channel, username, text, ts, direct_message, attempts, enqueued, received, state) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued')", (question.channel, question.username, question.text, question.ts, int(question.direct_message), question.attempts, now, received)).lastrowid
+            else:
+                self.__connection.execute("UPDATE questions SET state = 'queued', worker = NULL, process = NULL, attempts = ? WHERE id = ?", (question.attempts, question.queue_id))
+        if question.user is not None:
+            question.user.discard(question)
+        question.detach()
+        with self.__wakeup:
+            self.__wakeup.notify()
+
+    def pop(self, timeout: Optional[float] = None, worker: Optional[Hashable] = None) -> Optional[Question]:
+        """Takes the next question for the worker, blocking until one is available
+
+        Args:
+            timeout (float, optional): The maximum amount of seconds to wait for a question. Defaults to None (wait forever).
+            worker (Hashable, optional): The worker asking for a question. The worker claims the users of the questions it receives. Defaults to None (no affinity).
+
+        Returns:
+            Optional[Question]: The next question or None if the timeout expired or the queue was shut down
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.__shutdown:
+            rows = self.__claim(self.__key(worker), lambda record: True, 1)
+            if rows:
+                return self.__restore(rows[0])
+            wait = self.poll_interval if deadline is None else min(self.poll_interval, deadline - time.monotonic())
+            if wait <= 0:
+                return None
+            with self.__wakeup:
+                self.__wakeup.wait(wait)
+        return None
+
+    def take(self, worker: Hashable, predicate: Callable[[SharedRecord], bool], limit: int) -> List[Question]:
+        """Takes queued questions the predicate accepts without blocking, questions of users the worker owns first
+
+        Args:
+            worker (Hashable): The worker taking the questions
+            predicate (Callable[[SharedRecord], bool]): Returns whether a question is taken, it gets the queued record
+            limit (int): The maximum amount of questions to take
+
+        Returns:
+            List[Question]: The taken questions
+        """
+        return [self.__restore(record) for record in self.__claim(self.__key(worker), predicate, limit)]
+
+    def __claim(self, key: Optional[str], predicate: Callable[[SharedRecord], bool], limit: int) -> List[SharedRecord]:
+        with self.__lock:
+            if self.__connection.execute("SELECT 1 FROM questions WHERE state = 'queued' LIMIT 1").fetchone() is None:
+                return [] # Checked without the write lock, idle workers poll cheaply
+            with self.__connection:
+                self.__connection.execute("BEGIN IMMEDIATE")
+                rows = self.__connection.execute("""
+                    SELECT q.id, q.channel, q.username, q.text, q.ts, q.direct_message, q.attempts, q.enqueued, q.received FROM questions q LEFT JOIN owners o ON o.username = q.username
+                    WHERE q.state = 'queued' AND (o.worker IS NULL OR o.worker = ? OR ? IS NULL) ORDER BY o.worker IS NULL, q.id LIMIT ?
+                """, (key, key, 1 if limit == 1 else 200)).fetchall()
+                taken = []
+                for row in rows:
+                    if len(taken) >= limit:
+                        break
+                    record = SharedRecord(row)
+                    if predicate(record):
+                        taken.append(record)
+                self.__connection.executemany("UPDATE questions SET state = 'taken', worker = ?, process = ? WHERE id = ?", [(key, self.process, record.id) for record in taken])
+                if key is not None:
+                    self.__connection.executemany("INSERT OR IGNORE INTO owners (username, worker, process) VALUES (?, ?, ?)", [(record.username, key, self.process) for record in taken])
+                return taken
+
+    def __restore(self, record: SharedRecord) -> Question:
+        if self.factory is None:
+            raise RuntimeError("The shared queue has no factory to build questions")
+        question = self.factory(record.to_dict())
+        question.queue_id = record.id
+        if record.received is not None:
+            question.mark("received", record.received)
+        question.mark("enqueued", record.created)
+        return question
+
+    def complete(self, question: Question) -> None:
+        """Removes an answered question from the shared queue, the user's conversation is released once none of their questions is left
+
+        Args:
+            question (Question): The question
+        """
+        if question.queue_id is None:
+            return
+        with self.__lock, self.__connection:
+            self.__connection.execute("BEGIN IMMEDIATE")
+            self.__connection.execute("DELETE FROM questions WHERE id = ?", (question.queue_id,))
+            self.__forget(question.username)
+
+    def __forget(self, username: str) -> None:
+        # Inside a transaction, drops the owner of a user without queued or taken questions
+        self.__connection.execute("DELETE FROM owners WHERE username = ? AND NOT EXISTS (SELECT 1 FROM questions WHERE username = ?)", (username, username))
+
+    def is_pending(self, username: str, text: str) -> bool:
+        """Checks whether a user's question with the prompt is queued or being answered by any process
+
+        Args:
+            username (str): The username of the user
+            text (str): The prompt of the question
+
+        Returns:
+            bool: Whether the question is pending
+        """
+        with self.__lock:
+            return self.__connection.execute("SELECT 1 FROM questions WHERE username = ? AND text = ? LIMIT 1", (username, text)).fetchone() is not None
+
+    def owner(self, username: str) -> Optional[str]:
+        """Returns the worker that owns the conversation of the user
+
+        Args:
+            username (str): The username of the user
+
+        Returns:
+            Optional[str]: The owning worker, prefixed with its process, or None if the user has not been claimed yet
+        """
+        with self.__lock:
+            row = self.__connection.execute("SELECT worker FROM owners WHERE username = ?", (username,)).fetchone()
+        return row[0] if row is not None else None
+
+    def release(self, worker: Hashable) -> None:
+        """Drops every conversation owned by the worker, its queued questions can be taken by any worker
+
+        Args:
+            worker (Hashable): The worker to release
+        """
+        with self.__lock:
+            self.__connection.execute("DELETE FROM owners WHERE worker = ?", (self.__key(worker),))
+
+    def ready_workers(self) -> int:
+        """Returns the amount of ready workers in all live processes
+
+        Returns:
+            int: The amount of workers
+        """
+        with self.__lock:
+            return self.__connection.execute("SELECT COALESCE(SUM(ready), 0) FROM processes WHERE heartbeat >= ?", (time.time() - self.lease,)).fetchone()[0]
+
+    def __beat(self) -> None:
+        now = time.time()
+        with self.__lock, self.__connection:
+            self.__connection.execute("BEGIN IMMEDIATE")
+            self.__connection.execute("INSERT INTO processes (id, heartbeat, ready) VALUES (?, ?, ?) ON CONFLICT(id) DO UPDATE SET heartbeat = excluded.heartbeat, ready = excluded.ready", (self.process, now, self.local_ready()))
+            for (process,) in self.__connection.execute("SELECT id FROM processes WHERE heartbeat < ?", (now - self.lease,)).fetchall():
+                requeued = self.__connection.execute("UPDATE questions SET state = 'queued', worker = NULL, process = NULL, attempts = attempts + 1 WHERE process = ? AND state = 'taken'", (process,)).rowcount
+                self.__connection.execute("DELETE FROM owners WHERE process = ?", (process,))
+                self.__connection.execute("DELETE FROM processes WHERE id = ?", (process,))
+                self.lg.warning(f"Process {process} stopped sending heartbeats, queued its {requeued} questions again")
+            for question_id, username, attempts in self.__connection.execute("SELECT id, username, attempts FROM questions WHERE state = 'queued' AND attempts >= ?", (self.max_attempts,)).fetchall():
+                self.lg.warning(f"Dropping question {question_id} of {username} after {attempts} attempts")
+                self.__connection.execute("DELETE FROM questions WHERE id = ?", (question_id,))
+                self.__forget(username)
+
+    def __run(self) -> None:
+        while not self.__stopped.wait(self.lease / 10): # Also reports the ready workers, so more often than the lease needs
+            try:
+                self.__beat()
+            except sqlite3.Error as e:
+                self.lg.error(f"Failed to write the heartbeat to {self.path}: {e}")
+
+    def shutdown(self) -> None:
+        """Signals the waiting workers of this process to stop, the other processes keep working
+        """
+        self.__shutdown = True
+        with self.__wakeup:
+            self.__wakeup.notify_all()
+
+    @property
+    def is_shutdown(self) -> bool:
+        """Whether the queue has been shut down in this process
+        """
+        return self.__shutdown
+
+    def close(self) -> None:
+        """Puts the questions this process still holds back into the queue and leaves the shared queue
+        """
+        self.shutdown()
+        self.__stopped.set()
+        self.__thread.join()
+        with self.__lock, self.__connection:
+            self.__connection.execute("BEGIN IMMEDIATE")
+            self.__connection.execute("UPDATE questions SET state = 'queued', worker = NULL, process = NULL WHERE process = ? AND state = 'taken'", (self.process,))
+            self.__connection.execute("DELETE FROM owners WHERE process = ?", (self.process,))
+            self.__connection.execute("DELETE FROM processes WHERE id = ?", (self.process,))
+        self.__connection.close()
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return self.__connection.execute("SELECT COUNT(*) FROM questions WHERE state = 'queued'").fetchone()[0]
+
+
+# Benchmark
+if __name__ == "__main__":
+    import multiprocessing
+    import tempfile
+
+    class Client:
+        def chat_postMessage(self, **_):
+            return {"ts": "1"}
+
+    class Owner:
+        def add(self, question):
+            question.user = self
+
+        def discard(self, question):
+            pass
+
+    def build(record: dict) -> Question:
+        return Question(record["channel"], record["username"], record["text"], Owner(), record["ts"], Client(), record["direct_message"])
+
+    def produce(path: str, start: int, count: int) -> None:
+        queue = SharedQueue(path)
+        for index in range(start, start + count):
+            queue.push(build({"channel": "C", "username": f"user{index % 50}", "text": f"Question {index}", "ts": str(index), "direct_message": False}))
+        queue.close()
+
+    def consume(path: str, name: str, results) -> None:
+        queue = SharedQueue(path)
+        queue.factory = build
+        answered = 0
+        while True:
+            question = queue.pop(timeout=1.0, worker=name)
+            if question is None:
+                break
+            queue.complete(question)
+            answered += 1
+        queue.close()
+        results.put(answered)
+
+    for producers, consumers in ((1, 1), (2, 4), (4, 8)):
+        path = os.path.join(tempfile.mkdtemp(), "shared.db")
+        SharedQueue(path).close() # Create the tables before the processes race for them
+        results = multiprocessing.Queue()
+        count = 2000
+        start = time.perf_counter()
+        processes = [multiprocessing.Process(target=produce, args=(path, index * count, count)) for index in range(producers)]
+        processes += [multiprocessing.Process(target=consume, args=(path, f"Worker-{index}", results)) for index in range(consumers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        duration = time.perf_counter() - start - 1.0 # The consumers wait a second for more questions before they stop
+        answered = sum(results.get() for _ in range(consumers))
+        print(f"{producers} producer and {consumers} consumer processes: {answered}/{producers * count} questions in {duration:.2f}s, {answered / duration:.0f} questions/s")
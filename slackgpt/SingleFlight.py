@@ -0,0 +1,63 @@
+from typing import Dict, Iterable, List
+import threading
+from Question import Question
+from AnswerCache import normalize_prompt
+
+class SingleFlight:
+    def __init__(self, prefix: str = "!", excluded_channels: Iterable[str] = ()):
+        """Coalesces identical prompts that are asked while the first copy is still queued or being answered
+
+        The first question with a prompt becomes the leader and goes to the queue, every identical question
+        asked before the leader is answered follows it and receives the same answer.
+
+        Args:
+            prefix (str, optional): The prefix that triggers the bot, stripped from the prompts. Defaults to "!".
+            excluded_channels (Iterable[str], optional): The channels whose questions are never coalesced. Defaults to ().
+        """
+        self.prefix = prefix
+        self.excluded_channels = set(excluded_channels)
+        self.coalesced = 0 # The amount of questions that didn't need their own backend call
+        self.__leaders: Dict[str, Question] = {} # Normalized prompt -> question in flight
+        self.__lock = threading.Lock()
+
+    def join(self, question: Question) -> bool:
+        """Attaches a question to an identical question in flight or makes it the leader for its prompt
+
+        Args:
+            question (Question): The new question
+
+        Returns:
+            bool: Whether the question follows another question and must not be queued
+        """
+        if question.channel in self.excluded_channels:
+            return False
+        key = normalize_prompt(question.text, self.prefix)
+        with self.__lock:
+            leader = self.__leaders.get(key)
+            if leader is None:
+                self.__leaders[key] = question
+                return False
+            if leader.followers is None:
+                leader.followers = []
+            leader.followers.append(question)
+            self.coalesced += 1
+            return True
+
+    def release(self, question: Question) -> List[Question]:
+        """Removes an answered leader and returns its followers, no question can join it afterwards
+
+        Args:
+            question (Question): The answered question
+
+        Returns:
+            List[Question]: The questions that followed the leader
+        """
+        key = normalize_prompt(question.text, self.prefix)
+        with self.__lock:
+            if self.__leaders.get(key) is question:
+                del self.__leaders[key]
+            followers, question.followers = question.followers or [], None
+        return followers
+
+    def __len__(self) -> int:
+        return len(self.__leaders)
@@ -0,0 +1,93 @@
+from typing import Optional
+import threading
+import time
+from Logger import *
+from AdmissionControl import format_wait
+from ProcessStats import process_age
+import Metrics
+
+class Startup:
+    def __init__(self, expected: float = 60.0, imports: float = 0.0):
+        """Tracks the cold start of the bot: when the first backend is ready and when the first question is answered
+
+        Questions that arrive before a backend is ready are queued and their users are told how long the startup
+        should still take.
+
+        Args:
+            expected (float, optional): The amount of seconds a backend is expected to take to start, for the estimate. Defaults to 60.0.
+            imports (float, optional): The amount of seconds the process spent importing its modules, part of the time until it is ready. Defaults to 0.0.
+        """
+        self.expected = expected
+        self.imports = imports
+        self.started = time.monotonic() - process_age()
+        self.ready_after: Optional[float] = None # Seconds from the process start until the first backend was ready
+        self.answered_after: Optional[float] = None # Seconds from the process start until the first question was answered
+        self.__ready = threading.Event()
+        self.__lock = threading.Lock()
+        self.lg = Logger("Startup", level=Level.INFO, formatter=Logger.minecraft_formatter, handlers=[FileHandler.latest_file_handler(Logger.minecraft_formatter), main_file_handler])
+        Metrics.registry.register(Metrics.Gauge("slackgpt_startup_import_seconds", "Time the process spent importing its modules", lambda: self.imports))
+        Metrics.registry.register(Metrics.Gauge("slackgpt_startup_ready_seconds", "Time from the process start until the first backend was ready", lambda: self.ready_after if self.ready_after is not None else float("nan")))
+        Metrics.registry.register(Metrics.Gauge("slackgpt_startup_first_answer_seconds", "Time from the process start until the first question was answered", lambda: self.answered_after if self.answered_after is not None else float("nan")))
+
+    @property
+    def is_ready(self) -> bool:
+        """Whether a backend has been ready since the start
+        """
+        return self.__ready.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until a backend is ready
+
+        Args:
+            timeout (float, optional): The maximum amount of seconds to wait. Defaults to None (wait forever).
+
+        Returns:
+            bool: Whether a backend is ready
+        """
+        return self.__ready.wait(timeout)
+
+    def backend_ready(self, name: str, duration: float) -> None:
+        """Records that a backend has been built and warmed up
+
+        Args:
+            name (str): The name of the worker
+            duration (float): The amount of seconds the backend took to start
+        """
+        with self.__lock:
+            if self.ready_after is not None:
+                return
+            self.ready_after = time.monotonic() - self.started
+        self.__ready.set()
+        self.lg.info(f"{name} is the first ready backend after {self.ready_after:.2f} seconds ({self.imports:.2f} seconds to import the modules, {duration:.2f} seconds to start the backend)")
+
+    def answered(self) -> None:
+        """Records that a backend answered a question, the first answer ends the cold start
+        """
+        if self.answered_after is not None:
+            return
+        with self.__lock:
+            if self.answered_after is not None:
+                return
+            self.answered_after = time.monotonic() - self.started
+        self.lg.info(f"Answered the first question {self.answered_after:.2f} seconds after the start")
+
+    def eta(self) -> float:
+        """Estimates how long the startup still takes
+
+        Returns:
+            float: The estimated amount of seconds, 0 once a backend is ready
+        """
+        if self.is_ready:
+            return 0.0
+        return max(self.expected - (time.monotonic() - self.started), 5.0) # Late backends are usually almost ready
+
+    def describe(self, wait: float = 0.0) -> str:
+        """Returns the feedback for a question that arrived before a backend was ready
+
+        Args:
+            wait (float, optional): The estimated amount of seconds the question waits in the queue once a backend is ready. Defaults to 0.0.
+
+        Returns:
+            str: The message for the user
+        """
+        return f"I am still starting up. Your question is queued and should be answered in about {format_wait(self.eta() + wait)}."
@@ -1,24 +1,112 @@
-from typing import List
+from collections import deque
+from typing import Deque, Dict, Optional
+import threading
 from Question import Question
 
 class User:
-    def __init__(self, username: str):
+    __slots__ = ("username", "store", "__conversation_id", "pending", "answered", "answered_bytes", "pending_prompts", "answered_prompts", "lock")
+
+    max_answers = 100 # The amount of answered questions kept per user, 0 for no limit
+    max_answer_bytes = 256 * 1024 # The UTF-8 size of the prompts and answers kept per user, 0 for no limit
+
+    def __init__(self, username: str, conversation_id: Optional[str] = None, store=None):
         """Represents a user in the handler
 
+        Only the latest answered questions are kept, see max_answers and max_answer_bytes. Older answers are
+        forgotten or, with a store, looked up in the database.
+
         Args:
             username (str): The username of the user
+            conversation_id (str, optional): The conversation id from ChatGPT. Defaults to None.
+            store (UserStore, optional): Persists the conversation id and answers. Defaults to None.
         """
         self.username = username
-        self.conversation_id = None # The conversation id from ChatGPT
-        self.pending: List[Question] = [] # The list of pending questions
-        self.answered: List[Question] = [] # The list of answered questions
+        self.store = store
+        self.__conversation_id = conversation_id
+        self.pending: Dict[int, Question] = {} # id(question) -> pending question, in the order they were asked
+        self.answered: Deque[Question] = deque() # The latest answered questions, oldest first
+        self.answered_bytes = 0 # The size of the prompts and answers in answered
+        self.pending_prompts: Dict[str, Question] = {} # Prompt -> pending question
+        self.answered_prompts: Dict[str, Question] = {} # Prompt -> latest answered question
+        self.lock = threading.Lock()
+
+    @property
+    def conversation_id(self) -> Optional[str]:
+        """The conversation id from ChatGPT
+        """
+        return self.__conversation_id
+
+    @conversation_id.setter
+    def conversation_id(self, conversation_id: Optional[str]) -> None:
+        if conversation_id != self.__conversation_id and self.store is not None:
+            self.store.save_conversation(self.username, conversation_id)
+        self.__conversation_id = conversation_id
+
+    def load_conversation(self, conversation_id: Optional[str]) -> None:
+        """Sets the conversation id read from the store without writing it back
+
+        Args:
+            conversation_id (Optional[str]): The conversation id
+        """
+        self.__conversation_id = conversation_id
 
     def __str__(self):
         return f"User({self.username}) -> {self.conversation_id}"
 
     def add(self, question: Question):
+        """Adds a question to the pending list and index
+
+        Args:
+            question (Question): The question to add
+        """
         question.user = self
-        self.pending.append(question)
+        with self.lock:
+            self.pending[id(question)] = question
+            self.pending_prompts[question.text] = question
+
+    def discard(self, question: Question):
+        """Removes a pending question without answering it, e.g. because another process answers it
+
+        Args:
+            question (Question): The question to remove
+        """
+        with self.lock:
+            self.pending.pop(id(question), None)
+            if self.pending_prompts.get(question.text) is question:
+                del self.pending_prompts[question.text]
+
+    def mark_answered(self, question: Question):
+        """Moves a question from the pending list and index to the answered ones
+
+        Args:
+            question (Question): The answered question
+        """
+        with self.lock:
+            self.answered.append(question)
+            self.answered_bytes += self.size(question)
+            self.answered_prompts[question.text] = question
+            self.pending.pop(id(question), None)
+            if self.pending_prompts.get(question.text) is question:
+                del self.pending_prompts[question.text]
+            if self.store is not None:
+                self.store.add_answer(question)
+            while len(self.answered) > 1 and ((self.max_answers and len(self.answered) > self.max_answers) or (self.max_answer_bytes and self.answered_bytes > self.max_answer_bytes)):
+                oldest = self.answered.popleft()
+                self.answered_bytes -= self.size(oldest)
+                if self.answered_prompts.get(oldest.text) is oldest:
+                    del self.answered_prompts[oldest.text]
+
+    @staticmethod
+    def size(question: Question) -> int:
+        """Returns the UTF-8 size of the prompt and answer of a question
+
+        Args:
+            question (Question): The answered question
+
+        Returns:
+            int: The size in bytes
+        """
+        return len(question.text.encode()) + len(question.answer_text.encode())
 
     def in_pending(self, question: str) -> bool:
         """Utility method to check if a question is in the pending list
@@ -29,7 +117,7 @@ class User:
         Returns:
             bool: Whether or not the question is in the pending list
         """
-        return question in [item.text for item in self.pending]
+        return question in self.pending_prompts
 
     def in_answered(self, question: str) -> bool:
         """Utility method to check if a question is in the answered list
@@ -39,5 +127,51 @@ class User:
 
         Returns:
             bool: Whether or not the question is in the answered list
-        """        """"""
-        return question in [item.text for item in self.answered]
\ No newline at end of file
+        """
+        return self.get_answered(question) is not None
+
+    def get_answered(self, question: str) -> Optional[Question]:
+        """Returns the latest answered question with the given prompt
+
+        Args:
+            question (str): The prompt of the question
+
+        Returns:
+            Optional[Question]: The answered question or None if the prompt hasn't been answered yet
+        """
+        answered = self.answered_prompts.get(question)
+        if answered is None and self.store is not None:
+            return self.store.find_answer(self.username, question)
+        return answered
+
+
+# Benchmark
+if __name__ == "__main__":
+    import time
+    import tracemalloc
+
+    class Recorder:
+        def chat_postMessage(self, **_):
+            return {"ts": "1"}
+
+    def measure(max_answers: int, max_answer_bytes: int) -> str:
+        User.max_answers = max_answers
+        User.max_answer_bytes = max_answer_bytes
+        client = Recorder()
+        users = [User(f"user{index}") for index in range(1000)]
+        tracemalloc.start()
+        start = time.perf_counter()
+        for index in range(100000): # 1000 users ask 100 questions each
+            user = users[index % 1000]
+            question = Question("C00000000", user.username, f"!Question {index}: please explain this", user, f"{1600000000 + index}.000100", client)
+            question.answer(f"Answer {index} " + "lorem " * 60)
+        duration = time.perf_counter() - start
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        found = sum(users[index % 1000].get_answered(f"!Question {index}: please explain this") is not None for index in range(99000, 100000))
+        return f"max_answers {max_answers:3}, max_answer_bytes {max_answer_bytes:6}: {current / 2 ** 20:5.1f}MiB for 100000 answered questions ({current / 100000:4.0f} bytes each), {duration / 100000 * 1e6:.1f}us per answer, {found}/1000 recent answers found"
+
+    print(measure(0, 0))
+    print(measure(100, 256 * 1024))
+    print(measure(20, 0))
+    print(measure(0, 8 * 1024))
@@ -0,0 +1,278 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import itertools
+import sqlite3
+import threading
+import time
+from User import User
+from Logger import *
+
+class StoredAnswer:
+    __slots__ = ("channel", "username", "text", "answer_text", "is_answered")
+
+    def __init__(self, channel: str, username: str, text: str, answer_text: str):
+        """An answered question loaded from the store, it has the fields of Question that are read after answering
+
+        Args:
+            channel (str): The channel id
+            username (str): The username of the user
+            text (str): The prompt
+            answer_text (str): The answer
+        """
+        self.channel = channel
+        self.username = username
+        self.text = text
+        self.answer_text = answer_text
+        self.is_answered = True
+
+
+class UserStore:
+    def __init__(self, path: str, hot_users: int = 1000, flush_interval: float = 1.0, max_batch: int = 500, history_ttl: float = 90 * 24 * 3600):
+        """Keeps users, their conversation ids and their answered questions in SQLite so they survive restarts
+
+        The database runs in WAL mode and answers are indexed by user and prompt hash. The most recently used users are
+        kept in memory with their latest answers (see User.max_answers), older answers are looked up in the database. Changes are written in
+        batches from a background thread, and users are only loaded when they ask something.
+
+        Args:
+            path (str): The path of the database file
+            hot_users (int, optional): The amount of users kept in memory, users with pending questions are never evicted. Defaults to 1000.
+            flush_interval (float, optional): The maximum amount of seconds a change waits before it is written. Defaults to 1.0.
+            max_batch (int, optional): The amount of waiting changes that triggers an early write. Defaults to 500.
+            history_ttl (float, optional): The amount of seconds answers are kept in the database, 0 to keep them forever. Defaults to 90 days.
+        """
+        self.path = path
+        self.hot_users = hot_users
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.history_ttl = history_ttl
+        self.loads = 0 # The amount of users loaded from the database
+        self.evictions = 0
+        self.__users: "OrderedDict[str, User]" = OrderedDict() # Username -> user, least recently used first
+        self.__users_lock = threading.Lock()
+        self.__conversations: Dict[str, Optional[str]] = {} # Username -> conversation id waiting to be written
+        self.__flushing: Dict[str, Optional[str]] = {} # Username -> conversation id being written
+        self.__answers: List[Tuple[str, str, str, str, str, float]] = [] # (username, prompt hash, prompt, answer, channel, time) waiting to be written
+        self.__flushing_answers: List[Tuple[str, str, str, str, str, float]] = [] # Answers being written
+        self.__condition = threading.Condition()
+        self.__closed = False
+        self.__purged = 0.0
+        self.__write_lock = threading.Lock()
+        self.__writer = self.__connect()
+        self.__writer.executescript("""
+            CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, conversation_id TEXT, updated REAL);
+            CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY, username TEXT NOT NULL, prompt_hash TEXT NOT NULL, prompt TEXT NOT NULL, answer TEXT NOT NULL, channel TEXT, answered REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS history_user_prompt ON history (username, prompt_hash);
+            CREATE INDEX IF NOT EXISTS history_answered ON history (answered);
+        """)
+        self.__reader = self.__connect()
+        self.__read_lock = threading.Lock()
+        self.__thread = threading.Thread(target=self.__run, name="UserStore", daemon=True)
+        self.__thread.start()
+        self.lg = Logger("UserStore", level=Level.INFO, formatter=Logger.minecraft_formatter, handlers=[FileHandler.latest_file_handler(Logger.minecraft_formatter), main_file_handler])
+
+    def __connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL") # WAL stays consistent, only the last batch can be lost on power failure
+        return connection
+
+    @staticmethod
+    def prompt_hash(prompt: str) -> str:
+        return hashlib.sha1(prompt.encode()).hexdigest()
+
+    def get(self, username: str) -> User:
+        """Returns the user from memory or loads it from the database, creating it if it is new
+
+        Args:
+            username (str): The username of the user
+
+        Returns:
+            User: The user
+        """
+        with self.__users_lock:
+            user = self.__users.get(username)
+            if user is not None:
+                self.__users.move_to_end(username)
+                return user
+            with self.__condition:
+                pending = self.__conversations if username in self.__conversations else self.__flushing
+                waiting = username in pending
+                conversation_id = pending.get(username)
+            if not waiting:
+                with self.__read_lock:
+                    row = self.__reader.execute("SELECT conversation_id FROM users WHERE username = ?", (username,)).fetchone()
+                conversation_id = row[0] if row is not None else None
+            user = self.__users[username] = User(username, conversation_id, self)
+            self.loads += 1
+            self.__evict()
+            return user
+
+    def refresh(self, user: User) -> None:
+        """Reloads the conversation id of a user that another process may have changed, unless a change of this process is waiting to be written
+
+        Args:
+            user (User): The user
+        """
+        with self.__condition:
+            if user.username in self.__conversations or user.username in self.__flushing:
+                return
+        with self.__read_lock:
+            row = self.__reader.execute("SELECT conversation_id FROM users WHERE username = ?", (user.username,)).fetchone()
+        if row is not None:
+            user.load_conversation(row[0])
+
+    def __evict(self) -> None:
+        for username in list(self.__users):
+            if len(self.__users) <= self.hot_users:
+                return
+            if not self.__users[username].pending: # Users with pending questions are referenced by the queue
+                del self.__users[username]
+                self.evictions += 1
+
+    def save_conversation(self, username: str, conversation_id: Optional[str]) -> None:
+        """Queues the conversation id of a user for writing
+
+        Args:
+            username (str): The username of the user
+            conversation_id (Optional[str]): The conversation id
+        """
+        with self.__condition:
+            self.__conversations[username] = conversation_id
+            self.__notify()
+
+    def add_answer(self, question) -> None:
+        """Queues an answered question for writing
+
+        Args:
+            question (Question): The answered question
+        """
+        with self.__condition:
+            self.__answers.append((question.username, self.prompt_hash(question.text), question.text, question.answer_text, question.channel, time.time()))
+            self.__notify()
+
+    def __notify(self) -> None:
+        if len(self.__answers) + len(self.__conversations) >= self.max_batch:
+            self.__condition.notify()
+
+    def find_answer(self, username: str, prompt: str) -> Optional[StoredAnswer]:
+        """Returns the latest answer of a user to a prompt, including answers that haven't been written yet
+
+        Args:
+            username (str): The username of the user
+            prompt (str): The prompt
+
+        Returns:
+            Optional[StoredAnswer]: The answered question or None if the user never asked the prompt
+        """
+        with self.__condition:
+            for answer in itertools.chain(reversed(self.__answers), reversed(self.__flushing_answers)):
+                if answer[0] == username and answer[2] == prompt:
+                    return StoredAnswer(answer[4], username, prompt, answer[3])
+        with self.__read_lock:
+            row = self.__reader.execute("SELECT channel, answer FROM history WHERE username = ? AND prompt_hash = ? AND prompt = ? ORDER BY id DESC LIMIT 1", (username, self.prompt_hash(prompt), prompt)).fetchone()
+        return StoredAnswer(row[0], username, prompt, row[1]) if row is not None else None
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                if not self.__closed and len(self.__answers) + len(self.__conversations) < self.max_batch:
+                    self.__condition.wait(self.flush_interval)
+                if self.__closed:
+                    return
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                self.lg.error(f"Failed to write to {self.path}: {e}")
+
+    def flush(self) -> None:
+        """Writes every waiting change in one transaction and purges expired answers about once an hour
+        """
+        with self.__write_lock:
+            with self.__condition:
+                conversations, self.__conversations = self.__conversations, {}
+                answers, self.__answers = self.__answers, []
+                self.__flushing = conversations
+                self.__flushing_answers = answers
+            now = time.time()
+            if not conversations and not answers and not (self.history_ttl and now - self.__purged > 3600):
+                return
+            try:
+                with self.__writer: # One transaction per batch
+                    self.__writer.execute("BEGIN")
+                    self.__writer.executemany("INSERT INTO users (username, conversation_id, updated) VALUES (?, ?, ?) ON CONFLICT(username) DO UPDATE SET conversation_id = excluded.conversation_id, updated = excluded.updated", [(username, conversation_id, now) for username, conversation_id in conversations.items()])
+                    self.__writer.executemany("INSERT INTO history (username, prompt_hash, prompt, answer, channel, answered) VALUES (?, ?, ?, ?, ?, ?)", answers)
+                    if self.history_ttl and now - self.__purged > 3600:
+                        self.__writer.execute("DELETE FROM history WHERE answered < ?", (now - self.history_ttl,))
+                        self.__purged = now
+            except sqlite3.Error:
+                with self.__condition: # Keep the batch for the next attempt, newer changes win
+                    self.__answers[:0] = answers
+                    for username, conversation_id in conversations.items():
+                        self.__conversations.setdefault(username, conversation_id)
+                raise
+            finally:
+                with self.__condition:
+                    self.__flushing = {}
+                    self.__flushing_answers = []
+
+    def close(self) -> None:
+        """Stops the background thread, writes the waiting changes and closes the database
+        """
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        self.__thread.join()
+        self.flush()
+        with self.__write_lock:
+            self.__writer.close()
+        with self.__read_lock:
+            self.__reader.close()
+
+    def stats(self) -> str:
+        """Returns a human readable summary of the store
+
+        Returns:
+            str: The summary
+        """
+        return f"User store: {len(self.__users)} users in memory, {self.loads} loaded, {self.evictions} evicted"
+
+    def __len__(self) -> int:
+        return len(self.__users)
+
+
+# Benchmark
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import tracemalloc
+    from Question import Question
+
+    class Recorder:
+        def chat_postMessage(self, **_):
+            return {"ts": "1"}
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "users.db")
+    tracemalloc.start()
+    store = UserStore(path, hot_users=1000)
+    start = time.perf_counter()
+    for index in range(100000): # 10000 users ask 10 questions each, round robin
+        user = store.get(f"user{index % 10000}")
+        question = Question("C", user.username, f"Question {index // 10000}", user, str(index), Recorder())
+        question.answer("Answer " * 50)
+        user.conversation_id = f"conversation{index % 10000}"
+    store.flush()
+    duration = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    print(f"100000 answers from 10000 users in {duration:.2f}s ({duration / 100000 * 1e6:.1f}us each), {current / 2 ** 20:.1f}MiB in use, peak {peak / 2 ** 20:.1f}MiB, {store.stats()}")
+    start = time.perf_counter()
+    hits = sum(store.get(f"user{index}").get_answered("Question 3") is not None for index in range(0, 10000, 7))
+    print(f"Looked up {len(range(0, 10000, 7))} old answers ({hits} found) in {(time.perf_counter() - start) / len(range(0, 10000, 7)) * 1e6:.1f}us each")
+    store.close()
+    store = UserStore(path)
+    start = time.perf_counter()
+    user = store.get("user42")
+    print(f"Reopened and loaded a user lazily in {(time.perf_counter() - start) * 1000:.2f}ms, conversation {user.conversation_id}, {os.path.getsize(path) / 2 ** 20:.1f}MiB on disk")
+    store.close()
@@ -1,14 +1,44 @@
 from Question import Question
 from slack_sdk.web import WebClient
+from concurrent.futures import Future
+import time
 
 
 class WaitingQuestion(Question):
+    __slots__ = ("placeholder_ts", "last_update")
 
-    def __init__(self, channel: str, username: str, text: str, user, ts: str, client: WebClient):
-        super().__init__(channel, username, text, user, ts, client)
+    update_interval = 1.0 # The minimum amount of seconds between two edits of the placeholder message
+
+    def __init__(self, channel: str, username: str, text: str, user, ts: str, client: WebClient, direct_message: bool = False):
+        """Represents a question that posts a placeholder message and edits it in place with the (partial) answer
+
+        Args:
+            channel (str): The channel id
+            username (str): The username of the user
+            text (str): The prompt for ChatGPT
+        """
+        super().__init__(channel, username, text, user, ts, client, direct_message)
+        self.placeholder_ts = None # The ts of the "I am thinking ..." message or the outbox future resolving to it
+        self.last_update = 0.0
 
     def send_pre_answer(self) -> str:
-        return self.client.chat_postMessage(channel=self.channel, text="I am thinking ...")
+        response = self.client.chat_postMessage(channel=self.channel, text="I am thinking ...")
+        self.placeholder_ts = response if isinstance(response, Future) else response["ts"]
+        return self.placeholder_ts
+
+    def send_partial(self, text: str) -> bool:
+        if self.placeholder_ts is None or not text or time.monotonic() - self.last_update < self.update_interval:
+            return False
+        self.client.chat_update(channel=self.channel, ts=self.placeholder_ts, text=text + " ...")
+        self.last_update = time.monotonic()
+        return True
+
+    def detach(self) -> None:
+        super().detach()
+        self.placeholder_ts = None
 
     def send_answer(self) -> None:
-        self.client.chat_postMessage(channel=self.channel, text=self.answer_text)
+        if self.placeholder_ts is None:
+            self.track_delivery(self.client.chat_postMessage(channel=self.channel, text=self.answer_text))
+        else:
+            self.track_delivery(self.client.chat_update(channel=self.channel, ts=self.placeholder_ts, text=self.answer_text))
@@ -0,0 +1,201 @@
+from typing import Callable, List, Optional
+import threading
+import time
+from Handler import Handler
+from Logger import *
+from ChatBotThread import ChatBotThread
+from Question import Question
+from ProcessStats import process_tree_rss
+import Metrics
+
+class WorkerPool:
+    def __init__(self, handler: Handler, factory: Callable[[str], ChatBotThread], size: int = 1, create_bot: Optional[Callable[[], object]] = None, ask_timeout: float = 0, max_attempts: int = 2, recycle_after: int = 0, max_rss: int = 0, spares: int = 0, watch_interval: float = 1.0, rss_interval: float = 10.0):
+        """Represents a pool of chatbot workers that drain the handler's queue concurrently
+
+        Every worker claims the users of the questions it answers, so a conversation always stays
+        with the backend that created it (see Queue.pop).
+
+        A watchdog thread enforces the ask deadlines and replaces workers whose thread stopped, e.g. because their
+        backend couldn't be built (see ChatBotThread.start_bot). A worker whose backend made no progress for ask_timeout seconds
+        is abandoned and replaced by a new worker with a new backend, and its question is queued again or failed. The
+        watchdog also asks the busiest worker to rebuild its backend when the process tree uses more than max_rss bytes.
+
+        Spare workers build and warm up their backend in the background without answering questions. A hung worker is
+        replaced by a ready spare, so the pool doesn't wait for a browser to start.
+
+        Args:
+            handler (Handler): The handler whose queue the workers drain
+            factory (Callable[[str], ChatBotThread]): Creates a worker with the given name
+            size (int, optional): The amount of workers. Defaults to 1.
+            create_bot (Callable[[], object], optional): Overrides the create_bot method of every worker, e.g. with a stub. Defaults to None.
+            ask_timeout (float, optional): The amount of seconds a backend may take without progress, 0 for no limit. Defaults to 0.
+            max_attempts (int, optional): The amount of timed out asks after which a question is failed instead of queued again. Defaults to 2.
+            recycle_after (int, optional): The amount of asks after which a worker rebuilds its backend, 0 for never. Defaults to 0.
+            max_rss (int, optional): The amount of bytes the process and its browsers may use before a backend is rebuilt, 0 for no limit. Defaults to 0.
+            spares (int, optional): The amount of spare workers kept ready to replace hung workers. Defaults to 0.
+            watch_interval (float, optional): The amount of seconds between two deadline checks. Defaults to 1.0.
+            rss_interval (float, optional): The amount of seconds between two memory checks. Defaults to 10.0.
+
+        Raises:
+            ValueError: If the size is smaller than 1
+        """
+        if size < 1:
+            raise ValueError("A worker pool needs at least one worker")
+        self.handler = handler
+        self.factory = factory
+        self.create_bot = create_bot
+        self.ask_timeout = ask_timeout
+        self.max_attempts = max_attempts
+        self.recycle_after = recycle_after
+        self.max_rss = max_rss
+        self.watch_interval = watch_interval
+        self.rss_interval = rss_interval
+        self.replaced = 0 # The amount of workers replaced because their backend hung
+        self.workers: List[ChatBotThread] = []
+        self.spares: List[ChatBotThread] = []
+        self.spawned = 0 # The amount of spare workers created
+        self.lg = Logger("WorkerPool", level=Level.INFO, formatter=Logger.minecraft_formatter, handlers=[FileHandler.latest_file_handler(Logger.minecraft_formatter), main_file_handler])
+        for index in range(size):
+            self.workers.append(self.__create(f"ChatBot-{index}"))
+        for _ in range(spares):
+            self.spares.append(self.__create_spare())
+        self.__stopped = threading.Event()
+        self.__watchdog = threading.Thread(target=self.__watch, name="Watchdog", daemon=True)
+        Metrics.registry.register(Metrics.Gauge("slackgpt_workers", "Amount of chatbot workers", lambda: len(self.workers)))
+        Metrics.registry.register(Metrics.Gauge("slackgpt_workers_busy", "Amount of workers answering a question", lambda: sum(worker.busy for worker in self.workers)))
+        Metrics.registry.register(Metrics.Gauge("slackgpt_workers_ready", "Amount of workers with a ready backend", lambda: self.ready))
+        Metrics.registry.register(Metrics.Gauge("slackgpt_spares_ready", "Amount of spare workers with a ready backend", lambda: sum(spare.ready.is_set() for spare in self.spares)))
+
+    def __create(self, name: str) -> ChatBotThread:
+        worker = self.factory(name)
+        if self.create_bot is not None:
+            worker.create_bot = self.create_bot
+        worker.ask_timeout = self.ask_timeout
+        worker.recycle_after = self.recycle_after
+        return worker
+
+    def __create_spare(self) -> ChatBotThread:
+        spare = self.__create(f"Spare-{self.spawned}")
+        spare.active.clear()
+        self.spawned += 1
+        return spare
+
+    def __take_spare(self, name: str) -> Optional[ChatBotThread]:
+        if not self.spares:
+            return None
+        spare = next((spare for spare in self.spares if spare.ready.is_set()), self.spares[0]) # A starting spare is still ahead of a new worker
+        self.spares.remove(spare)
+        replacement = self.__create_spare()
+        self.spares.append(replacement)
+        replacement.start()
+        spare.name = name # The name is the worker's key in the queue, it must be set before the spare pops a question
+        spare.activate()
+        return spare
+
+    @property
+    def ready(self) -> int:
+        """The amount of workers whose backend is ready to answer questions
+        """
+        return sum(worker.ready.is_set() for worker in self.workers)
+
+    def start(self) -> None:
+        """Starts every worker and spare of the pool and the watchdog. The backends are built in parallel by the worker threads
+        """
+        for worker in self.workers + self.spares:
+            worker.start()
+        self.__watchdog.start()
+        self.lg.info(f"Started {len(self.workers)} workers")
+
+    def __watch(self) -> None:
+        checked = time.monotonic()
+        while not self.__stopped.wait(self.watch_interval):
+            now = time.monotonic()
+            for index, worker in enumerate(list(self.workers)):
+                questions = worker.expire(now)
+                if questions:
+                    self.__replace(index, worker, questions)
+                elif not worker.is_alive() and not self.handler.queue.is_shutdown: # Its backend couldn't be built
+                    self.__revive(index, worker)
+            for index, spare in enumerate(list(self.spares)):
+                if not spare.is_alive() and not self.handler.queue.is_shutdown:
+                    self.lg.warning(f"{spare.name} stopped, starting a new spare")
+                    self.spares[index] = self.__create_spare()
+                    self.spares[index].start()
+            if self.max_rss and now - checked >= self.rss_interval:
+                checked = now
+                self.__check_memory()
+
+    def __replace(self, index: int, worker: ChatBotThread, questions: List[Question]) -> None:
+        self.replaced += 1
+        Metrics.errors.inc(kind="timeout")
+        Metrics.recycles.inc(reason="timeout")
+        self.lg.warning(f"{worker.name} didn't answer {questions[0].username} within {self.ask_timeout} seconds, replacing it")
+        # The hung thread can't be stopped, it exits once the backend returns or fails because it was torn down
+        threading.Thread(target=self.__close, args=(worker,), name=f"Close-{worker.name}", daemon=True).start()
+        self.__substitute(index, worker)
+        for question in questions:
+            self.__retry(question)
+
+    def __revive(self, index: int, worker: ChatBotThread) -> None:
+        self.replaced += 1
+        Metrics.recycles.inc(reason="failed")
+        self.lg.warning(f"{worker.name} stopped, replacing it")
+        self.__substitute(index, worker)
+
+    def __substitute(self, index: int, worker: ChatBotThread) -> None:
+        name = f"{worker.name.split('/')[0]}/{self.replaced}"
+        replacement = self.__take_spare(name)
+        if replacement is None:
+            replacement = self.__create(name)
+            replacement.start()
+        self.workers[index] = replacement
+        self.handler.queue.release(worker.name) # Its users are served by any worker
+
+    def __retry(self, question: Question) -> None:
+        question.attempts += 1
+        if question.attempts < self.max_attempts:
+            try:
+                self.handler.queue.push(question)
+                self.lg.info(f"Queued the question of {question.username} again")
+                return
+            except RuntimeError: # The queue has been shut down
+                pass
+        try:
+            question.answer(f"ChatGPT didn't answer within {round(self.ask_timeout)} seconds. Please try again later.")
+        except Exception as e:
+            self.lg.error(f"Failed to answer {question.username}: {e}")
+        finally:
+            self.handler.complete(question)
+            self.handler.answer_followers(question)
+
+    def __close(self, worker: ChatBotThread) -> None:
+        try:
+            worker.close_bot()
+        except Exception as e:
+            self.lg.error(f"Failed to close the backend of {worker.name}: {e}")
+
+    def __check_memory(self) -> None:
+        if any(worker.recycle_requested for worker in self.workers):
+            return # One backend at a time, so the other workers keep answering
+        rss = process_tree_rss()
+        if rss <= self.max_rss:
+            return
+        worker = max(self.workers, key=lambda worker: worker.asks)
+        worker.recycle_requested = True
+        self.lg.info(f"Using {rss / 2 ** 20:.0f}MiB, {worker.name} rebuilds its backend after {worker.asks} asks")
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Shuts down the queue and waits for the workers to finish the questions they already picked up
+
+        Args:
+            timeout (float, optional): The maximum amount of seconds to wait for each worker. Defaults to None.
+        """
+        self.__stopped.set()
+        self.handler.queue.shutdown()
+        for worker in self.workers + self.spares:
+            if worker.is_alive():
+                worker.join(timeout)
+        self.lg.info(f"Stopped {len(self.workers)} workers and {len(self.spares)} spares")
+
+    def __len__(self) -> int:
+        return len(self.workers)
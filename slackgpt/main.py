@@ -1,12 +1,38 @@
-from typing import List
+import time
+imports_start = time.monotonic() # Slack and Flask stay eager, WSGI servers load the app and its routes with the module and the workers need the client
+from typing import List, Optional
 from slack_sdk import WebClient
-from flask import Flask, Response
+from flask import Flask, Response, g, request
 from slackeventsapi import SlackEventAdapter
 import json
 import argparse
+import os
+import shlex
+import threading
 from Logger import *
 from Handler import Handler
 from GPTThread import GPTThread
+from WorkerPool import WorkerPool
+from LatencyTracker import LatencyTracker
+from AnswerCache import AnswerCache
+from SingleFlight import SingleFlight
+from NearDuplicateIndex import NearDuplicateIndex
+from ProfileCache import ProfileCache
+from WaitingQuestion import WaitingQuestion
+from Question import Question
+from User import User
+from Scheduler import schedulers
+from AdmissionControl import AdmissionControl
+from UserStore import UserStore
+from QueueJournal import QueueJournal
+from SharedQueue import SharedQueue
+from SharedEventSet import SharedEventSet
+from Startup import Startup
+from ChatLog import ChatLog, ChatMessage
+from Batcher import Batcher
+from ChatBotThread import ChatBotThread
+import Metrics
+import_seconds = time.monotonic() - imports_start
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--auth_path", help="Specifies the path to a file containing first the Slack Bot token, then the Slack signing secret", required=False)
@@ -16,54 +42,219 @@ parser.add_argument("--debug", "-d", action="store_true", help="Enable debug log
 parser.add_argument("--headless", action="store_true", help="Run chatgpt wrapper in headless mode", required=False)
 parser.add_argument("--browser", choices=["firefox", "chromium"], default="firefox", help="Specify the browser used by chatgpt wrapper (playwright install <browser>)", required=False)
 parser.add_argument("--prefix", default="!", help="Specify the prefix to trigger the bot", required=False)
+parser.add_argument("--workers", type=int, default=1, help="Specify the amount of chatbot workers (one browser each)", required=False)
+parser.add_argument("--dedup_ttl", type=float, default=600, help="Specify how many seconds Slack event ids are remembered to drop retries", required=False)
+parser.add_argument("--cache_size", type=int, default=10000, help="Specify the maximum amount of answers shared between users, 0 to disable the answer cache", required=False)
+parser.add_argument("--cache_ttl", type=float, default=3600, help="Specify how many seconds a cached answer is reused", required=False)
+parser.add_argument("--cache_path", help="Specify a file to keep the answer cache in between restarts", required=False)
+parser.add_argument("--no_cache_channel", action="append", default=[], help="Specify a channel that never uses the answer cache (can be repeated)", required=False)
+parser.add_argument("--similarity_threshold", type=float, help="Reuse the answer of a similar prompt if the estimated similarity (0-1) reaches this threshold", required=False)
+parser.add_argument("--similarity_index_size", type=int, default=10000, help="Specify the maximum amount of prompts in the similarity index", required=False)
+parser.add_argument("--no_coalesce", action="store_true", help="Ask every question separately, even if an identical question is already in flight", required=False)
+parser.add_argument("--profile_ttl", type=float, default=3600, help="Specify how many seconds a Slack username is cached", required=False)
+parser.add_argument("--warm_profiles", action="store_true", help="Cache the usernames of the whole workspace on startup", required=False)
+parser.add_argument("--stream", action="store_true", help="Post a placeholder message and edit it while the answer is generated", required=False)
+parser.add_argument("--stream_interval", type=float, default=1.0, help="Specify the minimum amount of seconds between two edits of a streamed answer", required=False)
+parser.add_argument("--scheduler", choices=list(schedulers), default="fifo", help="Specify the order in which questions are answered: fifo, fair (per user round robin, direct messages first) or shortest (shortest prompt first)", required=False)
+parser.add_argument("--max_wait", type=float, default=300, help="Specify after how many seconds a question is answered next regardless of the fair or shortest scheduler", required=False)
+parser.add_argument("--user_rate", type=float, default=0, help="Specify how many questions per minute a user may ask, 0 for no limit", required=False)
+parser.add_argument("--user_burst", type=float, default=5, help="Specify how many questions a user may ask at once", required=False)
+parser.add_argument("--max_queue", type=int, default=0, help="Specify the maximum amount of queued questions before new ones are rejected, 0 for no limit", required=False)
+parser.add_argument("--history_size", type=int, default=100, help="Specify how many answered questions are kept in memory per user, 0 for no limit", required=False)
+parser.add_argument("--history_bytes", type=int, default=256 * 1024, help="Specify how many bytes of prompts and answers are kept in memory per user, 0 for no limit", required=False)
+parser.add_argument("--store_path", help="Specify a SQLite file to keep users, conversations and answers in between restarts", required=False)
+parser.add_argument("--store_hot_users", type=int, default=1000, help="Specify how many users of the store are kept in memory", required=False)
+parser.add_argument("--journal_path", help="Specify a file to journal the queued questions in, unfinished questions are asked again after a restart", required=False)
+parser.add_argument("--ask_timeout", type=float, default=300, help="Specify after how many seconds without progress a hung ChatGPT backend is abandoned and replaced, 0 for no limit", required=False)
+parser.add_argument("--ask_attempts", type=int, default=2, help="Specify how many times a question is asked before it is failed because ChatGPT hung", required=False)
+parser.add_argument("--recycle_after", type=int, default=0, help="Specify after how many questions a worker restarts its browser, 0 for never", required=False)
+parser.add_argument("--max_rss", type=float, default=0, help="Specify how many MiB the bot and its browsers may use before a browser is restarted, 0 for no limit", required=False)
+parser.add_argument("--spare_backends", type=int, default=0, help="Specify the amount of spare browsers kept ready to replace hung ones", required=False)
+parser.add_argument("--warm_up_prompt", help="Specify a prompt every new browser asks before it answers questions", required=False)
+parser.add_argument("--startup_eta", type=float, default=60, help="Specify how many seconds a browser usually takes to start, for the estimate sent to questions that arrive during the startup", required=False)
+parser.add_argument("--batch_size", type=int, default=1, help="Specify how many queued questions of a user are merged into one ChatGPT prompt, 1 to ask every question separately", required=False)
+parser.add_argument("--batch_window", type=float, default=30, help="Specify within how many seconds questions of a user must have been asked to be merged", required=False)
+parser.add_argument("--chat_log_path", default="./logs/chat", help="Specify the directory of the chat log (JSON Lines, see ChatLog.py to query it)", required=False)
+parser.add_argument("--chat_log_size", type=float, default=64, help="Specify after how many MiB a chat log file is closed and compressed", required=False)
+parser.add_argument("--chat_log_age", type=float, default=86400, help="Specify after how many seconds a chat log file is closed and compressed", required=False)
+parser.add_argument("--chat_log_retention", type=float, default=30, help="Specify after how many days compressed chat log files are deleted, 0 to keep them forever", required=False)
+parser.add_argument("--role", choices=["all", "ingest", "worker"], default="all", help="Specify whether the process receives Slack events (ingest), answers questions (worker) or both (all), ingest and worker require --shared_path", required=False)
+parser.add_argument("--shared_path", help="Specify a SQLite file that queues the questions and deduplicates the Slack events of several processes", required=False)
+parser.add_argument("--ingest_workers", type=int, default=4, help="Specify the amount of threads processing Slack events after they have been acknowledged", required=False)
 
-args = parser.parse_args()
+args = parser.parse_args(shlex.split(os.environ["SLACKGPT_ARGS"]) if "SLACKGPT_ARGS" in os.environ else None) # WSGI servers don't pass arguments
+if args.role != "all" and not args.shared_path:
+    parser.error(f"--role {args.role} requires --shared_path")
+if args.shared_path and args.journal_path:
+    parser.error("--journal_path can't be combined with --shared_path, the shared queue keeps the unfinished questions")
+if args.shared_path and not args.store_path:
+    args.store_path = args.shared_path # The processes have to share the conversations too
 
 if args.auth_path:
     token, secret = open(args.auth_path, "r").read().splitlines() 
 else:
     token, secret = args.token, args.secret
 
-lg = Logger("SlackGPT", level=Level.DEBUG if args.debug else Level.INFO, formatter=Logger.minecraft_formatter, handlers=[FileHandler.latest_file_handler(Logger.minecraft_formatter), main_file_handler])
-clg = Logger("CHAT", level=Level.WARNING, formatter=Logger.minecraft_formatter, handlers=[FileHandler(Level.LOG, Logger.minecraft_formatter, directory="./logs", generator=lambda *_: "chat.log"), main_file_handler])
+lg = Logger("SlackGPT", level=Level.DEBUG if args.debug else Level.INFO, formatter=Logger.minecraft_formatter, handlers=[FileHandler.latest_file_handler(Logger.minecraft_formatter, level=Level.DEBUG if args.debug else Level.LOG), main_file_handler])
+chat_log = ChatLog(args.chat_log_path, max_bytes=int(args.chat_log_size * 2 ** 20), max_age=args.chat_log_age, retention=args.chat_log_retention * 86400)
+clg = Logger("CHAT", level=Level.WARNING, formatter=Logger.minecraft_formatter, handlers=[chat_log])
 app = Flask("SlackGPT") 
 adapter = SlackEventAdapter(secret, "/slack/events", app)
 
 client = WebClient(token)
-handler = Handler(client)
+answer_cache = AnswerCache(args.prefix, args.cache_ttl, args.cache_size, excluded_channels=args.no_cache_channel)
+if args.cache_path:
+    lg.info(f"Loaded {answer_cache.load(args.cache_path)} answers from {args.cache_path}")
+single_flight = None if args.no_coalesce or args.shared_path else SingleFlight(args.prefix, excluded_channels=args.no_cache_channel)
+near_duplicates = NearDuplicateIndex(args.prefix, args.similarity_threshold, args.similarity_index_size, excluded_channels=args.no_cache_channel) if args.similarity_threshold else None
+WaitingQuestion.update_interval = args.stream_interval
+User.max_answers = args.history_size
+User.max_answer_bytes = args.history_bytes
+ChatBotThread.warm_up_prompt = args.warm_up_prompt
+startup = Startup(args.startup_eta, import_seconds)
+handler = Handler(client, args.ingest_workers, args.dedup_ttl, answer_cache=answer_cache, single_flight=single_flight, near_duplicates=near_duplicates, question_type=WaitingQuestion if args.stream else Question,
+    scheduler=schedulers["fifo"] if args.scheduler == "fifo" else lambda: schedulers[args.scheduler](max_wait=args.max_wait),
+    admission=AdmissionControl(args.user_rate, args.user_burst, args.max_queue, args.workers),
+    store=UserStore(args.store_path, args.store_hot_users) if args.store_path else None,
+    journal=QueueJournal(args.journal_path) if args.journal_path else None,
+    startup=startup if args.role != "ingest" else None,
+    batcher=Batcher(args.prefix, args.batch_size, args.batch_window) if args.batch_size > 1 else None,
+    queue=SharedQueue(args.shared_path) if args.shared_path else None,
+    messages=SharedEventSet(args.shared_path, args.dedup_ttl) if args.shared_path else None)
+ack_latency = LatencyTracker("Slack event ack latency", histogram=Metrics.ack_seconds)
+Metrics.registry.register(Metrics.Gauge("slackgpt_queue_depth", "Amount of questions waiting for a worker", lambda: len(handler.queue)))
+Metrics.registry.register(Metrics.Gauge("slackgpt_outbox_depth", "Amount of messages waiting to be delivered to Slack", lambda: len(handler.outbox)))
+Metrics.registry.register(Metrics.Gauge("slackgpt_answer_cache_hits_total", "Answers reused from the answer cache", lambda: answer_cache.hits, "counter"))
+Metrics.registry.register(Metrics.Gauge("slackgpt_answer_cache_misses_total", "Questions not found in the answer cache", lambda: answer_cache.misses, "counter"))
+Metrics.registry.register(Metrics.Gauge("slackgpt_outbox_rate_limited_total", "Rate limited responses from Slack", lambda: handler.outbox.rate_limited, "counter"))
+if handler.batcher is not None:
+    Metrics.registry.register(Metrics.Gauge("slackgpt_batched_questions_total", "Questions merged into the ask of an earlier question", lambda: handler.batcher.merged, "counter"))
+profiles = ProfileCache(client, args.profile_ttl)
+pool: Optional[WorkerPool] = None # Created by create_pool
+
+@app.before_request
+def start_ack_timer():
+    g.received = time.perf_counter()
+
+@app.after_request
+def record_ack_latency(response):
+    if request.path == "/slack/events" and "received" in g:
+        ack_latency.record(time.perf_counter() - g.received)
+    return response
+
+@app.route("/metrics")
+def metrics():
+    """Serves the stage latencies, queue depth, worker utilization and error counters in the Prometheus text format
+    """
+    return Response(Metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/healthz")
+def healthz():
+    """Answers as long as the process is able to acknowledge Slack events, even while the backends are starting
+    """
+    return Response("OK", status=200, mimetype="text/plain")
+
+@app.route("/readyz")
+def readyz():
+    """Answers with 200 once a backend is ready to answer questions and with 503 before
+    """
+    if isinstance(handler.queue, SharedQueue): # Any process with a ready backend answers the questions
+        ready = handler.queue.ready_workers()
+        return Response(f"{'Ready' if ready else 'Starting'}: {ready} backends ready in all processes", status=200 if ready else 503, mimetype="text/plain")
+    ready = pool.ready if pool is not None else 0
+    workers = len(pool) if pool is not None else args.workers
+    return Response(f"{'Ready' if ready else 'Starting'}: {ready}/{workers} backends ready", status=200 if ready else 503, mimetype="text/plain")
 
 @adapter.on("message")
 def message(payload: dict):
+    """Acknowledges a message event as fast as possible and leaves the Slack calls to the handler's executor
+    """
+    event = payload.get("event", {})
+    if "event_id" not in payload or "text" not in event:
+        return Response("OK", status=200)
+    if not handler.register_message(payload):
+        return Response("OK", status=200)
+    payload["received"] = time.monotonic() # The start of the question's stage trace
+    handler.submit(process_event, payload)
+    return Response("OK", status=200)
+
+def process_event(payload: dict):
+    """Resolves the user of a message event and hands it to the handler. Runs on the handler's executor
 
+    Args:
+        payload (dict): The payload of the event
+    """
     event = payload["event"]
     message = event["text"]
 
     if "bot_id" in event.keys():
-        if not handler.is_unique_message(payload):
-            return
-        if message == "I am thinking ...":
-            handler.waiting_messages.append(event["ts"])
-        return Response("OK", status=200)
-
-    handler.messages.append(payload["event_id"])
+        return
 
-    user = client.users_info(user=event["user"]) # lookup the user id to get the username and profile picture
-    username = user["user"]["profile"]["display_name"]
-    if username == "":
-        username = user["user"]["real_name"]
+    username = profiles.get(event["user"]) # lookup the user id to get the username, only calls Slack for unknown users
 
-    lg.debug(json.dumps(payload, indent=2))
-    clg.log(f"[{event['channel']}] {username}: {event['text']}")
+    lg.debug(lambda: json.dumps(payload, indent=2))
+    clg.log(ChatMessage(event["channel"], username, event["text"], event_id=payload["event_id"], ts=event.get("ts")))
 
     if message.lower().startswith(args.prefix.lower()) or event["channel_type"] == "im":
-        return handler.process_message(payload, username)
+        handler.process_message(payload, username)
 
-    return Response("OK", status=200)
+def create_pool(create_bot=None) -> WorkerPool:
+    """Creates the pool of GPT threads configured by the arguments and reports its readiness at /readyz
+
+    Args:
+        create_bot (Callable[[], object], optional): Overrides the backend of the workers, e.g. with a stub. Defaults to None.
+
+    Returns:
+        WorkerPool: The pool, not started yet
+    """
+    global pool
+    pool = WorkerPool(handler, lambda name: GPTThread(handler, args.browser, args.prefix, args.headless, name, args.stream), args.workers, create_bot=create_bot,
+        ask_timeout=args.ask_timeout, max_attempts=args.ask_attempts, recycle_after=args.recycle_after, max_rss=int(args.max_rss * 2 ** 20), spares=args.spare_backends)
+    if isinstance(handler.queue, SharedQueue):
+        handler.queue.local_ready = lambda: pool.ready
+    return pool
 
 
 if __name__ == "__main__":
-    lg.info("Starting GPT Thread from main.py")
-    gpt_thread = GPTThread(handler, args.browser, args.prefix, args.headless)
-    lg.info("Started GPT Thread from main.py")
-    gpt_thread.start()
-    app.run(debug=args.debug)
+    if handler.journal is not None:
+        lg.info(f"Replayed {handler.replay()} unfinished questions from {args.journal_path}")
+    if args.role != "ingest":
+        lg.info(f"Starting {args.workers} GPT Threads from main.py")
+        pool = create_pool()
+        pool.start()
+        lg.info(f"Started {args.workers} GPT Threads from main.py, their backends start in the background")
+    if args.warm_profiles and args.role != "worker":
+        handler.submit(lambda _: lg.info(f"Cached {profiles.warm_up()} Slack users"), {})
+    try:
+        if args.role == "worker":
+            lg.info(f"Answering the questions queued in {args.shared_path}")
+            threading.Event().wait() # Until interrupted
+        else:
+            app.run(debug=args.debug)
+    finally:
+        handler.executor.shutdown(wait=True)
+        if pool is not None:
+            pool.stop()
+        if isinstance(handler.queue, SharedQueue):
+            handler.queue.close()
+            handler.messages.close()
+        if handler.journal is not None:
+            lg.info(handler.journal.stats())
+            handler.journal.close()
+        handler.outbox.close(timeout=30)
+        if handler.store is not None:
+            lg.info(handler.store.stats())
+            handler.store.close()
+        lg.info(ack_latency.report())
+        lg.info(handler.first_token_latency.report())
+        lg.info(answer_cache.stats())
+        lg.info(profiles.stats())
+        if near_duplicates is not None:
+            lg.info(f"Similarity index: {len(near_duplicates)} prompts, {near_duplicates.hits} hits, {near_duplicates.misses} misses")
+        if handler.batcher is not None:
+            lg.info(handler.batcher.stats())
+        if single_flight is not None:
+            lg.info(f"Coalesced {single_flight.coalesced} identical questions")
+        if args.cache_path:
+            answer_cache.save(args.cache_path)
+        chat_log.close()